@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+"""Queue delivery on a single asyncio event loop (``QUEUE_WORKER_MODE=async``).
+
+The thread mode ties up one thread per delivery in flight while it waits on
+the network. Here every delivery lane is a task on one loop, so hundreds of
+sends can be in flight at once:
+
+* ``AsyncHTTPClient`` is a small HTTP/1.1 client on ``asyncio`` streams that
+  keeps connections alive per host, like the ``requests`` session of
+  ``telegram_client``, and honours the same proxy and CA settings. What it
+  cannot do (a SOCKS proxy, say) stops the worker at startup.
+* Spool operations (scan, claim, ack, retry) block, so they run on a small
+  thread pool. The bookkeeping itself is ``queue_worker``'s: a pass claims
+  the same lanes ``process_queue_once`` would, and delivered, failed and
+  duplicate items are settled by the same functions.
+* Per-chat order is kept as in the thread mode: a destination has at most
+  one lane in flight, and its later items stay in ``pending/`` until that
+  lane finishes. Each lane takes at most ``MAX_LANE_ITEMS`` items per pass,
+  so the memory held does not grow with the backlog.
+* SIGTERM stops claiming, waits up to ``QUEUE_DRAIN_TIMEOUT`` seconds for
+  the lanes in flight and then exits. Items of lanes cut off by the timeout
+  stay in ``processing/`` and are recovered on the next start.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import email.message
+import json
+import logging
+import os
+import signal
+import ssl
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Set, Tuple
+
+import requests
+
+import env_utils
+import metrics
+import queue_watch
+import rate_limit
+import routing
+import sms_queue
+import telegram_client
+from on_receive import (
+    TELEGRAM_TEXT_LIMIT,
+    build_telegram_batch_payload,
+    build_telegram_payload,
+    build_telegram_payloads,
+)
+from queue_worker import (
+    DEFAULT_MAX_RETRY_DELAY,
+    claim_item,
+    coalesce,
+    fan_out_item,
+    is_due,
+    lane_key,
+    permanent_failure,
+    rendered_length,
+    resolve_bot_token,
+    resolve_chat_id,
+    schedule_retry,
+    settle_delivered,
+    skip_duplicate,
+)
+
+INFLIGHT_ENV = "QUEUE_ASYNC_INFLIGHT"
+IO_THREADS_ENV = "QUEUE_ASYNC_IO_THREADS"
+DRAIN_TIMEOUT_ENV = "QUEUE_DRAIN_TIMEOUT"
+DEFAULT_INFLIGHT = 100
+DEFAULT_IO_THREADS = 4
+DEFAULT_DRAIN_TIMEOUT = 30.0
+MAX_LANE_ITEMS = 50
+
+# Scheme, host, port and the proxy URL (empty for a direct connection).
+Origin = Tuple[str, str, int, str]
+PROXY_SCHEMES = ("http",)
+
+
+class Response:
+    """Status, headers and body of an HTTP response.
+
+    It has the attributes of ``requests.Response`` that ``telegram_client``'s
+    error helpers read; ``headers`` lookups ignore case.
+    """
+
+    __slots__ = ("status_code", "reason", "headers", "content")
+
+    def __init__(self, status_code: int, reason: str, headers: email.message.Message, content: bytes) -> None:
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self) -> object:
+        return json.loads(self.content.decode("utf-8"))
+
+
+class _Connection:
+    __slots__ = ("reader", "writer")
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    @property
+    def usable(self) -> bool:
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self) -> None:
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class _Closed(ConnectionError):
+    """The server closed or reset the connection before the first byte of the response."""
+
+
+def proxy_for(parts: urllib.parse.SplitResult) -> urllib.parse.SplitResult | None:
+    """The proxy ``requests`` would pick for ``parts``: ``<SCHEME>_PROXY`` or ``ALL_PROXY``, unless ``NO_PROXY`` matches."""
+    proxies = urllib.request.getproxies_environment()
+    proxy = proxies.get(parts.scheme) or proxies.get("all")
+    if not proxy or urllib.request.proxy_bypass_environment(parts.hostname or "", proxies):
+        return None
+    return urllib.parse.urlsplit(proxy if "://" in proxy else "http://" + proxy)
+
+
+def check_url(url: str) -> None:
+    """Raise ``ValueError`` for a URL the client cannot reach: not http(s), or behind a proxy other than http://."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Unsupported URL {parts.scheme}://{parts.hostname or ''}")
+    proxy = proxy_for(parts)
+    if proxy is not None and (proxy.scheme not in PROXY_SCHEMES or not proxy.hostname):
+        raise ValueError(
+            f"Unsupported proxy {proxy.scheme}://{proxy.hostname or ''} for {parts.hostname}; only http:// proxies are"
+        )
+
+
+def _basic_auth(parts: urllib.parse.SplitResult) -> str | None:
+    if parts.username is None:
+        return None
+    credentials = f"{urllib.parse.unquote(parts.username)}:{urllib.parse.unquote(parts.password or '')}"
+    return "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+
+
+def _head(lines: List[str]) -> bytes:
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class AsyncHTTPClient:
+    """HTTP/1.1 client for JSON POSTs that keeps connections alive per host.
+
+    At most ``pool_size`` connections per host are open at once; further
+    requests wait for one to come free. A request on a reused connection the
+    server has meanwhile closed, so that sending fails or the connection ends
+    before the first byte of the response, is sent once more on a new
+    connection. A client belongs to the event loop it is first used on.
+
+    As with ``requests``, ``HTTP(S)_PROXY``, ``ALL_PROXY`` and ``NO_PROXY``
+    select a proxy (HTTPS is tunnelled with ``CONNECT``), credentials in a
+    URL are sent as Basic auth, and ``REQUESTS_CA_BUNDLE`` replaces the CA
+    store. Only http:// proxies are supported; :func:`check_url` tells.
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5.0, read_timeout: float = 10.0) -> None:
+        self.pool_size = max(1, pool_size)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connections = 0
+        self._idle: Dict[Origin, List[_Connection]] = {}
+        self._slots: Dict[Origin, asyncio.Semaphore] = {}
+        self._ssl: ssl.SSLContext | None = None
+
+    @classmethod
+    def from_env(cls) -> "AsyncHTTPClient":
+        connect_timeout, read_timeout = telegram_client.get_timeouts()
+        return cls(env_utils.get_int_env("TELEGRAM_POOL_SIZE", 10), connect_timeout, read_timeout)
+
+    async def post_json(self, url: str, body: object) -> Response:
+        check_url(url)
+        parts = urllib.parse.urlsplit(url)
+        proxy = proxy_for(parts)
+        origin = (
+            parts.scheme,
+            parts.hostname,
+            parts.port or (443 if parts.scheme == "https" else 80),
+            proxy.geturl() if proxy is not None else "",
+        )
+        host = parts.netloc.rpartition("@")[2]
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        data = json.dumps(body).encode("utf-8")
+        headers = [f"Host: {host}", "Content-Type: application/json", f"Content-Length: {len(data)}"]
+        if proxy is not None and parts.scheme == "http":
+            # Plain HTTP goes to the proxy in absolute form; HTTPS is tunnelled.
+            target = f"http://{host}{target}"
+            if _basic_auth(proxy):
+                headers.append(f"Proxy-Authorization: {_basic_auth(proxy)}")
+        if _basic_auth(parts):
+            headers.append(f"Authorization: {_basic_auth(parts)}")
+        head = _head([f"POST {target} HTTP/1.1"] + headers)
+        slots = self._slots.get(origin)
+        if slots is None:
+            slots = self._slots[origin] = asyncio.Semaphore(self.pool_size)
+        async with slots:
+            fresh = False
+            while True:
+                connection, reused = await self._checkout(origin, fresh)
+                sent = False
+                try:
+                    connection.writer.write(head + data)
+                    await connection.writer.drain()
+                    sent = True
+                    response, keep_alive = await asyncio.wait_for(_read_response(connection.reader), self.read_timeout)
+                except (_Closed, ConnectionResetError, BrokenPipeError) as exc:
+                    connection.close()
+                    # Once part of the response arrived the server has seen the
+                    # request; sending it again could deliver it twice.
+                    if reused and (not sent or isinstance(exc, _Closed)):
+                        fresh = True
+                        continue
+                    raise ConnectionError(f"{origin[1]}:{origin[2]} closed the connection") from exc
+                except asyncio.TimeoutError:
+                    connection.close()
+                    raise TimeoutError(
+                        f"No response from {origin[1]}:{origin[2]} within {self.read_timeout}s"
+                    ) from None
+                except BaseException:
+                    connection.close()
+                    raise
+                if keep_alive:
+                    self._idle.setdefault(origin, []).append(connection)
+                else:
+                    connection.close()
+                return response
+
+    async def _checkout(self, origin: Origin, fresh: bool = False) -> Tuple[_Connection, bool]:
+        idle = self._idle.get(origin)
+        while idle and not fresh:
+            connection = idle.pop()
+            if connection.usable:
+                return connection, True
+            connection.close()
+        _, host, port, _ = origin
+        try:
+            reader, writer = await asyncio.wait_for(self._open(origin), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Connecting to {host}:{port} timed out after {self.connect_timeout}s") from None
+        self.connections += 1
+        return _Connection(reader, writer), False
+
+    def _tls(self) -> ssl.SSLContext:
+        if self._ssl is None:
+            cafile = os.getenv("REQUESTS_CA_BUNDLE") or os.getenv("CURL_CA_BUNDLE") or None
+            self._ssl = ssl.create_default_context(cafile=cafile)
+        return self._ssl
+
+    async def _open(self, origin: Origin) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        scheme, host, port, proxy_url = origin
+        tls = self._tls() if scheme == "https" else None
+        if not proxy_url:
+            return await asyncio.open_connection(host, port, ssl=tls)
+        proxy = urllib.parse.urlsplit(proxy_url)
+        reader, writer = await asyncio.open_connection(proxy.hostname, proxy.port or 80)
+        if tls is None:
+            return reader, writer
+        try:
+            lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+            if _basic_auth(proxy):
+                lines.append(f"Proxy-Authorization: {_basic_auth(proxy)}")
+            writer.write(_head(lines))
+            await writer.drain()
+            _, code, reason, _ = await _read_head(reader, await reader.readline())
+            if code != 200:
+                raise ConnectionError(f"Proxy {proxy.hostname} refused the tunnel to {host}:{port}: {code} {reason}")
+            await writer.start_tls(tls, server_hostname=host)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def close(self) -> None:
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+        self._idle.clear()
+
+
+async def _read_head(reader: asyncio.StreamReader, status_line: bytes) -> Tuple[str, int, str, email.message.Message]:
+    """Parse ``status_line`` and the headers after it, skipping interim 1xx answers to the final one."""
+    while True:
+        version, _, rest = status_line.decode("latin-1").rstrip("\r\n").partition(" ")
+        code, _, reason = rest.partition(" ")
+        if not version.startswith("HTTP/") or not code.isdigit():
+            raise ConnectionError(f"Malformed HTTP status line: {status_line[:100]!r}")
+        headers = email.message.Message()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+        if not 100 <= int(code) < 200:
+            return version, int(code), reason, headers
+        if int(code) == 101:
+            raise ConnectionError("Unexpected 101 Switching Protocols")
+        # 100 Continue or 103 Early Hints: the final answer follows.
+        status_line = await reader.readline()
+
+
+async def _read_response(reader: asyncio.StreamReader) -> Tuple[Response, bool]:
+    try:
+        first = await reader.read(1)
+    except ConnectionResetError as exc:
+        raise _Closed() from exc
+    if not first:
+        raise _Closed()
+    version, code, reason, headers = await _read_head(reader, first + await reader.readline())
+    keep_alive = version == "HTTP/1.1" and (headers.get("Connection") or "").lower() != "close"
+    if "chunked" in (headers.get("Transfer-Encoding") or "").lower():
+        content = await _read_chunked(reader)
+    elif headers.get("Content-Length") is not None:
+        content = await reader.readexactly(int(headers["Content-Length"]))
+    else:
+        content = await reader.read()
+        keep_alive = False
+    return Response(code, reason, headers, content), keep_alive
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            # Skip the trailers up to the blank line.
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+def check_endpoints(bot_token: str, router: routing.Router | None) -> None:
+    """Raise ``ValueError`` for a Bot API or webhook URL the client cannot reach, before any message is tried."""
+    for url in [telegram_client.api_url(bot_token)] + (router.webhooks() if router is not None else []):
+        check_url(url)
+
+
+async def send_message(client: AsyncHTTPClient, bot_token: str, payload: Dict[str, str]) -> Response:
+    """``telegram_client.send_message`` for the event loop: same rate limits, metrics and errors."""
+    chat_id = str(payload.get("chat_id", ""))
+    limiter = rate_limit.get_limiter()
+    if limiter.enabled:
+        wait = limiter.reserve(chat_id)
+        if wait > 0:
+            await asyncio.sleep(wait)
+    started = time.perf_counter()
+    try:
+        response = await client.post_json(telegram_client.api_url(bot_token), payload)
+    except Exception:
+        # Timeouts, resets, truncated or malformed answers: no response either way.
+        metrics.TELEGRAM_REQUESTS.inc(code="error")
+        raise
+    finally:
+        metrics.TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started)
+    metrics.TELEGRAM_REQUESTS.inc(code=response.status_code)
+    if response.status_code >= 400:
+        error = telegram_client.api_error(response)
+        if error.retry_after:
+            limiter.penalize(chat_id, error.retry_after)
+        raise error
+    return response
+
+
+async def send_webhook(client: AsyncHTTPClient, url: str, payload: Dict[str, object]) -> None:
+    response = await client.post_json(url, routing.webhook_body(payload))
+    if response.status_code >= 400:
+        raise requests.HTTPError(f"{response.status_code} {response.reason} for url: {url}", response=response)
+
+
+def claim_lanes(
+    queue: sms_queue.QueueBackend,
+    chat_id: str,
+    busy: Set[str],
+    capacity: int,
+    router: routing.Router | None = None,
+    lane_limit: int = MAX_LANE_ITEMS,
+) -> Tuple[Dict[str, List[sms_queue.QueueItem]], bool]:
+    """The claiming half of ``queue_worker.process_queue_once``, run off the event loop.
+
+    Returns up to ``capacity`` new lanes of at most ``lane_limit`` items each,
+    skipping the destinations in ``busy``, and whether items were fanned out.
+    """
+    now = time.time()
+    blocked = set(busy)
+    lanes: Dict[str, List[sms_queue.QueueItem]] = {}
+    fanned = False
+    for item in queue.pending():
+        destination = lane_key(item.meta or {}, chat_id)
+        if destination in blocked:
+            continue
+        if (item.meta is not None and not is_due(item.meta, now)) or (
+            destination not in lanes and len(lanes) >= capacity
+        ):
+            blocked.add(destination)
+            continue
+        claimed = claim_item(queue, item)
+        if claimed is None or skip_duplicate(queue, claimed, chat_id):
+            continue
+        if router is not None and fan_out_item(queue, claimed, router):
+            fanned = True
+            continue
+        destination = lane_key(claimed.payload, chat_id)
+        lane = lanes.setdefault(destination, [])
+        lane.append(claimed)
+        if len(lane) >= lane_limit:
+            blocked.add(destination)
+    return lanes, fanned
+
+
+def release_items(queue: sms_queue.QueueBackend, items: List[sms_queue.QueueItem]) -> None:
+    for item in items:
+        queue.release(item)
+
+
+class AsyncWorker:
+    """Deliver the queue with one task per destination lane, at most ``max_inflight`` at a time."""
+
+    def __init__(
+        self,
+        queue: sms_queue.QueueBackend,
+        client: AsyncHTTPClient,
+        bot_token: str,
+        chat_id: str,
+        max_attempts: int,
+        retry_delay: float,
+        max_delay: float = DEFAULT_MAX_RETRY_DELAY,
+        coalesce_window: float = 0.0,
+        router: routing.Router | None = None,
+        max_inflight: int = DEFAULT_INFLIGHT,
+        io_threads: int = DEFAULT_IO_THREADS,
+    ) -> None:
+        self.queue = queue
+        self.client = client
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.coalesce_window = coalesce_window
+        self.router = router
+        self.max_inflight = max(1, max_inflight)
+        self.on_done: Callable[[], None] | None = None
+        self._io = ThreadPoolExecutor(max_workers=max(1, io_threads), thread_name_prefix="queue-io")
+        self._lanes: Dict[str, asyncio.Task] = {}
+
+    @property
+    def inflight(self) -> int:
+        return len(self._lanes)
+
+    async def io(self, fn: Callable[..., object], *args: object) -> object:
+        return await asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    async def process_once(self) -> bool:
+        """Claim the due lanes and start a task for each; returns whether any delivery was started."""
+        capacity = self.max_inflight - len(self._lanes)
+        if capacity <= 0:
+            return False
+        lanes, fanned = await self.io(claim_lanes, self.queue, self.chat_id, set(self._lanes), capacity, self.router)
+        for destination, lane in lanes.items():
+            task = asyncio.create_task(self.deliver_lane(lane), name=f"lane {destination}")
+            self._lanes[destination] = task
+            task.add_done_callback(lambda done, key=destination: self._finished(key, done))
+        return fanned or bool(lanes)
+
+    def _finished(self, destination: str, task: asyncio.Task) -> None:
+        if self._lanes.get(destination) is task:
+            del self._lanes[destination]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Delivery lane for chat %s crashed: %s", destination, task.exception())
+        if self.on_done is not None:
+            self.on_done()
+
+    async def deliver_lane(self, lane: List[sms_queue.QueueItem]) -> None:
+        # Webhooks receive one request per SMS; only Telegram messages are merged.
+        groups = coalesce(lane, 0.0 if lane[0].payload.get("webhook") else self.coalesce_window)
+        for index, group in enumerate(groups):
+            if await self.deliver_group(group):
+                continue
+            # The failed head is rescheduled; hand the rest back untouched so the
+            # chat is not delivered out of order.
+            rest = [item for later in groups[index + 1 :] for item in later]
+            if rest:
+                await self.io(release_items, self.queue, rest)
+            return
+
+    async def deliver_group(self, group: List[sms_queue.QueueItem]) -> bool:
+        head = group[0]
+        try:
+            if len(group) > 1:
+                token = resolve_bot_token(head.payload, self.bot_token, self.router)
+                messages = [(str(item.payload["number"]), str(item.payload["text"])) for item in group]
+                chat = resolve_chat_id(head.payload, self.chat_id)
+                await send_message(self.client, token, build_telegram_batch_payload(chat, messages))
+            else:
+                await self.send_item(head.payload)
+        except Exception as exc:
+            if len(group) > 1 and permanent_failure(exc):
+                # As in ``queue_worker.deliver_group``: retry the items one by one.
+                for index, item in enumerate(group):
+                    if not await self.deliver_group([item]):
+                        await self.io(release_items, self.queue, group[index + 1 :])
+                        return False
+                return True
+            rescheduled = await self.io(
+                schedule_retry, self.queue, head, exc, self.max_attempts, self.retry_delay, self.max_delay
+            )
+            if len(group) > 1:
+                await self.io(release_items, self.queue, group[1:])
+                return False
+            return not rescheduled
+        await self.io(settle_delivered, self.queue, group, self.chat_id)
+        if len(group) > 1:
+            metrics.COALESCED.inc(len(group) - 1)
+        return True
+
+    async def send_item(self, payload: Dict[str, object]) -> None:
+        webhook = payload.get("webhook")
+        if isinstance(webhook, str) and webhook:
+            await send_webhook(self.client, webhook, payload)
+            return
+        token = resolve_bot_token(payload, self.bot_token, self.router)
+        chat = resolve_chat_id(payload, self.chat_id)
+        if rendered_length(payload) <= TELEGRAM_TEXT_LIMIT:
+            await send_message(
+                self.client, token, build_telegram_payload(chat, str(payload["number"]), str(payload["text"]))
+            )
+            return
+        # As in ``queue_worker.send_parts``, a retry continues after the parts already sent.
+        messages = build_telegram_payloads(chat, str(payload["number"]), str(payload["text"]))
+        for index in range(int(payload.get("parts_sent") or 0), len(messages)):
+            await send_message(self.client, token, messages[index])
+            payload["parts_sent"] = index + 1
+
+    async def drain(self, timeout: float | None = None) -> None:
+        """Wait for the lanes in flight; after ``timeout`` seconds the rest are cancelled."""
+        running = list(self._lanes.values())
+        if not running:
+            return
+        _, pending = await asyncio.wait(running, timeout=timeout)
+        if pending:
+            logging.warning(
+                "%s delivery lanes did not finish within %.0fs; their messages stay in processing/ until recovered",
+                len(pending),
+                timeout,
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def serve(
+        self,
+        watcher: queue_watch.InotifyWatcher | queue_watch.PollingWatcher,
+        housekeeping: Callable[[], None],
+        poll_interval: float,
+        indexed: bool = False,
+        drain_timeout: float = DEFAULT_DRAIN_TIMEOUT,
+    ) -> None:
+        """Run passes until SIGTERM or SIGINT, then drain the lanes in flight."""
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+
+        def stop() -> None:
+            stopping.set()
+            watcher.wake()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop)
+        self.on_done = watcher.wake
+        try:
+            while not stopping.is_set():
+                await self.io(housekeeping)
+                if await self.process_once():
+                    if indexed:
+                        # Take in arrivals between busy passes without blocking.
+                        self.queue.arrived(await self.io(watcher.wait, 0))
+                    continue
+                await self.io(self.queue.flush)
+                # Not on the I/O pool: the wait would hold one of its threads.
+                self.queue.arrived(await loop.run_in_executor(None, watcher.wait, poll_interval))
+            logging.info("Stopping: draining %s delivery lanes in flight", len(self._lanes))
+            await self.drain(drain_timeout)
+        finally:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
+            await self.io(self.queue.flush)
+            await self.close()
+
+    def shutdown(self) -> None:
+        self._io.shutdown(wait=True)
+
+    async def close(self) -> None:
+        await self.client.close()
+        self.shutdown()
+
+
+async def process_queue_once(
+    queue: sms_queue.QueueBackend,
+    client: AsyncHTTPClient,
+    bot_token: str,
+    chat_id: str,
+    max_attempts: int,
+    retry_delay: float,
+    max_delay: float = DEFAULT_MAX_RETRY_DELAY,
+    coalesce_window: float = 0.0,
+    router: routing.Router | None = None,
+) -> bool:
+    """One pass of ``queue_worker.process_queue_once`` on the event loop, waiting for every lane it starts."""
+    worker = AsyncWorker(
+        queue, client, bot_token, chat_id, max_attempts, retry_delay, max_delay, coalesce_window, router
+    )
+    try:
+        started = await worker.process_once()
+        await worker.drain()
+    finally:
+        worker.shutdown()
+    return started
+
+
+def run(
+    queue: sms_queue.QueueBackend,
+    watcher: queue_watch.InotifyWatcher | queue_watch.PollingWatcher,
+    housekeeping: Callable[[], None],
+    bot_token: str,
+    chat_id: str,
+    max_attempts: int,
+    retry_delay: float,
+    max_delay: float,
+    coalesce_window: float,
+    router: routing.Router | None,
+    poll_interval: float,
+    indexed: bool = False,
+) -> None:
+    """Deliver ``queue`` on an event loop until SIGTERM; settings not passed in are read from the environment."""
+    try:
+        check_endpoints(bot_token, router)
+    except ValueError as exc:
+        logging.error("Cannot deliver in async mode: %s", exc)
+        raise SystemExit(1)
+    worker = AsyncWorker(
+        queue,
+        AsyncHTTPClient.from_env(),
+        bot_token,
+        chat_id,
+        max_attempts,
+        retry_delay,
+        max_delay,
+        coalesce_window,
+        router,
+        env_utils.get_int_env(INFLIGHT_ENV, DEFAULT_INFLIGHT),
+        env_utils.get_int_env(IO_THREADS_ENV, DEFAULT_IO_THREADS),
+    )
+    drain_timeout = env_utils.get_float_env(DRAIN_TIMEOUT_ENV, DEFAULT_DRAIN_TIMEOUT)
+    logging.info("Async delivery: up to %s lanes in flight", worker.max_inflight)
+    asyncio.run(worker.serve(watcher, housekeeping, poll_interval, indexed, drain_timeout))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Measure delivery ledger lookups as the ledger grows.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_dedup --sizes 10000 100000 1000000
+
+For each size the ledger is filled up to that many delivered ids, then
+random known and unknown ids are looked up. Lookups are rowid searches, so
+their cost should stay flat while the database grows.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import dedup
+
+BATCH = 10000
+
+
+def fill(ledger: dedup.DeliveryLedger, start: int, stop: int) -> None:
+    payload = {"number": "+10000000000", "text": "benchmark message", "received_at": time.time()}
+    for first in range(start, stop, BATCH):
+        ledger.record((f"id-{index}", payload, "chat") for index in range(first, min(first + BATCH, stop)))
+
+
+def lookup_us(ledger: dedup.DeliveryLedger, size: int, lookups: int) -> float:
+    ids = [f"id-{int.from_bytes(os.urandom(4), 'big') % size}" for _ in range(lookups // 2)]
+    ids += [f"missing-{index}" for index in range(lookups - len(ids))]
+    started = time.perf_counter()
+    for message_id in ids:
+        ledger.delivered(message_id)
+    return (time.perf_counter() - started) / len(ids) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--dir", help="filesystem for the ledger (default: the system temp dir)")
+    args = parser.parse_args()
+
+    sizes: List[int] = sorted(args.sizes)
+    with tempfile.TemporaryDirectory(prefix="smsgw-dedup-", dir=args.dir) as tmp:
+        path = Path(tmp) / dedup.DB_FILENAME
+        ledger = dedup.DeliveryLedger(path)
+        filled = 0
+        for size in sizes:
+            started = time.perf_counter()
+            fill(ledger, filled, size)
+            fill_seconds = time.perf_counter() - started
+            filled = size
+            size_mb = sum(f.stat().st_size for f in Path(tmp).iterdir()) / 1e6
+            print(
+                f"{size:>9} ids  lookup {lookup_us(ledger, size, args.lookups):6.2f} us"
+                f"  fill {fill_seconds:6.2f} s  on disk {size_mb:7.1f} MB"
+            )
+        ledger.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
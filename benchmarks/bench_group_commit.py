@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Measure worker state-transition throughput with and without group commit.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_group_commit --messages 500 --window-ms 50 --dir /dev/shm --dir .
+
+Each directory is benchmarked twice: once with per-rename directory fsyncs
+and once with QUEUE_GROUP_COMMIT_MS batching. Use one tmpfs path and one
+path on the real storage (SD card, eMMC) to see the difference.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+from unittest import mock
+
+import sms_queue
+
+
+def run_transitions(base_dir: Path, messages: int, window: float) -> tuple[float, int]:
+    queue = sms_queue.FileQueue(base_dir, group_commit_window=window)
+    for index in range(messages):
+        queue.enqueue("+10000000000", f"benchmark message {index}")
+    real_fsync = os.fsync
+    calls = 0
+
+    def counting_fsync(fd: int) -> None:
+        nonlocal calls
+        calls += 1
+        real_fsync(fd)
+
+    with mock.patch("os.fsync", counting_fsync):
+        started = time.perf_counter()
+        for item in list(queue.pending()):
+            claimed = queue.claim(item)
+            queue.ack(claimed)
+        queue.flush()
+        elapsed = time.perf_counter() - started
+    return messages / elapsed, calls
+
+
+def default_dirs() -> List[str]:
+    dirs = ["/dev/shm"] if os.path.isdir("/dev/shm") else []
+    return dirs + ["."]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--window-ms", type=float, default=50.0)
+    parser.add_argument("--dir", action="append", dest="dirs", help="filesystem to test (repeatable)")
+    args = parser.parse_args()
+
+    for directory in args.dirs or default_dirs():
+        for window in (0.0, args.window_ms / 1000.0):
+            with tempfile.TemporaryDirectory(prefix="smsgw-bench-", dir=directory) as tmp:
+                rate, fsyncs = run_transitions(Path(tmp), args.messages, window)
+            label = "per-rename fsync" if window == 0 else f"group commit {args.window_ms:g}ms"
+            print(f"{directory:<16} {label:<22} {rate:10.1f} msg/s  {fsyncs:6d} fsyncs")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
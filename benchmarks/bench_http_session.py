@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Compare per-message latency of one-shot requests.post with the pooled Telegram client.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_http_session --messages 200 [--tls] [--latency 0.005]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import requests
+
+import rate_limit
+import telegram_client
+from benchmarks.stub_telegram import StubTelegramServer
+from on_receive import build_telegram_payload
+
+
+def make_self_signed_cert(directory: Path) -> tuple[str, str]:
+    certfile = directory / "cert.pem"
+    keyfile = directory / "key.pem"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-days",
+            "1",
+            "-keyout",
+            str(keyfile),
+            "-out",
+            str(certfile),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return str(certfile), str(keyfile)
+
+
+def measure(send: Callable[[], None], messages: int) -> List[float]:
+    samples = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        send()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def report(label: str, samples: List[float]) -> None:
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(
+        f"{label:<28} mean={statistics.mean(samples) * 1000:7.2f}ms "
+        f"p50={statistics.median(samples) * 1000:7.2f}ms p99={p99 * 1000:7.2f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub server latency in seconds")
+    parser.add_argument("--tls", action="store_true", help="serve HTTPS with a throwaway self-signed cert")
+    args = parser.parse_args()
+
+    certfile = keyfile = None
+    tmpdir = None
+    if args.tls:
+        if shutil.which("openssl") is None:
+            raise SystemExit("--tls needs the openssl binary")
+        tmpdir = tempfile.TemporaryDirectory()
+        certfile, keyfile = make_self_signed_cert(Path(tmpdir.name))
+        os.environ["REQUESTS_CA_BUNDLE"] = certfile
+
+    payload = build_telegram_payload("chat", "+10000000000", "benchmark message")
+    # Measure the transport, not the per-chat rate limit.
+    rate_limit.set_limiter(rate_limit.RateLimiter(global_rate=0, chat_rate=0))
+    try:
+        with StubTelegramServer(latency=args.latency, certfile=certfile, keyfile=keyfile) as server:
+            os.environ[telegram_client.API_URL_ENV] = server.url
+            url = telegram_client.api_url("token")
+
+            def one_shot() -> None:
+                requests.post(url, json=payload, timeout=10).raise_for_status()
+
+            before_connections = server.connections
+            before = measure(one_shot, args.messages)
+            one_shot_connections = server.connections - before_connections
+
+            telegram_client.reset_session()
+            before_connections = server.connections
+            after = measure(lambda: telegram_client.send_message("token", payload), args.messages)
+            pooled_connections = server.connections - before_connections
+            telegram_client.reset_session()
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    print(f"{args.messages} messages against {server.url}")
+    report(f"requests.post ({one_shot_connections} conns)", before)
+    report(f"pooled session ({pooled_connections} conns)", after)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
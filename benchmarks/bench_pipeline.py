@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Load-test the queue pipeline end to end against the stub Bot API.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --messages 500 --rate 100 --source on_receive
+    python -m benchmarks.bench_pipeline --messages 500 --source enqueue --error-rate 0.05 --flood-rate 0.02
+
+Synthetic SMS are enqueued at ``--rate`` per second (0: as fast as possible)
+either through ``on_receive.main`` (the RunOnReceive hook, minus interpreter
+startup; see ``bench_receive_startup`` for that) or ``sms_queue.enqueue_message``.
+A real ``queue_worker.py`` process delivers them to the stub, which can add
+latency and inject 500 and 429 answers. Reported are throughput, p50/p99
+enqueue-to-Telegram latency, fsyncs on both sides and the worker's CPU time
+and peak RSS.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+from unittest import mock
+
+import on_receive
+import sms_queue
+from benchmarks.stub_telegram import StubTelegramServer
+
+ROOT = Path(__file__).resolve().parent.parent
+NUMBER = "+10000000000"
+# Sharded workers split the queue by chat, so the enqueue source spreads the load over several.
+CHATS = 16
+_INDEX = re.compile(r"bench (\d+)")
+_WARMUP = re.compile(r"warmup (\d+)")
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def worker_env(queue_dir: Path, backend: str, url: str, concurrency: int, coalesce_window: float) -> Dict[str, str]:
+    env = {key: value for key, value in os.environ.items() if not key.startswith(("SMSGW_", "QUEUE_"))}
+    env.update(
+        {
+            "TELEGRAM_BOT_TOKEN": "bench",
+            "TELEGRAM_CHAT_ID": "bench",
+            "TELEGRAM_API_URL": url,
+            "SMSGW_QUEUE_DIR": str(queue_dir),
+            "SMSGW_QUEUE_BACKEND": backend,
+            "QUEUE_CONCURRENCY": str(concurrency),
+            "QUEUE_COALESCE_WINDOW": str(coalesce_window),
+            "QUEUE_POLL_INTERVAL": "0.5",
+            "QUEUE_RETRY_DELAY": "0.05",
+            "QUEUE_RETRY_MAX_DELAY": "1",
+            "QUEUE_MAX_RETRIES": "1000",
+            # Measure the pipeline, not the Bot API limits it deliberately stays under.
+            "TELEGRAM_RATE_GLOBAL": "0",
+            "TELEGRAM_RATE_CHAT": "0",
+            "METRICS_PORT": "0",
+            # Injected faults would log a warning per retry.
+            "LOGLEVEL": "ERROR",
+            "PYTHONPATH": str(ROOT),
+        }
+    )
+    return env
+
+
+def produce(source: str, index: int, queue_dir: Path, text: str | None = None) -> None:
+    text = text or f"bench {index}"
+    if source == "enqueue":
+        sms_queue.enqueue_message(NUMBER, text, queue_dir, f"bench-{index % CHATS}")
+        return
+    with mock.patch.dict(os.environ, {"SMS_MESSAGES": "1", "SMS_1_NUMBER": NUMBER, "SMS_1_TEXT": text}):
+        on_receive.main(["--enqueue"])
+
+
+def delivered_at(server: StubTelegramServer) -> Dict[int, float]:
+    """First successful delivery time per message index; a coalesced request counts for all its SMS."""
+    seen: Dict[int, float] = {}
+    for request in server.requests:
+        for match in _INDEX.finditer(str(request["payload"].get("text", ""))):
+            seen.setdefault(int(match.group(1)), float(request["received_at"]))
+    return seen
+
+
+def run_benchmark(
+    messages: int = 200,
+    rate: float = 0.0,
+    source: str = "enqueue",
+    backend: str = "file",
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    flood_rate: float = 0.0,
+    retry_after: int = 1,
+    concurrency: int = 1,
+    coalesce_window: float = 0.0,
+    timeout: float = 120.0,
+    workdir: Path | None = None,
+    workers: int = 1,
+) -> Dict[str, float]:
+    """Run one load test and return its measurements."""
+    if source == "enqueue" and backend != "file":
+        raise ValueError("sms_queue.enqueue_message only writes the file spool")
+    with tempfile.TemporaryDirectory(prefix="smsgw-load-", dir=workdir) as tmp:
+        queue_dir = Path(tmp) / "queue"
+        stats_files = [Path(tmp) / f"worker-{index}.json" for index in range(workers)]
+        with StubTelegramServer(
+            latency=latency, error_rate=error_rate, flood_rate=flood_rate, retry_after=retry_after, seed=1
+        ) as server:
+            env = worker_env(queue_dir, backend, server.url, concurrency, coalesce_window)
+            command = [sys.executable, "-m", "benchmarks.bench_pipeline"]
+            processes = []
+            for index, stats_file in enumerate(stats_files):
+                shard = ["--shard", f"{index}/{workers}"] if workers > 1 else []
+                processes.append(
+                    subprocess.Popen(command + ["--worker-stats", str(stats_file)] + shard, cwd=ROOT, env=env)
+                )
+            try:
+                with mock.patch.dict(
+                    os.environ,
+                    {"SMSGW_QUEUE_DIR": str(queue_dir), "SMSGW_QUEUE_BACKEND": backend, "LOGLEVEL": "WARNING"},
+                ):
+                    result = drive(server, processes, source, queue_dir, messages, rate, timeout)
+            finally:
+                for process in processes:
+                    process.send_signal(signal.SIGTERM)
+                for process in processes:
+                    process.wait(timeout=10)
+            stats = [json.loads(stats_file.read_text()) for stats_file in stats_files]
+            result["workers"] = workers
+            result["worker_fsyncs"] = sum(stat["worker_fsyncs"] for stat in stats)
+            result["worker_cpu_seconds"] = sum(stat["worker_cpu_seconds"] for stat in stats)
+            result["worker_max_rss_mb"] = max(stat["worker_max_rss_mb"] for stat in stats)
+            result.update({"http_errors": server.errors, "http_429": server.floods, "connections": server.connections})
+    result["worker_fsyncs_per_message"] = result["worker_fsyncs"] / messages
+    result["producer_fsyncs_per_message"] = result["producer_fsyncs"] / messages
+    return result
+
+
+def drive(
+    server: StubTelegramServer,
+    workers: List[subprocess.Popen],
+    source: str,
+    queue_dir: Path,
+    messages: int,
+    rate: float,
+    timeout: float,
+) -> Dict[str, float]:
+    # Warm-up messages prove the workers are up, so their startup is not
+    # counted as latency. With shards and the enqueue source, a few per worker
+    # reach all of them with high probability; hook messages all go to the
+    # default chat and so to one worker.
+    warmups = 4 * len(workers) if len(workers) > 1 else 1
+    for index in range(warmups):
+        produce(source, index, queue_dir, f"warmup {index}")
+    deadline = time.monotonic() + timeout
+    while len(warmed_up(server)) < warmups:
+        if any(worker.poll() is not None for worker in workers) or time.monotonic() > deadline:
+            raise RuntimeError("the queue workers did not deliver the warm-up messages")
+        time.sleep(0.01)
+    warmup_requests = len(server.requests)
+
+    real_fsync = os.fsync
+    fsyncs = 0
+
+    def counting_fsync(fd: int) -> None:
+        nonlocal fsyncs
+        fsyncs += 1
+        real_fsync(fd)
+
+    enqueued: Dict[int, float] = {}
+    started = time.time()
+    with mock.patch("os.fsync", counting_fsync):
+        for index in range(messages):
+            if rate > 0:
+                delay = started + index / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            enqueued[index] = time.time()
+            produce(source, index, queue_dir)
+    produced = time.time()
+
+    seen = delivered_at(server)
+    while len(seen) < messages and time.monotonic() < deadline:
+        time.sleep(0.02)
+        seen = delivered_at(server)
+    latencies = [seen[index] - enqueued[index] for index in enqueued if index in seen]
+    finished = max((seen[index] for index in enqueued if index in seen), default=produced)
+    return {
+        "messages": messages,
+        "delivered": len(latencies),
+        "enqueue_rate": messages / max(produced - started, 1e-9),
+        "throughput": len(latencies) / max(finished - started, 1e-9),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p99": percentile(latencies, 0.99),
+        "producer_fsyncs": fsyncs,
+        "telegram_requests": len(server.requests) - warmup_requests,
+    }
+
+
+def warmed_up(server: StubTelegramServer) -> set:
+    return {
+        match.group(1) for request in server.requests for match in _WARMUP.finditer(str(request["payload"]["text"]))
+    }
+
+
+def run_worker_with_stats(stats_file: Path, argv: List[str]) -> None:
+    """Run queue_worker in this process and write its fsyncs, CPU time and peak RSS on SIGTERM."""
+    real_fsync = os.fsync
+    fsyncs = 0
+
+    def counting_fsync(fd: int) -> None:
+        nonlocal fsyncs
+        fsyncs += 1
+        real_fsync(fd)
+
+    def stop(signum: int, frame: object) -> None:
+        raise SystemExit(0)
+
+    os.fsync = counting_fsync
+    signal.signal(signal.SIGTERM, stop)
+    import queue_worker
+
+    try:
+        queue_worker.run_worker(argv)
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        stats = {
+            "worker_fsyncs": fsyncs,
+            "worker_cpu_seconds": usage.ru_utime + usage.ru_stime,
+            # ru_maxrss is in KiB on Linux.
+            "worker_max_rss_mb": usage.ru_maxrss / 1024,
+        }
+        stats_file.write_text(json.dumps(stats))
+
+
+def report(result: Dict[str, float]) -> None:
+    print(
+        f"{result['delivered']}/{result['messages']} delivered in {result['telegram_requests']} Bot API requests"
+        f" by {result['workers']} worker(s)"
+    )
+    print(
+        f"  enqueue rate     {result['enqueue_rate']:10.1f} msg/s  ({result['producer_fsyncs_per_message']:.2f} fsyncs/msg)"
+    )
+    print(f"  throughput       {result['throughput']:10.1f} msg/s")
+    print(f"  latency p50/p99  {result['latency_p50'] * 1000:8.1f} / {result['latency_p99'] * 1000:.1f} ms")
+    print(f"  worker fsyncs    {result['worker_fsyncs']:10d}  ({result['worker_fsyncs_per_message']:.2f}/msg)")
+    print(f"  worker CPU       {result['worker_cpu_seconds']:10.2f} s   peak RSS {result['worker_max_rss_mb']:.1f} MiB")
+    print(
+        f"  injected faults  {result['http_errors']} x 500, {result['http_429']} x 429; {result['connections']} connections"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=0.0, help="SMS enqueued per second (0: as fast as possible)")
+    parser.add_argument("--source", choices=("on_receive", "enqueue"), default="on_receive")
+    parser.add_argument("--backend", choices=sms_queue.QUEUE_BACKENDS, default="file")
+    parser.add_argument("--latency", type=float, default=0.0, help="stub server latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of sends answered with 500")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429s")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, one shard of the chats each")
+    parser.add_argument("--concurrency", type=int, default=1, help="QUEUE_CONCURRENCY of each worker")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="QUEUE_COALESCE_WINDOW of the worker")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--dir", type=Path, help="filesystem for the queue (default: the system temp dir)")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--worker-stats", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--shard", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_stats:
+        run_worker_with_stats(args.worker_stats, ["--shard", args.shard] if args.shard else [])
+        return
+    if args.source == "enqueue" and args.backend != "file":
+        parser.error("--source enqueue writes the file spool; use --source on_receive with --backend sqlite")
+    result = run_benchmark(
+        messages=args.messages,
+        rate=args.rate,
+        source=args.source,
+        backend=args.backend,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        retry_after=args.retry_after,
+        concurrency=args.concurrency,
+        coalesce_window=args.coalesce_window,
+        timeout=args.timeout,
+        workdir=args.dir,
+        workers=args.workers,
+    )
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        report(result)
+    if result["delivered"] < result["messages"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Measure the per-SMS cost of the RunOnReceive hook in queue mode.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_receive_startup --runs 20
+
+Each variant starts a fresh interpreter the way gammu-smsd does and enqueues
+one message into a temporary spool. Reported are the median wall time, the
+peak RSS of the child and whether ``requests`` got imported.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+HOOK = str(ROOT / "on_receive.py")
+# Prints whether requests was imported once the hook has run.
+PROBE = (
+    "import runpy, sys; sys.argv = [{hook!r}, '--enqueue']; runpy.run_path({hook!r}, run_name='__main__'); "
+    "sys.stderr.write('requests=%s\\n' % ('requests' in sys.modules))"
+)
+
+VARIANTS: Dict[str, List[str]] = {
+    "interpreter only (python3 -c pass)": [sys.executable, "-c", "pass"],
+    "python3 on_receive.py --enqueue": [sys.executable, HOOK, "--enqueue"],
+    "python3 -S on_receive.py --enqueue": [sys.executable, "-S", HOOK, "--enqueue"],
+}
+
+
+def run_once(command: List[str], env: Dict[str, str]) -> Tuple[float, int]:
+    started = time.perf_counter()
+    pid = subprocess.Popen(command, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).pid
+    _, status, usage = os.wait4(pid, 0)
+    elapsed = time.perf_counter() - started
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{' '.join(command)} exited with {status}")
+    return elapsed, usage.ru_maxrss
+
+
+def imports_requests(env: Dict[str, str]) -> bool:
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(hook=HOOK)], env=env, cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return "requests=True" in result.stderr
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="smsgw-bench-") as tmp:
+        env = dict(os.environ, SMSGW_QUEUE_DIR=tmp, SMS_MESSAGES="1", SMS_1_NUMBER="+100", SMS_1_TEXT="benchmark")
+        env.pop("PYTHONPATH", None)
+        print(f"requests imported by --enqueue: {imports_requests(env)}")
+        for label, command in VARIANTS.items():
+            run_once(command, env)  # warm the page cache
+            samples = [run_once(command, env) for _ in range(args.runs)]
+            wall = statistics.median(sample[0] for sample in samples) * 1000
+            rss = max(sample[1] for sample in samples) / 1024
+            print(f"{label:<38} {wall:8.1f} ms  {rss:6.1f} MiB peak RSS")
+        queued = len(list(Path(tmp, "pending").glob("*.json")))
+    print(f"messages enqueued: {queued}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Compare a scheduling pass over the pending spool for JSON files and compact records.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_records --messages 2000 --text-length 1000
+
+The spool is filled with messages that are all waiting for a retry, so a
+pass only has to read each item's ``next_attempt_at`` and destination, as
+``queue_worker.process_queue_once`` does. JSON files are parsed whole;
+records only have their header read. The ``+index`` rows keep the pending
+items in memory, as a worker with inotify does: after the first pass the
+directory is neither listed nor read.
+"""
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import sms_queue
+
+
+def fill(queue: sms_queue.FileQueue, messages: int, text_length: int) -> None:
+    payloads = []
+    for index in range(messages):
+        payload = sms_queue.build_payload("+10000000000", "x" * text_length, chat_id=f"chat-{index % 10}")
+        payload.update(attempts=1, next_attempt_at=time.time() + 3600)
+        payloads.append(payload)
+    queue.enqueue_payloads(payloads)
+
+
+def scan_seconds(queue: sms_queue.FileQueue, passes: int) -> float:
+    started = time.perf_counter()
+    for _ in range(passes):
+        for item in queue.pending():
+            meta = item.meta or {}
+            meta.get("next_attempt_at"), meta.get("chat_id")
+    return (time.perf_counter() - started) / passes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--text-length", type=int, default=1000)
+    parser.add_argument("--passes", type=int, default=5)
+    parser.add_argument("--dir", help="filesystem for the spool (default: the system temp dir)")
+    args = parser.parse_args()
+
+    for record_format in sms_queue.RECORD_FORMATS:
+        for indexed in (False, True):
+            with tempfile.TemporaryDirectory(prefix="smsgw-records-", dir=args.dir) as tmp:
+                queue = sms_queue.FileQueue(Path(tmp), record_format=record_format)
+                fill(queue, args.messages, args.text_length)
+                if indexed:
+                    queue.index_pending(sms_queue.DEFAULT_INDEX_RESCAN)
+                    scan_seconds(queue, 1)
+                seconds = scan_seconds(queue, args.passes)
+            label = record_format + ("+index" if indexed else "")
+            print(
+                f"{label:<13} {args.messages} pending  pass {seconds * 1000:8.1f} ms"
+                f"  {seconds / args.messages * 1e6:6.1f} us/item"
+            )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
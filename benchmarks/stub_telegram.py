@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Local stub of the Telegram Bot API for tests and benchmarks.
+
+Besides a fixed ``latency`` it can inject faults: ``error_rate`` of the
+requests answer 500 and ``flood_rate`` answer 429 with ``retry_after``.
+Only successful sends are recorded in ``requests``.
+"""
+from __future__ import annotations
+
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+_SEND_MESSAGE_PATH = re.compile(r"^/bot[^/]+/sendMessage$")
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY every
+    # keep-alive response stalls on the client's delayed ACK.
+    disable_nagle_algorithm = True
+    server: "_StubHTTPServer"
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002 - BaseHTTPRequestHandler signature
+        return
+
+    def do_POST(self) -> None:  # noqa: N802 - http.server naming
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        if not _SEND_MESSAGE_PATH.match(self.path):
+            self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        try:
+            payload = json.loads(raw or b"{}")
+        except ValueError:
+            payload = {}
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        with self.server.lock:
+            roll = self.server.rng.random()
+            failed = roll < self.server.error_rate
+            flooded = not failed and roll < self.server.error_rate + self.server.flood_rate
+            self.server.errors += failed
+            self.server.floods += flooded
+        if failed:
+            self._reply(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+            return
+        if flooded:
+            retry_after = self.server.retry_after
+            self._reply(
+                429,
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                },
+            )
+            return
+        with self.server.lock:
+            self.server.requests.append({"path": self.path, "payload": payload, "received_at": time.time()})
+            message_id = len(self.server.requests)
+        self._reply(200, {"ok": True, "result": {"message_id": message_id}})
+
+    def _reply(self, status: int, body: Dict[str, object]) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops the SYNs of a burst of new connections,
+    # which then wait a second for the retransmit.
+    request_queue_size = 128
+
+    def __init__(
+        self, address, latency: float, error_rate: float, flood_rate: float, retry_after: int, seed: int | None
+    ) -> None:
+        super().__init__(address, _StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.errors = 0
+        self.floods = 0
+        self.requests: List[Dict[str, object]] = []
+
+
+class StubTelegramServer:
+    """Serve a minimal sendMessage endpoint on localhost in a background thread."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        certfile: str | None = None,
+        keyfile: str | None = None,
+        error_rate: float = 0.0,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+        seed: int | None = None,
+    ) -> None:
+        self._server = _StubHTTPServer((host, port), latency, error_rate, flood_rate, retry_after, seed)
+        self.scheme = "http"
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+            self.scheme = "https"
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-telegram", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"{self.scheme}://{host}:{port}"
+
+    @property
+    def connections(self) -> int:
+        with self._server.lock:
+            return self._server.connections
+
+    @property
+    def errors(self) -> int:
+        with self._server.lock:
+            return self._server.errors
+
+    @property
+    def floods(self) -> int:
+        with self._server.lock:
+            return self._server.floods
+
+    @property
+    def requests(self) -> List[Dict[str, object]]:
+        with self._server.lock:
+            return list(self._server.requests)
+
+    def start(self) -> "StubTelegramServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(timeout=5)
+
+    def __enter__(self) -> "StubTelegramServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Delivery ledger: skip messages that were already delivered and duplicate SMS.
+
+The ledger is a small SQLite (WAL) database next to the queue with two
+tables keyed by a 64-bit BLAKE2b digest stored as the ``INTEGER PRIMARY
+KEY``. A lookup is therefore a rowid search in a few-page-deep B-tree,
+whatever the number of entries, and each entry takes a few dozen bytes:
+
+* ``delivered`` holds the ids of delivered queue items. The worker checks
+  it after claiming an item and records ids right after a successful send,
+  before the item is moved to ``sent/``. A crash in between no longer
+  causes a second send. Entries expire after ``DEDUP_TTL_DAYS``.
+* ``content`` holds a digest of sender, text and destination per
+  delivered SMS. An SMS that matches one received less than
+  ``DEDUP_WINDOW`` seconds earlier is treated as a duplicate, for example
+  a PDU that the modem delivers again after a reset.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Tuple
+
+import env_utils
+import sms_queue
+
+DB_PATH_ENV = "SMSGW_DEDUP_DB"
+DB_FILENAME = "dedup.sqlite3"
+DEFAULT_TTL_DAYS = 7.0
+DEFAULT_WINDOW = 120.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS delivered (key INTEGER PRIMARY KEY, delivered_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS delivered_at ON delivered (delivered_at);
+CREATE TABLE IF NOT EXISTS content (key INTEGER PRIMARY KEY, received_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS content_received_at ON content (received_at);
+"""
+
+
+def digest(*parts: str) -> int:
+    data = "\0".join(parts).encode("utf-8", "surrogatepass")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big", signed=True)
+
+
+def content_key(payload: Dict[str, object], destination: str) -> int:
+    return digest(str(payload.get("number", "")), str(payload.get("text", "")), destination)
+
+
+def resolve_db_path(env=os.getenv) -> Path:
+    configured = env(DB_PATH_ENV)
+    if configured:
+        return Path(configured)
+    return sms_queue.resolve_queue_dir(env) / DB_FILENAME
+
+
+class DeliveryLedger:
+    """Persistent index of delivered message ids and recent SMS contents; safe to share between threads."""
+
+    def __init__(
+        self,
+        path: Path,
+        ttl: float = DEFAULT_TTL_DAYS * 86400,
+        window: float = DEFAULT_WINDOW,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL still survives a crash of the process; a power cut may lose
+        # the last records, which at worst means one duplicate send.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def delivered(self, message_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM delivered WHERE key = ?", (digest(message_id),)).fetchone()
+        return row is not None
+
+    def duplicate_of(self, payload: Dict[str, object], destination: str) -> float | None:
+        """``received_at`` of a delivered SMS with the same content within the window, if there is one."""
+        received_at = payload.get("received_at")
+        if self.window <= 0 or not isinstance(received_at, (int, float)):
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT received_at FROM content WHERE key = ?", (content_key(payload, destination),)
+            ).fetchone()
+        if row is None or abs(received_at - row[0]) > self.window:
+            return None
+        return row[0]
+
+    def record(self, deliveries: Iterable[Tuple[str, Dict[str, object], str]]) -> None:
+        """Record ``(id, payload, destination)`` deliveries in one transaction."""
+        now = self._clock()
+        ids = []
+        contents = []
+        for message_id, payload, destination in deliveries:
+            ids.append((digest(message_id), now))
+            received_at = payload.get("received_at")
+            if self.window > 0 and isinstance(received_at, (int, float)):
+                contents.append((content_key(payload, destination), float(received_at)))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO delivered (key, delivered_at) VALUES (?, ?)", ids)
+                self._conn.executemany("INSERT OR REPLACE INTO content (key, received_at) VALUES (?, ?)", contents)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def evict(self) -> int:
+        """Drop expired ids and contents older than the window; returns how many rows went."""
+        now = self._clock()
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM delivered WHERE delivered_at < ?", (now - self.ttl,)).rowcount
+            removed += self._conn.execute(
+                "DELETE FROM content WHERE received_at < ?", (now - max(self.window, 0.0),)
+            ).rowcount
+        return removed
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def open_ledger(env=os.getenv) -> DeliveryLedger | None:
+    """Ledger configured by the environment, or ``None`` when ``DEDUP_TTL_DAYS`` is 0."""
+    ttl_days = env_utils.get_float_env("DEDUP_TTL_DAYS", DEFAULT_TTL_DAYS)
+    if ttl_days <= 0:
+        return None
+    window = env_utils.get_float_env("DEDUP_WINDOW", DEFAULT_WINDOW)
+    return DeliveryLedger(resolve_db_path(env), ttl=ttl_days * 86400, window=window)
+
+
+_ledger: DeliveryLedger | None = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> DeliveryLedger | None:
+    with _ledger_lock:
+        return _ledger
+
+
+def set_ledger(ledger: DeliveryLedger | None) -> None:
+    """Install the process-wide ledger the delivery paths consult; ``None`` turns deduplication off."""
+    global _ledger
+    with _ledger_lock:
+        _ledger = ledger
@@ -5,13 +5,21 @@ set -euo pipefail
 # Utility helpers
 # ---------------------------------------------------------------------------
 log() {
-    echo "[entrypoint] $*"
+    echo "[entrypoint] ${LOG_TAG}$*"
 }
 
 LAST_RESET_TS=0
 RESET_BACKOFF=0
 DELIVERY_MODE_RESOLVED="direct"
-QUEUE_WORKER_PID=""
+QUEUE_WORKER_PIDS=()
+INBOX_INGESTER_PID=""
+OUTBOX_PID=""
+HEALTH_PID=""
+LOG_TAG=""
+SMSD_CONFIG="/tmp/gammu-smsdrc"
+DETECTED_MODEMS=()
+declare -A MODEM_INSTANCE_PIDS=()
+declare -A MODEM_INSTANCE_PORTS=()
 
 normalize_usb_id() {
     local value="$1"
@@ -37,8 +45,8 @@ get_gammu_debuglevel() {
 resolve_delivery_mode() {
     local mode="${DELIVERY_MODE:-direct}"
     mode="${mode,,}"
-    if [[ "$mode" == "queue" ]]; then
-        DELIVERY_MODE_RESOLVED="queue"
+    if [[ "$mode" == "queue" || "$mode" == "inbox" || "$mode" == "hybrid" ]]; then
+        DELIVERY_MODE_RESOLVED="$mode"
         return 0
     fi
     if [[ -n "$mode" && "$mode" != "direct" ]]; then
@@ -49,53 +57,123 @@ resolve_delivery_mode() {
 }
 
 get_run_on_receive_cmd() {
+    if [[ "$DELIVERY_MODE_RESOLVED" == "inbox" ]]; then
+        # inbox_ingest.py picks messages up from the inbox spool instead.
+        return 0
+    fi
     if [[ "$DELIVERY_MODE_RESOLVED" == "queue" ]]; then
-        printf '%s' "python3 /app/on_receive.py --enqueue"
+        # -S skips site-packages setup; the enqueue path only needs the stdlib.
+        printf '%s' "python3 -S /app/on_receive.py --enqueue"
+    elif [[ "$DELIVERY_MODE_RESOLVED" == "hybrid" ]]; then
+        # One direct send with a short timeout; failures go to the queue worker.
+        printf '%s' "python3 /app/on_receive.py --hybrid"
     else
         printf '%s' "python3 /app/on_receive.py"
     fi
 }
 
 start_queue_worker_if_enabled() {
-    if [[ "$DELIVERY_MODE_RESOLVED" != "queue" ]]; then
+    if [[ "$DELIVERY_MODE_RESOLVED" == "direct" ]]; then
+        return 0
+    fi
+    local workers="${QUEUE_WORKERS:-1}"
+    local index
+    if (( workers <= 1 )); then
+        if [[ -n "${QUEUE_WORKER_PIDS[0]:-}" ]] && kill -0 "${QUEUE_WORKER_PIDS[0]}" 2>/dev/null; then
+            return 0
+        fi
+        log "Starting queue worker"
+        python3 /app/queue_worker.py &
+        QUEUE_WORKER_PIDS[0]=$!
+        return 0
+    fi
+    for ((index = 0; index < workers; index++)); do
+        if [[ -n "${QUEUE_WORKER_PIDS[$index]:-}" ]] && kill -0 "${QUEUE_WORKER_PIDS[$index]}" 2>/dev/null; then
+            continue
+        fi
+        log "Starting queue worker ${index}/${workers}"
+        python3 /app/queue_worker.py --shard "${index}/${workers}" &
+        QUEUE_WORKER_PIDS[$index]=$!
+    done
+}
+
+start_inbox_ingester_if_enabled() {
+    if [[ "$DELIVERY_MODE_RESOLVED" != "inbox" ]]; then
         return 0
     fi
-    if [[ -n "${QUEUE_WORKER_PID:-}" ]] && kill -0 "$QUEUE_WORKER_PID" 2>/dev/null; then
+    if [[ -n "${INBOX_INGESTER_PID:-}" ]] && kill -0 "$INBOX_INGESTER_PID" 2>/dev/null; then
         return 0
     fi
-    log "Starting queue worker"
-    python3 /app/queue_worker.py &
-    QUEUE_WORKER_PID=$!
+    log "Starting inbox ingester"
+    python3 /app/inbox_ingest.py &
+    INBOX_INGESTER_PID=$!
+}
+
+start_outbox_if_enabled() {
+    if [[ "${OUTBOX_API_PORT:-0}" == "0" ]]; then
+        return 0
+    fi
+    if [[ -n "${OUTBOX_PID:-}" ]] && kill -0 "$OUTBOX_PID" 2>/dev/null; then
+        return 0
+    fi
+    log "Starting outbox API on port ${OUTBOX_API_PORT}"
+    python3 /app/outbox.py &
+    OUTBOX_PID=$!
+}
+
+start_health_if_enabled() {
+    if [[ "${HEALTH_PORT:-0}" == "0" ]]; then
+        return 0
+    fi
+    if [[ -n "${HEALTH_PID:-}" ]] && kill -0 "$HEALTH_PID" 2>/dev/null; then
+        return 0
+    fi
+    log "Starting health server on port ${HEALTH_PORT}"
+    python3 /app/health.py &
+    HEALTH_PID=$!
 }
 
 generate_config() {
     local dev="$1"
+    local config="${2:-/tmp/gammu-smsdrc}"
+    local inbox_path="${3:-${GAMMU_SPOOL_PATH}/inbox}"
     local debuglevel=""
     local run_on_receive=""
     debuglevel=$(get_gammu_debuglevel 2>/dev/null || true)
     run_on_receive=$(get_run_on_receive_cmd)
-    cat > /tmp/gammu-smsdrc <<EOF
+    cat > "$config" <<EOF
 [gammu]
 device = ${dev}
 connection = at
 
 [smsd]
 service      = files
-inboxpath    = ${GAMMU_SPOOL_PATH}/inbox/
+inboxpath    = ${inbox_path}/
 outboxpath   = ${GAMMU_SPOOL_PATH}/outbox/
 sentpath     = ${GAMMU_SPOOL_PATH}/sent/
 errorpath    = ${GAMMU_SPOOL_PATH}/error/
-RunOnReceive = ${run_on_receive}
 logfile      = /dev/stdout
 DeleteAfterReceive = yes
 MultipartTimeout   = 600
 CheckSecurity = 0
+OutboxFormat = unicode
+TransmitFormat = auto
 EOF
+    if [[ -n "$run_on_receive" ]]; then
+        echo "RunOnReceive = $run_on_receive" >> "$config"
+    fi
     if [[ -n "$debuglevel" ]]; then
-        echo "DebugLevel = $debuglevel" >> /tmp/gammu-smsdrc
+        echo "DebugLevel = $debuglevel" >> "$config"
+    fi
+    if [[ -n "${GAMMU_INBOX_FORMAT:-}" ]]; then
+        # "detail" keeps each segment's UDH for inbox_ingest.py to stitch by reference.
+        echo "InboxFormat = ${GAMMU_INBOX_FORMAT}" >> "$config"
+    fi
+    if [[ "$config" == /tmp/gammu-smsdrc ]]; then
+        ln -sf /tmp/gammu-smsdrc /tmp/gammurc
     fi
-    ln -sf /tmp/gammu-smsdrc /tmp/gammurc
-    export GAMMU_CONFIG=/tmp/gammu-smsdrc
+    SMSD_CONFIG="$config"
+    export GAMMU_CONFIG="$config"
 }
 
 # ---------------------------------------------------------------------------
@@ -109,7 +187,8 @@ get_vid_pid_from_env() {
     return 1
 }
 
-get_vid_pid_from_sysfs() {
+# Prints the sysfs directory of the USB device that owns a tty port.
+find_usb_sysfs_parent() {
     local modem_port="$1"
     local resolved
     local tty
@@ -135,11 +214,7 @@ get_vid_pid_from_sysfs() {
     for candidate in "$sys_dev" "$sys_dev/.." "$sys_dev/../.." "$sys_dev/../../.." "$sys_dev/../../../.."; do
         path=$(readlink -f "$candidate" 2>/dev/null || true)
         if [[ -f "$path/idVendor" && -f "$path/idProduct" ]]; then
-            local vid
-            local pid
-            vid=$(cat "$path/idVendor")
-            pid=$(cat "$path/idProduct")
-            printf '%s %s\n' "$(normalize_usb_id "$vid")" "$(normalize_usb_id "$pid")"
+            printf '%s\n' "$path"
             return 0
         fi
     done
@@ -147,6 +222,12 @@ get_vid_pid_from_sysfs() {
     return 1
 }
 
+get_vid_pid_from_sysfs() {
+    local path
+    path=$(find_usb_sysfs_parent "$1") || return 1
+    printf '%s %s\n' "$(normalize_usb_id "$(cat "$path/idVendor")")" "$(normalize_usb_id "$(cat "$path/idProduct")")"
+}
+
 get_vid_pid_from_lsusb() {
     if ! command -v lsusb >/dev/null 2>&1; then
         return 1
@@ -204,6 +285,13 @@ find_usb_sysfs_device() {
     return 1
 }
 
+# One "<unix time> <vid>:<pid> [<modem id>]" line per reset; queue_worker.py
+# exposes the count and last timestamp as metrics.
+record_watchdog_reset() {
+    local state_file="${WATCHDOG_STATE_FILE:-/tmp/smsgw-watchdog-resets}"
+    printf '%s %s%s\n' "$(date +%s)" "$1" "${SMSGW_MODEM_ID:+ $SMSGW_MODEM_ID}" >> "$state_file" 2>/dev/null || true
+}
+
 reset_usb_modem() {
     local min_interval="${RESET_MIN_INTERVAL:-60}"
     local backoff_step="${RESET_BACKOFF_STEP:-30}"
@@ -242,14 +330,27 @@ reset_usb_modem() {
 
     log "[watchdog] Resetting USB modem ${vid}:${pid}"
 
+    # With several identical modems VID:PID is ambiguous; the port's own sysfs
+    # parent pins down the device to reset.
+    local usb_path=""
+    local bus_args=()
+    if [[ -n "${MODEM_PORT:-}" ]] && usb_path=$(find_usb_sysfs_parent "$MODEM_PORT"); then
+        if [[ -f "$usb_path/busnum" && -f "$usb_path/devnum" ]]; then
+            bus_args=(-b "$(cat "$usb_path/busnum")" -g "$(cat "$usb_path/devnum")")
+        fi
+    fi
+
     if command -v usb_modeswitch >/dev/null 2>&1; then
-        usb_modeswitch -R -v "$vid" -p "$pid" >/dev/null 2>&1 || true
+        usb_modeswitch -R -v "$vid" -p "$pid" "${bus_args[@]}" >/dev/null 2>&1 || true
     else
         log "[watchdog] usb_modeswitch not found; skipping USB mode switch"
     fi
 
     local usb_device
-    if usb_device=$(find_usb_sysfs_device "$vid" "$pid"); then
+    if [[ -n "$usb_path" ]]; then
+        usb_device=$(basename "$usb_path")
+    fi
+    if [[ -n "${usb_device:-}" ]] || usb_device=$(find_usb_sysfs_device "$vid" "$pid"); then
         if [[ -w /sys/bus/usb/drivers/usb/unbind && -w /sys/bus/usb/drivers/usb/bind ]]; then
             log "[watchdog] Rebinding USB device $usb_device"
             echo "$usb_device" > /sys/bus/usb/drivers/usb/unbind || true
@@ -263,6 +364,7 @@ reset_usb_modem() {
     fi
 
     LAST_RESET_TS=$SECONDS
+    record_watchdog_reset "${vid}:${pid}"
     if (( settle_seconds > 0 )); then
         log "[watchdog] Waiting ${settle_seconds}s after USB reset"
         sleep "$settle_seconds"
@@ -274,51 +376,148 @@ reset_usb_modem() {
 # ---------------------------------------------------------------------------
 # Modem detection helpers
 # ---------------------------------------------------------------------------
-detect_modem() {
+# Prints candidate ports, one per line: MODEM_PORT and MODEM_PORTS first, then
+# everything under /dev/serial and /dev/ttyUSB*. Aliases of one tty (a by-id
+# link and its ttyUSB node) are listed once, so no port is probed twice.
+list_modem_candidates() {
     local candidates=()
-    local timeout_seconds="${MODEM_DETECT_TIMEOUT:-10}"
+    local pinned=()
     local nullglob_state
+    local p
 
     if [[ -n "${MODEM_PORT:-}" ]]; then
         candidates+=("${MODEM_PORT}")
     fi
+    if [[ -n "${MODEM_PORTS:-}" ]]; then
+        read -r -a pinned <<< "$MODEM_PORTS"
+        candidates+=("${pinned[@]}")
+    fi
 
-    nullglob_state=$(shopt -p nullglob)
+    # `shopt -p` exits 1 when the option is off.
+    nullglob_state=$(shopt -p nullglob || true)
     shopt -s nullglob
-    local p
     for p in /dev/serial/by-id/* /dev/serial/by-path/* /dev/ttyUSB*; do
         candidates+=("${p}")
     done
     eval "$nullglob_state"
 
     local -A seen=()
+    local resolved
     for p in "${candidates[@]}"; do
         [[ -e "$p" ]] || continue
-        if [[ -n "${seen[$p]:-}" ]]; then
+        resolved=$(readlink -f "$p" 2>/dev/null || printf '%s' "$p")
+        if [[ -n "${seen[$resolved]:-}" ]]; then
             continue
         fi
-        seen[$p]=1
-        log "[detect_modem] probing $p"
-        if timeout "$timeout_seconds" gammu -c <(printf '[gammu]\ndevice=%s\nconnection=at\n' "$p") identify \
-            >/dev/null 2>&1; then
-            log "[detect_modem] found working modem on $p"
-            MODEM_PORT="$p"
-            export MODEM_PORT
-            generate_config "$p"
-            return 0
-        fi
+        seen[$resolved]=1
+        printf '%s\n' "$p"
     done
+}
+
+# Prints "<port> <imei>" if the port answers `gammu identify` ("-" when the
+# modem does not report an IMEI).
+probe_modem() {
+    local port="$1"
+    local timeout_seconds="${MODEM_DETECT_TIMEOUT:-10}"
+    local output
+    local imei
+    if ! output=$(timeout "$timeout_seconds" gammu -c <(printf '[gammu]\ndevice=%s\nconnection=at\n' "$port") identify \
+        2>/dev/null); then
+        return 1
+    fi
+    imei=$(printf '%s\n' "$output" | awk -F': *' '/^IMEI/ { print $2; exit }')
+    printf '%s %s\n' "$port" "${imei:--}"
+}
+
+# Probes all given ports in parallel, so detection takes one probe timeout
+# rather than one per port. Prints probe_modem's line for every working port,
+# in the order given.
+probe_modem_candidates() {
+    local results_dir
+    local pids=()
+    local i
+    results_dir=$(mktemp -d)
+    for i in $(seq 1 $#); do
+        log "[detect_modem] probing ${!i}" >&2
+        probe_modem "${!i}" > "$results_dir/$i" 2>/dev/null &
+        pids+=($!)
+    done
+    if (( ${#pids[@]} > 0 )); then
+        wait "${pids[@]}" || true
+    fi
+    for i in $(seq 1 $#); do
+        cat "$results_dir/$i"
+    done
+    rm -rf "$results_dir"
+}
+
+detect_modem() {
+    local candidates=()
+    local port
+    mapfile -t candidates < <(list_modem_candidates)
+
+    while read -r port _; do
+        log "[detect_modem] found working modem on $port"
+        MODEM_PORT="$port"
+        export MODEM_PORT
+        generate_config "$port"
+        return 0
+    done < <(probe_modem_candidates "${candidates[@]}")
     return 1
 }
 
+# Identifies a modem by IMEI, falling back to its port name.
+modem_id_for() {
+    local imei="$1"
+    local port="$2"
+    if [[ -n "$imei" && "$imei" != "-" ]]; then
+        printf '%s' "$imei"
+    else
+        printf '%s' "${port##*/}" | tr -c 'A-Za-z0-9._-' '_'
+    fi
+}
+
+# Fills DETECTED_MODEMS with one "<modem id> <port>" entry per working modem
+# that has no instance in MODEM_INSTANCE_PIDS yet. Ports of running instances
+# are not probed, and a modem exposing several AT ports is kept once (by IMEI).
+detect_modems() {
+    local candidates=()
+    local port
+    local imei
+    local modem_id
+    local -A busy=()
+    local -A seen=()
+    DETECTED_MODEMS=()
+
+    for port in "${MODEM_INSTANCE_PORTS[@]}"; do
+        busy[$(readlink -f "$port" 2>/dev/null || printf '%s' "$port")]=1
+    done
+    while read -r port; do
+        if [[ -z "${busy[$(readlink -f "$port" 2>/dev/null || printf '%s' "$port")]:-}" ]]; then
+            candidates+=("$port")
+        fi
+    done < <(list_modem_candidates)
+
+    while read -r port imei; do
+        modem_id=$(modem_id_for "$imei" "$port")
+        if [[ -n "${seen[$modem_id]:-}" || -n "${MODEM_INSTANCE_PIDS[$modem_id]:-}" ]]; then
+            continue
+        fi
+        seen[$modem_id]=1
+        log "[detect_modem] found modem $modem_id on $port"
+        DETECTED_MODEMS+=("$modem_id $port")
+    done < <(probe_modem_candidates "${candidates[@]}")
+    (( ${#DETECTED_MODEMS[@]} > 0 ))
+}
+
 # ---------------------------------------------------------------------------
 # Watchdog helpers
 # ---------------------------------------------------------------------------
 start_gammu_smsd() {
     if command -v stdbuf >/dev/null 2>&1; then
-        exec stdbuf -oL -eL gammu-smsd -c /tmp/gammu-smsdrc
+        exec stdbuf -oL -eL gammu-smsd -c "$SMSD_CONFIG"
     else
-        exec gammu-smsd -c /tmp/gammu-smsdrc
+        exec gammu-smsd -c "$SMSD_CONFIG"
     fi
 }
 
@@ -366,6 +565,102 @@ run_smsd_with_watchdog() {
     return "$smsd_rc"
 }
 
+# Runs gammu-smsd under the watchdog once and resets the USB modem if the
+# watchdog gave up on it.
+supervise_smsd_once() {
+    log "Starting sms-daemon"
+    local smsd_rc=0
+    if run_smsd_with_watchdog; then
+        smsd_rc=0
+    else
+        smsd_rc=$?
+    fi
+
+    if (( smsd_rc == 2 )); then
+        log "[watchdog] Modem timeout threshold reached; resetting USB"
+        reset_usb_modem || true
+    else
+        log "[watchdog] gammu-smsd exited (rc=${smsd_rc}); restarting detection"
+    fi
+}
+
+# Switch this shell to the per-modem spool. The queue, its SQLite database
+# and the delivery ledger are pinned to the root spool first, so that the
+# receive hooks of every modem feed the one queue the worker drains.
+enter_modem_spool() {
+    local modem_id="$1"
+    SMSGW_QUEUE_DIR="${SMSGW_QUEUE_DIR:-${GAMMU_SPOOL_PATH}/sms-queue}"
+    SMSGW_QUEUE_DB="${SMSGW_QUEUE_DB:-${SMSGW_QUEUE_DIR}/queue.sqlite3}"
+    SMSGW_DEDUP_DB="${SMSGW_DEDUP_DB:-${SMSGW_QUEUE_DIR}/dedup.sqlite3}"
+    export SMSGW_QUEUE_DIR SMSGW_QUEUE_DB SMSGW_DEDUP_DB
+    GAMMU_SPOOL_PATH="${GAMMU_SPOOL_PATH}/modems/${modem_id}"
+    mkdir -p "$GAMMU_SPOOL_PATH"/{inbox,outbox,sent,error}
+}
+
+# One supervised gammu-smsd per modem, with its own config, spool and
+# watchdog state. Queue mode tags every SMS with the modem id through
+# SMSGW_MODEM_ID; inbox mode keeps the shared inbox so that the single
+# ingester sees every modem's messages.
+run_modem_instance() {
+    local modem_id="$1"
+    local port="$2"
+    local inbox_path=""
+    MODEM_PORT="$port"
+    SMSGW_MODEM_ID="$modem_id"
+    export MODEM_PORT SMSGW_MODEM_ID
+    LOG_TAG="[modem ${modem_id}] "
+    if [[ "$DELIVERY_MODE_RESOLVED" == "inbox" ]]; then
+        inbox_path="${GAMMU_SPOOL_PATH}/inbox"
+    fi
+    enter_modem_spool "$modem_id"
+
+    while true; do
+        local start=$SECONDS
+        until probe_modem "$port" >/dev/null; do
+            if (( SECONDS - start > 60 )); then
+                reset_usb_modem || true
+                start=$SECONDS
+            fi
+            log "Modem not responding on $port; retrying in 5s"
+            sleep 5
+        done
+        generate_config "$port" "/tmp/gammu-smsdrc-${modem_id}" "${inbox_path:-${GAMMU_SPOOL_PATH}/inbox}"
+        supervise_smsd_once
+    done
+}
+
+run_multi_modem() {
+    local rescan="${MODEM_RESCAN_INTERVAL:-60}"
+    local modem_id
+    local port
+    local entry
+
+    while true; do
+        for modem_id in "${!MODEM_INSTANCE_PIDS[@]}"; do
+            if ! kill -0 "${MODEM_INSTANCE_PIDS[$modem_id]}" 2>/dev/null; then
+                log "Instance for modem $modem_id exited"
+                unset "MODEM_INSTANCE_PIDS[$modem_id]" "MODEM_INSTANCE_PORTS[$modem_id]"
+            fi
+        done
+
+        if detect_modems; then
+            for entry in "${DETECTED_MODEMS[@]}"; do
+                read -r modem_id port <<< "$entry"
+                log "Starting instance for modem $modem_id on $port"
+                run_modem_instance "$modem_id" "$port" &
+                MODEM_INSTANCE_PIDS[$modem_id]=$!
+                MODEM_INSTANCE_PORTS[$modem_id]=$port
+            done
+        fi
+        if (( ${#MODEM_INSTANCE_PIDS[@]} == 0 )); then
+            log "No modem detected yet; retrying in 5s"
+            sleep 5
+            continue
+        fi
+        sleep "$rescan"
+    done
+}
+
 main() {
     # Skip modem work when executing tests directly
     if [[ "${1:-}" == "pytest" ]] || {
@@ -390,7 +685,23 @@ main() {
     GAMMU_SPOOL_PATH="${GAMMU_SPOOL_PATH:-/var/spool/gammu}"
     mkdir -p "$GAMMU_SPOOL_PATH"/{inbox,outbox,sent,error,archive}
     resolve_delivery_mode
+
+    # supervisor.py runs gammu-smsd and the delivery processes itself;
+    # SMSGW_SUPERVISOR=bash keeps the shell loop below.
+    if [[ "${SMSGW_SUPERVISOR:-python}" == "python" && "${MULTI_MODEM:-false}" != "true" && -f /app/supervisor.py ]]; then
+        log "Handing over to the Python supervisor"
+        exec python3 /app/supervisor.py
+    fi
+
     start_queue_worker_if_enabled
+    start_inbox_ingester_if_enabled
+    start_outbox_if_enabled
+    start_health_if_enabled
+
+    if [[ "${MULTI_MODEM:-false}" == "true" ]]; then
+        log "Multi-modem mode: one sms-daemon per detected modem"
+        run_multi_modem
+    fi
 
     while true; do
         log "Starting modem detection"
@@ -404,20 +715,7 @@ main() {
             sleep 5
         done
 
-        log "Starting sms-daemon"
-        local smsd_rc=0
-        if run_smsd_with_watchdog; then
-            smsd_rc=0
-        else
-            smsd_rc=$?
-        fi
-
-        if (( smsd_rc == 2 )); then
-            log "[watchdog] Modem timeout threshold reached; resetting USB"
-            reset_usb_modem || true
-        else
-            log "[watchdog] gammu-smsd exited (rc=${smsd_rc}); restarting detection"
-        fi
+        supervise_smsd_once
     done
 }
 
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""Health and readiness endpoint, answered from cached state.
+
+A sampler thread refreshes three things, each on its own schedule:
+
+* the status of each modem that gammu-smsd keeps in shared memory (IMEI,
+  signal and battery, which smsd samples every ``StatusFrequency`` seconds),
+  read with ``gammu-smsd-monitor`` so the modem port is never opened a
+  second time;
+* the queue backlog and the age of its oldest pending message;
+* the heartbeat files that each queue worker rewrites while its loop runs.
+
+``/healthz`` (liveness) and ``/readyz`` (readiness) only format that cached
+state, so a probe costs no I/O and cannot slow delivery down.
+``health.py --check`` queries the local endpoint for container healthchecks.
+"""
+from __future__ import annotations
+
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import env_utils
+import logging_utils
+import queue_retention
+import sms_queue
+import supervisor
+
+HEALTH_PORT_ENV = "HEALTH_PORT"
+HEALTH_ADDR_ENV = "HEALTH_ADDR"
+HEALTH_STATE_ENV = "HEALTH_STATE_DIR"
+DEFAULT_STATE_DIR = "/tmp/smsgw-health"
+DEFAULT_SMSD_CONFIG = "/tmp/gammu-smsdrc"
+# Multi-modem instances write /tmp/gammu-smsdrc-<modem id> instead.
+SMSD_CONFIG_GLOB = "/tmp/gammu-smsdrc*"
+DEFAULT_HEARTBEAT_INTERVAL = 10.0
+DEFAULT_WORKER_STALE = 120.0
+DEFAULT_SAMPLE_INTERVAL = 15.0
+DEFAULT_MODEM_INTERVAL = 60.0
+DEFAULT_MAX_QUEUE_AGE = 900.0
+MONITOR_TIMEOUT = 10.0
+QUEUE_MODES = ("queue", "inbox", "hybrid")
+
+# ``gammu-smsd-monitor`` prints one "<Key>: <value>" line per field.
+_MONITOR_FIELDS = {
+    "PhoneID": "phone_id",
+    "IMEI": "imei",
+    "Sent": "sent",
+    "Received": "received",
+    "Failed": "failed",
+    "BatterPercent": "battery_percent",
+    "NetworkSignal": "signal_percent",
+}
+_MONITOR_NUMBERS = ("sent", "received", "failed", "battery_percent", "signal_percent")
+
+
+def health_enabled(env=os.getenv) -> bool:
+    """The health server runs when ``HEALTH_PORT`` is set to a port; ``0`` or unset turns it off."""
+    try:
+        return int(env(HEALTH_PORT_ENV) or 0) > 0
+    except ValueError:
+        return False
+
+
+def resolve_state_dir(env=os.getenv) -> Path:
+    return Path(env(HEALTH_STATE_ENV) or DEFAULT_STATE_DIR)
+
+
+def heartbeat_name(shard: Tuple[int, int] | None) -> str:
+    return "worker.json" if shard is None else f"worker-{shard[0]}.json"
+
+
+def expected_workers(mode: str, workers: int) -> List[str]:
+    """Heartbeat files the workers of ``mode`` write; direct delivery runs no worker."""
+    if mode not in QUEUE_MODES:
+        return []
+    if workers <= 1:
+        return [heartbeat_name(None)]
+    return [heartbeat_name((index, workers)) for index in range(workers)]
+
+
+class Heartbeat:
+    """Liveness record of one queue worker, rewritten at most every ``interval`` seconds.
+
+    ``beat`` is called from the worker loop and, with the number of
+    messages, after each delivery. The file is replaced atomically but not
+    fsynced: it only has to outlive the process, not a power loss.
+    """
+
+    def __init__(
+        self, path: Path, interval: float = DEFAULT_HEARTBEAT_INTERVAL, clock: Callable[[], float] = time.time
+    ) -> None:
+        self.path = path
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started = clock()
+        self._written = float("-inf")
+        self._delivered = 0
+        self._last_delivery: float | None = None
+
+    def beat(self, delivered: int = 0) -> None:
+        now = self._clock()
+        with self._lock:
+            if delivered:
+                self._delivered += delivered
+                self._last_delivery = now
+            if now - self._written < self.interval:
+                return
+            self._written = now
+            state = {
+                "pid": os.getpid(),
+                "started": self._started,
+                "heartbeat": now,
+                "delivered": self._delivered,
+                "last_delivery": self._last_delivery,
+            }
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_name(self.path.name + ".tmp")
+                tmp_path.write_text(json.dumps(state), encoding="utf-8")
+                os.replace(tmp_path, self.path)
+            except OSError as exc:
+                logging.warning("Writing heartbeat %s failed: %s", self.path, exc)
+
+
+_heartbeat: Heartbeat | None = None
+
+
+def get_heartbeat() -> Heartbeat | None:
+    return _heartbeat
+
+
+def set_heartbeat(heartbeat: Heartbeat | None) -> None:
+    """Install the process-wide heartbeat that deliveries report to; ``None`` turns reporting off."""
+    global _heartbeat
+    _heartbeat = heartbeat
+
+
+def parse_monitor_output(text: str) -> Dict[str, object]:
+    status: Dict[str, object] = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(":")
+        field = _MONITOR_FIELDS.get(key.strip())
+        if not sep or field is None:
+            continue
+        value = value.strip()
+        if field in _MONITOR_NUMBERS:
+            try:
+                status[field] = int(value)
+            except ValueError:
+                continue
+        elif value:
+            status[field] = value
+    return status
+
+
+def sample_modem(config: str = DEFAULT_SMSD_CONFIG, timeout: float = MONITOR_TIMEOUT) -> Dict[str, object]:
+    """gammu-smsd's view of the modem; ``ok`` is ``None`` when it cannot be asked at all."""
+    try:
+        result = subprocess.run(
+            ["gammu-smsd-monitor", "-c", config, "-n", "1", "-d", "0"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=timeout,
+            check=False,
+        )
+    except FileNotFoundError:
+        return {"ok": None, "error": "gammu-smsd-monitor not installed"}
+    except subprocess.TimeoutExpired:
+        return {"ok": False, "error": f"gammu-smsd-monitor timed out after {timeout:.0f}s"}
+    status = parse_monitor_output(result.stdout)
+    if result.returncode != 0 or not status:
+        lines = result.stdout.strip().splitlines()
+        return {"ok": False, "error": lines[-1] if lines else f"gammu-smsd-monitor exited with {result.returncode}"}
+    # smsd reports -1 until it has a reading; zero means no network.
+    status["ok"] = status.get("signal_percent") != 0
+    return status
+
+
+def find_smsd_configs(pattern: str = SMSD_CONFIG_GLOB) -> List[str]:
+    """The gammu-smsd configs of the running instances: one, or one per modem with ``MULTI_MODEM=true``."""
+    return sorted(path for path in glob.glob(pattern) if Path(path).is_file())
+
+
+def modem_name(config: str) -> str:
+    """The modem id of a per-modem config, ``default`` for the single-modem one."""
+    name = Path(config).name
+    prefix = Path(DEFAULT_SMSD_CONFIG).name + "-"
+    return name[len(prefix) :] if name.startswith(prefix) else "default"
+
+
+def sample_queue(queue: sms_queue.QueueBackend) -> Dict[str, object]:
+    status: Dict[str, object] = dict(queue.counts())
+    oldest = queue.oldest("pending", 1)
+    timestamp = queue_retention.message_timestamp(oldest[0]) if oldest else None
+    status["oldest_pending_at"] = timestamp
+    return status
+
+
+def read_heartbeats(state_dir: Path, names: Sequence[str]) -> Dict[str, Dict[str, object] | None]:
+    beats: Dict[str, Dict[str, object] | None] = {}
+    for name in names:
+        try:
+            beat = json.loads((state_dir / name).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            beat = None
+        beats[name] = beat if isinstance(beat, dict) else None
+    return beats
+
+
+def _age(now: float, timestamp: object) -> float | None:
+    if not isinstance(timestamp, (int, float)):
+        return None
+    return round(max(0.0, now - timestamp), 1)
+
+
+class HealthMonitor:
+    """Cached health state plus the sampler that refreshes it.
+
+    ``refresh`` runs the samplers that are due and is the only method that
+    does I/O; ``report`` derives liveness and readiness from the cache.
+    A worker is alive while its heartbeat is younger than ``worker_stale``.
+    The service is ready when it is alive, every modem answers with a
+    signal and the oldest pending message is younger than ``max_queue_age``
+    (``0`` disables that check). The modems are those of ``smsd_configs``,
+    by default every gammu-smsd config found on each sampling round.
+    """
+
+    def __init__(
+        self,
+        queue: sms_queue.QueueBackend | None,
+        state_dir: Path,
+        workers: Sequence[str],
+        smsd_configs: Sequence[str] | None = None,
+        sample_interval: float = DEFAULT_SAMPLE_INTERVAL,
+        modem_interval: float = DEFAULT_MODEM_INTERVAL,
+        worker_stale: float = DEFAULT_WORKER_STALE,
+        max_queue_age: float = DEFAULT_MAX_QUEUE_AGE,
+        modem_sampler: Callable[[str], Dict[str, object]] = sample_modem,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.queue = queue
+        self.state_dir = state_dir
+        self.workers = list(workers)
+        self.smsd_configs = smsd_configs
+        self.sample_interval = max(0.1, sample_interval)
+        self.modem_interval = modem_interval
+        self.worker_stale = worker_stale
+        self.max_queue_age = max_queue_age
+        self._modem_sampler = modem_sampler
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._modems: Dict[str, Dict[str, object]] | None = None
+        self._queue: Dict[str, object] | None = None
+        self._heartbeats: Dict[str, Dict[str, object] | None] = {}
+        self._next_modem = 0.0
+        self._stop = threading.Event()
+
+    def refresh(self) -> None:
+        now = self._clock()
+        heartbeats = read_heartbeats(self.state_dir, self.workers)
+        queue_status = None
+        if self.queue is not None:
+            try:
+                queue_status = sample_queue(self.queue)
+            except Exception as exc:
+                queue_status = {"error": str(exc)}
+            queue_status["sampled_at"] = now
+        modems = None
+        if self.modem_interval > 0 and now >= self._next_modem:
+            configs = find_smsd_configs() if self.smsd_configs is None else self.smsd_configs
+            modems = {}
+            for config in configs:
+                modem = self._modem_sampler(config)
+                modem["sampled_at"] = now
+                modems[modem_name(config)] = modem
+            self._next_modem = now + self.modem_interval
+        with self._lock:
+            self._heartbeats = heartbeats
+            if queue_status is not None:
+                self._queue = queue_status
+            if modems is not None:
+                self._modems = modems
+
+    def report(self) -> Tuple[bool, bool, Dict[str, object]]:
+        """``(live, ready, body)`` from the cached samples."""
+        now = self._clock()
+        with self._lock:
+            heartbeats = dict(self._heartbeats)
+            queue_status = dict(self._queue) if self._queue is not None else None
+            modems = {name: dict(modem) for name, modem in self._modems.items()} if self._modems is not None else None
+
+        workers: Dict[str, object] = {}
+        deliveries = []
+        for name in self.workers:
+            beat = heartbeats.get(name)
+            if beat is None:
+                workers[name] = {"alive": False}
+                continue
+            age = _age(now, beat.get("heartbeat"))
+            workers[name] = {
+                "alive": age is not None and age < self.worker_stale,
+                "heartbeat_age": age,
+                "pid": beat.get("pid"),
+                "delivered": beat.get("delivered"),
+            }
+            if isinstance(beat.get("last_delivery"), (int, float)):
+                deliveries.append(beat["last_delivery"])
+        live = all(worker["alive"] for worker in workers.values())
+
+        ready = live
+        if modems is not None:
+            for modem in modems.values():
+                modem["age"] = _age(now, modem.pop("sampled_at", None))
+            # No config at all means no gammu-smsd has been set up yet.
+            ready = ready and bool(modems) and all(modem.get("ok") is not False for modem in modems.values())
+        if queue_status is not None:
+            queue_status["age"] = _age(now, queue_status.pop("sampled_at", None))
+            queue_status["oldest_pending_age"] = _age(now, queue_status.pop("oldest_pending_at", None))
+            lag = queue_status["oldest_pending_age"]
+            if "error" in queue_status or (self.max_queue_age > 0 and lag is not None and lag > self.max_queue_age):
+                ready = False
+
+        last_delivery = max(deliveries) if deliveries else None
+        body: Dict[str, object] = {
+            "status": "ok" if ready else ("degraded" if live else "down"),
+            "live": live,
+            "ready": ready,
+            "modems": modems,
+            "queue": queue_status,
+            "workers": workers,
+            "last_delivery": last_delivery,
+            "last_delivery_age": _age(now, last_delivery),
+        }
+        return live, ready, body
+
+    def run(self) -> None:
+        """Refresh until ``stop``; a failing sampler is logged and retried on the next round."""
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as exc:
+                logging.error("Health sampling failed: %s", exc)
+            self._stop.wait(self.sample_interval)
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name="health-sampler", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    monitor: HealthMonitor
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0]
+        if path not in ("/healthz", "/readyz"):
+            self._reply(404, {"error": "not found"})
+            return
+        live, ready, body = self.monitor.report()
+        self._reply(200 if (live if path == "/healthz" else ready) else 503, body)
+
+    def _reply(self, status: int, body: Dict[str, object]) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug("health: " + format, *args)
+
+
+def start_server(monitor: HealthMonitor, port: int, addr: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve ``monitor`` from a daemon thread; port 0 picks a free port."""
+    server = ThreadingHTTPServer((addr, port), type("HealthHandler", (_HealthHandler,), {"monitor": monitor}))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    logging.info("Serving health on http://%s:%s/healthz", addr, server.server_address[1])
+    return server
+
+
+def check(ready: bool = False, env=os.getenv, timeout: float = 5.0) -> int:
+    """Exit status for a container healthcheck: 0 when the local endpoint answers 200 (or is disabled)."""
+    if not health_enabled(env):
+        return 0
+    import urllib.error
+    import urllib.request
+
+    url = f"http://127.0.0.1:{int(env(HEALTH_PORT_ENV))}/{'readyz' if ready else 'healthz'}"
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return 0 if response.status == 200 else 1
+    except urllib.error.HTTPError as exc:
+        print(exc.read().decode("utf-8", "replace"), file=sys.stderr)
+        return 1
+    except OSError as exc:
+        print(f"{url}: {exc}", file=sys.stderr)
+        return 1
+
+
+def run_health(argv: List[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if "--check" in argv:
+        return check(ready="--ready" in argv)
+    logging_utils.configure_logging()
+    mode = supervisor.resolve_delivery_mode(os.getenv("DELIVERY_MODE"))
+    queue = sms_queue.open_queue() if mode in QUEUE_MODES else None
+    monitor = HealthMonitor(
+        queue,
+        resolve_state_dir(),
+        expected_workers(mode, env_utils.get_int_env("QUEUE_WORKERS", 1)),
+        sample_interval=env_utils.get_float_env("HEALTH_SAMPLE_INTERVAL", DEFAULT_SAMPLE_INTERVAL),
+        modem_interval=env_utils.get_float_env("HEALTH_MODEM_INTERVAL", DEFAULT_MODEM_INTERVAL),
+        worker_stale=env_utils.get_float_env("HEALTH_WORKER_STALE", DEFAULT_WORKER_STALE),
+        max_queue_age=env_utils.get_float_env("HEALTH_MAX_QUEUE_AGE", DEFAULT_MAX_QUEUE_AGE),
+    )
+    monitor.refresh()
+    server = start_server(monitor, env_utils.get_int_env(HEALTH_PORT_ENV, 0), os.getenv(HEALTH_ADDR_ENV) or "0.0.0.0")
+    try:
+        monitor.run()
+    finally:
+        server.shutdown()
+        if queue is not None:
+            queue.close()
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(run_health())
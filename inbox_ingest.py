@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""Resident ingester that moves SMS from the gammu inbox spool into the delivery queue.
+
+gammu-smsd's ``files`` service writes every received part to
+``${GAMMU_SPOOL_PATH}/inbox/IN<YYYYMMDD>_<HHMMSS>_<serial>_<sender>_<part>.txt``.
+Parts of a concatenated SMS are written back to back with part numbers
+``00``, ``01``, ...; a message is complete once its newest part has been on
+disk for ``INBOX_ASSEMBLY_WINDOW`` seconds. Complete messages are enqueued
+in batches and their files removed.
+
+With ``InboxFormat = detail`` gammu writes SMS backup files instead, which
+keep each segment's user data header. Segments are then stitched by their
+concatenation reference, in sequence order, even when gammu gave up
+waiting for a late segment (``MultipartTimeout``) and saved it on its own.
+A message still missing segments ``INBOX_MULTIPART_TIMEOUT`` seconds after
+its first one is enqueued with what arrived.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Set, Tuple
+
+import env_utils
+import logging_utils
+import queue_watch
+import reassembly
+import sms_queue
+
+INBOX_DIR_ENV = "GAMMU_INBOX_PATH"
+DEFAULT_ASSEMBLY_WINDOW = 2.0
+DEFAULT_BATCH_SIZE = 100
+_INBOX_NAME = re.compile(
+    r"^IN(?P<date>\d{8})_(?P<time>\d{6})_(?P<serial>\d+)_(?P<sender>.*)_(?P<part>\d+)\.txt$", re.IGNORECASE
+)
+
+
+class InboxPart:
+    """One inbox file, identified by the fields gammu encodes in its name.
+
+    ``text`` caches the decoded file once read. For backup files of a
+    concatenated SMS, ``reference`` is its ``(reference, total)`` and
+    ``segments`` maps sequence numbers to text.
+    """
+
+    __slots__ = ("path", "timestamp", "serial", "sender", "part", "mtime", "text", "reference", "segments")
+
+    def __init__(self, path: Path, timestamp: float, serial: str, sender: str, part: int, mtime: float) -> None:
+        self.path = path
+        self.timestamp = timestamp
+        self.serial = serial
+        self.sender = sender
+        self.part = part
+        self.mtime = mtime
+        self.text: str | None = None
+        self.reference: Tuple[int, int] | None = None
+        self.segments: Dict[int, str] | None = None
+
+
+def resolve_inbox_dir(env=os.getenv) -> Path:
+    configured = env(INBOX_DIR_ENV)
+    if configured:
+        return Path(configured)
+    return Path(env("GAMMU_SPOOL_PATH", "/var/spool/gammu")) / "inbox"
+
+
+def parse_inbox_name(path: Path, mtime: float = 0.0) -> InboxPart | None:
+    """Parse a gammu inbox filename; returns ``None`` for anything else (e.g. ``.bin`` data SMS)."""
+    match = _INBOX_NAME.match(path.name)
+    if match is None:
+        return None
+    try:
+        # gammu names files after the SMSC timestamp in the container's local time.
+        timestamp = time.mktime(time.strptime(match.group("date") + match.group("time"), "%Y%m%d%H%M%S"))
+    except ValueError:
+        return None
+    return InboxPart(path, timestamp, match.group("serial"), match.group("sender"), int(match.group("part")), mtime)
+
+
+def read_inbox_text(path: Path) -> str:
+    """Decode an inbox file written with ``InboxFormat = unicode`` (UTF-16 with BOM) or ``standard``."""
+    raw = path.read_bytes()
+    if raw.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return raw.decode("utf-16")
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return raw.decode("latin-1")
+
+
+def parse_backup(text: str) -> List[Tuple[str, str]]:
+    """``(udh_hex, text)`` per section of an SMS backup file (``InboxFormat = detail``)."""
+    sections: List[Dict[str, str]] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("[SMSBackup"):
+            sections.append({})
+        elif sections and " = " in line and not line.startswith(";"):
+            key, value = line.split(" = ", 1)
+            sections[-1][key.strip()] = value.strip().strip('"')
+    segments = []
+    for section in sections:
+        hex_text = "".join(section[key] for key in sorted(section) if re.fullmatch(r"Text\d+", key))
+        try:
+            decoded = bytes.fromhex(hex_text).decode("utf-16-be")
+        except ValueError:
+            decoded = ""
+        segments.append((section.get("UDH", ""), decoded))
+    return segments
+
+
+def load_part(part: InboxPart) -> None:
+    """Read ``part`` into its ``text``; for backup files also pick up the concatenation reference."""
+    text = read_inbox_text(part.path)
+    if not text.startswith("[SMSBackup"):
+        part.text = text
+        return
+    sections = parse_backup(text)
+    part.text = "".join(segment for _, segment in sections)
+    for udh, segment in sections:
+        concat = reassembly.parse_concat_udh(udh)
+        if concat is None:
+            continue
+        reference, total, sequence = concat
+        if part.reference is None:
+            part.reference = (reference, total)
+            part.segments = {}
+        if part.reference == (reference, total):
+            part.segments[sequence] = segment
+
+
+class InboxAssembler:
+    """Group inbox parts into messages and release them once no further part can arrive.
+
+    Part ``00`` opens a new message for its sender; the next part number from
+    the same sender and modem serial extends it. Backup files of
+    concatenated SMS go through a ``reassembly.ConcatIndex`` instead.
+    """
+
+    def __init__(
+        self, window: float = DEFAULT_ASSEMBLY_WINDOW, multipart_timeout: float = reassembly.DEFAULT_MULTIPART_TIMEOUT
+    ) -> None:
+        self.window = window
+        self._open: Dict[Tuple[str, str], List[InboxPart]] = {}
+        self._closed: List[List[InboxPart]] = []
+        self._concat: reassembly.ConcatIndex[InboxPart] = reassembly.ConcatIndex(multipart_timeout)
+
+    def __len__(self) -> int:
+        return len(self._open) + len(self._closed) + len(self._concat)
+
+    def add(self, part: InboxPart) -> None:
+        try:
+            load_part(part)
+        except OSError:
+            # assemble_text reads it again and reports the error.
+            pass
+        if part.reference is not None and part.segments is not None:
+            message = self._concat.add(part.sender, *part.reference, part.segments, part, at=part.mtime)
+            if message is not None:
+                self._closed.append(message.items)
+            return
+        key = (part.serial, part.sender)
+        current = self._open.get(key)
+        if current is not None and part.part == current[-1].part + 1:
+            current.append(part)
+            return
+        if current is not None:
+            self._closed.append(current)
+        self._open[key] = [part]
+
+    def ready(self, now: float) -> List[List[InboxPart]]:
+        """Return complete messages in receive order."""
+        done, self._closed = self._closed, []
+        for key, parts in list(self._open.items()):
+            if now - max(part.mtime for part in parts) >= self.window:
+                done.append(self._open.pop(key))
+        for message in self._concat.expired(now):
+            logging.warning(
+                "Concatenated SMS from %s is missing %s of %s segment(s); enqueueing what arrived",
+                message.items[0].sender,
+                message.total - len(message.sequences),
+                message.total,
+            )
+            done.append(message.items)
+        done.sort(key=lambda parts: (parts[0].timestamp, parts[0].path.name))
+        return done
+
+
+def assemble_text(parts: List[InboxPart]) -> str:
+    # Concatenated SMS split mid-word, so parts are joined without a separator.
+    return reassembly.normalize_parts(_part_texts(parts))
+
+
+def _part_texts(parts: List[InboxPart]) -> Iterator[str]:
+    if parts[0].segments is not None:
+        segments: Dict[int, str] = {}
+        for part in parts:
+            segments.update(part.segments or {})
+        for sequence in sorted(segments):
+            yield segments[sequence]
+        return
+    for part in parts:
+        yield part.text if part.text is not None else read_inbox_text(part.path)
+
+
+def scan_inbox(inbox_dir: Path, seen: Set[str]) -> List[InboxPart]:
+    """Return inbox parts not handed to the assembler yet, oldest first."""
+    found = []
+    try:
+        entries = list(os.scandir(inbox_dir))
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        if entry.name in seen or not entry.is_file():
+            continue
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        part = parse_inbox_name(Path(entry.path), mtime)
+        if part is not None:
+            seen.add(entry.name)
+            found.append(part)
+    found.sort(key=lambda part: (part.timestamp, part.path.name))
+    return found
+
+
+def ingest_once(
+    inbox_dir: Path,
+    queue: sms_queue.QueueBackend,
+    assembler: InboxAssembler,
+    seen: Set[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    now: float | None = None,
+) -> int:
+    """Scan the inbox, enqueue every complete message and delete its files; returns the number enqueued."""
+    for part in scan_inbox(inbox_dir, seen):
+        assembler.add(part)
+    ready = assembler.ready(time.time() if now is None else now)
+    batch_size = max(1, batch_size)
+    enqueued = 0
+    for start in range(0, len(ready), batch_size):
+        batch = []
+        for parts in ready[start : start + batch_size]:
+            try:
+                batch.append((parts, assemble_text(parts)))
+            except OSError as exc:
+                # Left in place (and in ``seen``) so it is not retried until restart.
+                logging.warning("Skipping unreadable inbox message %s: %s", parts[0].path.name, exc)
+        try:
+            queue.enqueue_many((parts[0].sender, text, None) for parts, text in batch)
+        except Exception:
+            # Forget everything not enqueued yet so the next scan picks it up again.
+            for parts in ready[start:]:
+                seen.difference_update(part.path.name for part in parts)
+            raise
+        # Files are removed only after the batch is durable in the queue, so a
+        # crash in between re-ingests (never loses) the batch.
+        for parts, _ in batch:
+            for part in parts:
+                _remove(part.path)
+                seen.discard(part.path.name)
+            logging.info("Enqueued SMS from %s (%s part(s))", parts[0].sender, len(parts))
+        enqueued += len(batch)
+    return enqueued
+
+
+def _remove(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def run_ingester() -> None:
+    logging_utils.configure_logging()
+    inbox_dir = resolve_inbox_dir()
+    inbox_dir.mkdir(parents=True, exist_ok=True)
+    window = env_utils.get_float_env("INBOX_ASSEMBLY_WINDOW", DEFAULT_ASSEMBLY_WINDOW)
+    batch_size = env_utils.get_int_env("INBOX_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    poll_interval = env_utils.get_float_env("INBOX_POLL_INTERVAL", 2.0)
+    multipart_timeout = env_utils.get_float_env("INBOX_MULTIPART_TIMEOUT", reassembly.DEFAULT_MULTIPART_TIMEOUT)
+
+    queue = sms_queue.open_queue()
+    assembler = InboxAssembler(window, multipart_timeout)
+    seen: Set[str] = set()
+    watcher = queue_watch.open_watcher(inbox_dir, queue_watch.normalize_watch_mode(os.getenv("QUEUE_WATCH")))
+    logging.info("Ingesting SMS from %s", inbox_dir)
+    try:
+        while True:
+            try:
+                ingest_once(inbox_dir, queue, assembler, seen, batch_size)
+            except Exception as exc:
+                logging.error("Inbox ingest failed: %s", exc)
+            # While parts are waiting for their message to complete, wake up in
+            # time to release them; otherwise sleep until gammu writes a file.
+            watcher.wait(min(poll_interval, window) if len(assembler) else poll_interval)
+    finally:
+        watcher.close()
+        queue.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    run_ingester()
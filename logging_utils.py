@@ -1,9 +1,27 @@
-"""Logging helpers."""
+"""Logging helpers.
+
+``configure_logging`` replaces ``logging.basicConfig`` in the entry points.
+By default it keeps the plain text lines, but writes them from a background
+thread: records are put on a bounded queue and the caller never waits for
+stderr (and the watchdog pipe behind it). With ``LOG_FORMAT=json`` every
+record becomes one JSON line with the message id, a hash of the sender's
+number and the delivery latency when the caller supplied them. Repeated
+warnings with the same message template are sampled: at most
+``LOG_SAMPLE_BURST`` per ``LOG_SAMPLE_INTERVAL`` seconds, and the next line
+that passes reports how many were suppressed.
+"""
 
 from __future__ import annotations
 
+import atexit
+import hashlib
+import json
 import logging
 import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Tuple
 
 _LEVEL_NAMES = {
     "CRITICAL": logging.CRITICAL,
@@ -14,6 +32,13 @@ _LEVEL_NAMES = {
     "NOTSET": logging.NOTSET,
 }
 
+LOG_FORMATS = ("text", "json")
+DEFAULT_SAMPLE_INTERVAL = 60.0
+DEFAULT_SAMPLE_BURST = 10
+DEFAULT_QUEUE_SIZE = 10000
+# Attributes copied from ``extra=`` into JSON lines.
+CONTEXT_FIELDS = ("message_id", "number_hash", "latency_ms", "attempt", "suppressed")
+
 
 def parse_loglevel(value: str | None) -> int:
     if value is None:
@@ -28,3 +53,187 @@ def parse_loglevel(value: str | None) -> int:
 
 def get_loglevel(name: str = "LOGLEVEL") -> int:
     return parse_loglevel(os.getenv(name))
+
+
+def parse_log_format(value: str | None) -> str:
+    cleaned = (value or "text").strip().lower()
+    return cleaned if cleaned in LOG_FORMATS else "text"
+
+
+def hash_number(number: str) -> str:
+    """Short stable digest of a phone number, for correlating log lines without grepping raw numbers."""
+    return hashlib.blake2b(number.encode("utf-8", "surrogatepass"), digest_size=6).hexdigest()
+
+
+def message_fields(
+    message_id: str | None = None, number: object = None, received_at: object = None
+) -> Dict[str, object]:
+    """``extra=`` mapping describing one message: its id, number hash and age in milliseconds."""
+    fields: Dict[str, object] = {}
+    if message_id:
+        fields["message_id"] = message_id
+    if isinstance(number, str) and number:
+        fields["number_hash"] = hash_number(number)
+    if isinstance(received_at, (int, float)):
+        fields["latency_ms"] = round(max(0.0, time.time() - received_at) * 1000, 1)
+    return fields
+
+
+class TextFormatter(logging.Formatter):
+    """The usual text line, plus a note when similar warnings were sampled away before it."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f" ({suppressed} similar suppressed)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message and the known context fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, object] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Pass at most ``burst`` WARNING records per message template every ``interval`` seconds.
+
+    Records are keyed by logger and unformatted message, so "Delivery failed
+    (%s/%s): %s" is one key whatever its arguments. The first record let
+    through after a suppressed run carries the count as ``suppressed``.
+    """
+
+    def __init__(self, interval: float, burst: int, clock: Callable[[], float] = time.monotonic) -> None:
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._windows: Dict[Tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.WARNING or self.burst <= 0 or self.interval <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+def _background_handler(output: logging.Handler, size: int):
+    """QueueHandler for the callers plus the started listener thread that feeds ``output``."""
+    import logging.handlers
+    import queue
+
+    class DroppingQueueHandler(logging.handlers.QueueHandler):
+        """QueueHandler that drops records instead of blocking when the queue is full, and says so."""
+
+        def __init__(self, records: queue.Queue) -> None:
+            super().__init__(records)
+            self.dropped = 0
+            self._dropped_lock = threading.Lock()
+
+        def enqueue(self, record: logging.LogRecord) -> None:
+            # The count is taken out under the lock and put back if the notice
+            # does not fit either, so no thread's drops are lost.
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            try:
+                if dropped:
+                    notice = logging.LogRecord(
+                        record.name, logging.WARNING, __file__, 0, "Dropped %s log records", (dropped,), None
+                    )
+                    self.queue.put_nowait(self.prepare(notice))
+                    dropped = 0
+                self.queue.put_nowait(record)
+            except queue.Full:
+                with self._dropped_lock:
+                    self.dropped += dropped + 1
+
+    records: queue.Queue = queue.Queue(maxsize=max(1, size))
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return DroppingQueueHandler(records), listener
+
+
+def configure_logging(
+    level: int | None = None,
+    text_format: str = logging.BASIC_FORMAT,
+    background: bool | None = None,
+    stream=None,
+    env=os.getenv,
+) -> None:
+    """Set up the root logger from ``LOGLEVEL``, ``LOG_FORMAT``, ``LOG_ASYNC`` and the sampling settings.
+
+    Like ``basicConfig`` it does nothing when the root logger already has
+    handlers. ``background=False`` writes synchronously, which suits the
+    short-lived receive hook better than starting a thread.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    root.setLevel(parse_loglevel(env("LOGLEVEL")) if level is None else level)
+
+    output = logging.StreamHandler(sys.stderr if stream is None else stream)
+    if parse_log_format(env("LOG_FORMAT")) == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(TextFormatter(text_format))
+
+    handler: logging.Handler = output
+    if background is None:
+        background = _env_flag(env("LOG_ASYNC"), True)
+    if background:
+        handler, listener = _background_handler(output, _env_number(env, "LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE, int))
+        atexit.register(listener.stop)
+
+    handler.addFilter(
+        SamplingFilter(
+            _env_number(env, "LOG_SAMPLE_INTERVAL", DEFAULT_SAMPLE_INTERVAL, float),
+            _env_number(env, "LOG_SAMPLE_BURST", DEFAULT_SAMPLE_BURST, int),
+        )
+    )
+    root.addHandler(handler)
+
+
+def _env_flag(value: str | None, default: bool) -> bool:
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off")
+
+
+def _env_number(env, name: str, default, kind):
+    # env_utils logs parse errors, which cannot work before logging is set up.
+    value = env(name)
+    try:
+        return kind(value) if value is not None and value.strip() else default
+    except ValueError:
+        return default
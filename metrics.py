@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Minimal Prometheus metrics: counters, histograms, scrape-time gauges and an HTTP endpoint.
+
+Updates are an uncontended lock plus an addition, so instrumenting the
+delivery path costs well under a microsecond. Values that need I/O (queue
+depth, oldest pending age, watchdog resets) are gauges whose callbacks run
+only when ``/metrics`` is scraped.
+"""
+from __future__ import annotations
+
+import bisect
+import logging
+import math
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+METRICS_PORT_ENV = "METRICS_PORT"
+METRICS_ADDR_ENV = "METRICS_ADDR"
+WATCHDOG_STATE_ENV = "WATCHDOG_STATE_FILE"
+DEFAULT_WATCHDOG_STATE = "/tmp/smsgw-watchdog-resets"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: LabelValues) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {} if labelnames else {(): 0.0}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: object) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + "_total", self._labels(key), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: non-cumulative bucket counts (last slot is +Inf), sum, count.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def count(self, **labels: object) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class CallbackGauge(_Metric):
+    """Gauge whose samples are produced by ``callback`` at scrape time.
+
+    The callback returns a mapping of label-value tuples to values, or a
+    single number for an unlabelled gauge.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], object],
+        labelnames: Sequence[str] = (),
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self) -> Iterable[Sample]:
+        result = self.callback()
+        if result is None:
+            return
+        if not isinstance(result, dict):
+            result = {(): result}
+        for key, value in sorted(result.items()):
+            if value is not None:
+                yield self.name, self._labels(key), float(value)
+
+
+class CallbackCounter(CallbackGauge):
+    """Counter whose totals are read by ``callback`` at scrape time, e.g. from a log another process appends to."""
+
+    kind = "counter"
+
+    def samples(self) -> Iterable[Sample]:
+        for name, labels, value in super().samples():
+            yield name + "_total", labels, value
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(
+        self, name: str, documentation: str, callback: Callable[[], object], labelnames: Sequence[str] = ()
+    ) -> CallbackGauge:
+        return self.register(CallbackGauge(name, documentation, callback, labelnames))
+
+    def callback_counter(
+        self, name: str, documentation: str, callback: Callable[[], object], labelnames: Sequence[str] = ()
+    ) -> CallbackCounter:
+        return self.register(CallbackCounter(name, documentation, callback, labelnames))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as exc:
+                # A failing collector must not break the whole scrape.
+                logging.warning("Metric %s failed: %s", metric.name, exc)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+TELEGRAM_REQUEST_SECONDS = REGISTRY.histogram(
+    "smsgw_telegram_request_seconds", "Telegram Bot API request latency.", buckets=REQUEST_BUCKETS
+)
+TELEGRAM_REQUESTS = REGISTRY.counter(
+    "smsgw_telegram_requests", "Telegram Bot API requests by HTTP status code ('error' if no response).", ["code"]
+)
+DELIVERY_LATENCY_SECONDS = REGISTRY.histogram(
+    "smsgw_delivery_latency_seconds", "Time from receiving an SMS to its delivery to Telegram."
+)
+DELIVERED = REGISTRY.counter("smsgw_messages_delivered", "Queued messages delivered.")
+COALESCED = REGISTRY.counter("smsgw_messages_coalesced", "Messages merged into another message's Telegram send.")
+RETRIES = REGISTRY.counter("smsgw_queue_retries", "Delivery attempts that were rescheduled.")
+FAILED = REGISTRY.counter("smsgw_queue_failed", "Messages moved to failed after exhausting their retries.")
+DUPLICATES = REGISTRY.counter(
+    "smsgw_duplicates_skipped", "Queued messages not sent because the delivery ledger knew them.", ["reason"]
+)
+MODEM_DELIVERED = REGISTRY.counter(
+    "smsgw_modem_messages_delivered", "Queued messages delivered, by the modem that received them.", ["modem"]
+)
+
+
+def read_watchdog_resets(path: Path) -> Tuple[int, float | None]:
+    """Parse the reset log written by ``entrypoint.sh``: one ``<unix time> <vid>:<pid> [<modem>]`` line per reset."""
+    try:
+        lines = path.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return 0, None
+    count, last = 0, None
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        count += 1
+        try:
+            last = float(fields[0])
+        except ValueError:
+            continue
+    return count, last
+
+
+def read_watchdog_resets_by_modem(path: Path) -> Dict[LabelValues, int]:
+    """Count resets per modem id, the optional third field that multi-modem instances write."""
+    try:
+        lines = path.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return {}
+    counts: Dict[LabelValues, int] = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 3:
+            counts[(fields[2],)] = counts.get((fields[2],), 0) + 1
+    return counts
+
+
+def register_watchdog_metrics(registry: Registry = REGISTRY, env=os.getenv) -> None:
+    path = Path(env(WATCHDOG_STATE_ENV) or DEFAULT_WATCHDOG_STATE)
+    registry.callback_counter(
+        "smsgw_modem_watchdog_resets",
+        "USB modem resets performed by the entrypoint watchdog.",
+        lambda: read_watchdog_resets(path)[0],
+    )
+    registry.gauge(
+        "smsgw_modem_watchdog_last_reset_timestamp_seconds",
+        "Unix time of the last watchdog reset.",
+        lambda: read_watchdog_resets(path)[1],
+    )
+    registry.callback_counter(
+        "smsgw_modem_watchdog_resets_by_modem",
+        "USB modem resets per modem in multi-modem mode.",
+        lambda: read_watchdog_resets_by_modem(path),
+        ["modem"],
+    )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug("metrics: " + format, *args)
+
+
+def start_server(port: int, addr: str = "0.0.0.0", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Serve ``registry`` on ``addr:port`` from a daemon thread; port 0 picks a free port."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logging.info("Serving metrics on http://%s:%s/metrics", addr, server.server_address[1])
+    return server
@@ -1,18 +1,29 @@
 #!/usr/bin/env python3
-"""Handle incoming SMS and forward them to Telegram."""
+"""Handle incoming SMS and forward them to Telegram.
+
+gammu-smsd starts this script once per SMS, so the ``--enqueue`` path only
+imports the standard library: ``telegram_client`` (and with it ``requests``)
+is loaded when a message is actually sent.
+"""
 import html
 import logging
 import os
-import re
 import sys
 import time
-from typing import Iterable, Tuple
-
-import requests
+from typing import Iterable, List, Tuple
 
+import env_utils
 import logging_utils
+import reassembly
 import sms_queue
 
+TELEGRAM_TEXT_LIMIT = 4096
+# Room for the " (12/34)" marker in the header of a split message.
+PART_MARKER_RESERVE = 12
+DEFAULT_HYBRID_SEND_TIMEOUT = 5.0
+# Set by entrypoint.sh for each gammu-smsd instance when MULTI_MODEM is on.
+MODEM_ID_ENV = "SMSGW_MODEM_ID"
+
 
 def get_env(name: str, required: bool = True, default: str | None = None) -> str:
     """Get environment variable and optionally require it."""
@@ -23,67 +34,127 @@ def get_env(name: str, required: bool = True, default: str | None = None) -> str
 
 
 def parse_sms(parts: int, getenv=os.getenv) -> Tuple[str, str]:
-    """Assemble multipart SMS from environment variables."""
+    """Assemble multipart SMS from environment variables, reading no more parts than the text limit needs."""
     number = getenv("SMS_1_NUMBER", "unknown").strip()
-    messages: Iterable[str] = []
-    collected: list[str] = []
-    for i in range(1, parts + 1):
-        text = getenv(f"SMS_{i}_TEXT")
-        if text is not None:
-            collected.append(text.rstrip())
-    messages = collected
-    if not messages:
-        messages = ["(empty)"]
-    text = "\n".join(messages).lstrip()
-    text = re.sub(r"\n(?!\n)", " ", text)
-    text = re.sub(r" {2,}", " ", text)
-    if not text:
-        text = "(empty)"
-    return number, text[:4096]
+    texts = (getenv(f"SMS_{i}_TEXT") for i in range(1, parts + 1))
+    return number, reassembly.normalize_parts((text.rstrip() for text in texts if text is not None), separator="\n")
+
+
+def clean_text(text: str) -> str:
+    """Fold single line breaks and repeated spaces, and cap the text at ``reassembly.MAX_TEXT_LENGTH``."""
+    return reassembly.normalize_parts([text])
+
+
+def format_sms_html(number: str, text: str, marker: str = "") -> str:
+    return f"<b>{html.escape(number)}</b>{marker}\n{html.escape(text)}"
 
 
 def build_telegram_payload(chat_id: str, number: str, text: str) -> dict[str, str]:
     """Build Telegram payload for the SMS message."""
     return {
         "chat_id": chat_id,
-        "text": f"<b>{html.escape(number)}</b>\n{html.escape(text)}",
+        "text": format_sms_html(number, text),
+        "parse_mode": "HTML",
+    }
+
+
+def build_telegram_payloads(chat_id: str, number: str, text: str) -> List[dict[str, str]]:
+    """Payloads for one SMS: a single message, or numbered parts when it exceeds Telegram's limit."""
+    budget = TELEGRAM_TEXT_LIMIT - len(number) - 1
+    if len(text) <= budget:
+        return [build_telegram_payload(chat_id, number, text)]
+    pieces = reassembly.split_text(text, budget - PART_MARKER_RESERVE)
+    return [
+        {
+            "chat_id": chat_id,
+            "text": format_sms_html(number, piece, f" ({index}/{len(pieces)})"),
+            "parse_mode": "HTML",
+        }
+        for index, piece in enumerate(pieces, 1)
+    ]
+
+
+def build_telegram_batch_payload(chat_id: str, messages: Iterable[Tuple[str, str]]) -> dict[str, str]:
+    """Build one Telegram payload for several SMS, each under its own bold number header."""
+    return {
+        "chat_id": chat_id,
+        "text": "\n\n".join(format_sms_html(number, text) for number, text in messages),
         "parse_mode": "HTML",
     }
 
 
 def send_to_telegram(bot_token: str, chat_id: str, number: str, text: str) -> None:
     """Send assembled SMS to Telegram."""
-    payload = build_telegram_payload(chat_id, number, text)
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    import telegram_client
+
+    payloads = build_telegram_payloads(chat_id, number, text)
+    sent = 0
     for attempt in range(120):
         try:
-            requests.post(url, json=payload, timeout=10).raise_for_status()
+            # A retry continues with the first part that did not go out.
+            while sent < len(payloads):
+                telegram_client.send_message(bot_token, payloads[sent])
+                sent += 1
             logging.info("Sent SMS from %s to Telegram", number)
             return
         except Exception as exc:  # pragma: no cover - network failure is ignored in tests
             logging.warning("Send failed (attempt %s): %s", attempt + 1, exc)
-            time.sleep(30)
+            # A 429 names its own wait; anything else retries every 30 seconds.
+            time.sleep(getattr(exc, "retry_after", None) or 30)
     logging.error("Failed to send SMS after retries")
     raise SystemExit(1)
 
 
+def send_or_enqueue(bot_token: str, chat_id: str, number: str, text: str, timeout: float) -> bool:
+    """Try one send within ``timeout`` seconds; on any failure hand the SMS to the queue worker instead.
+
+    Returns whether the direct send succeeded. Unlike ``send_to_telegram``
+    the hook never sleeps, so an upstream outage costs each SMS at most the
+    timeout plus one enqueue.
+    """
+    import telegram_client
+
+    sent = 0
+    try:
+        for payload in build_telegram_payloads(chat_id, number, text):
+            telegram_client.send_message(bot_token, payload, timeout=timeout)
+            sent += 1
+    except Exception as exc:
+        logging.warning("Direct send failed (%s); queueing the SMS for the worker", exc)
+        enqueue_sms(number, text, parts_sent=sent)
+        return False
+    logging.info("Sent SMS from %s to Telegram", number)
+    return True
+
+
 def normalize_delivery_mode(value: str | None) -> str:
     mode = (value or "direct").strip().lower()
-    if mode == "queue":
-        return "queue"
+    if mode in ("queue", "hybrid"):
+        return mode
     if mode != "direct":
         logging.warning("Unknown DELIVERY_MODE=%r; defaulting to direct", value)
     return "direct"
 
 
-def enqueue_sms(number: str, text: str) -> None:
-    base_dir = sms_queue.resolve_queue_dir()
-    path = sms_queue.enqueue_message(number, text, base_dir)
-    logging.info("Enqueued SMS from %s to %s", number, path)
+def enqueue_sms(number: str, text: str, parts_sent: int = 0) -> None:
+    payload = sms_queue.build_payload(number, text)
+    if parts_sent:
+        # The worker skips the parts of a split message that already went out.
+        payload["parts_sent"] = parts_sent
+    modem = os.getenv(MODEM_ID_ENV)
+    if modem:
+        payload["modem"] = modem
+    queue = sms_queue.open_queue()
+    try:
+        (message_id,) = queue.enqueue_payloads([payload])
+    finally:
+        queue.close()
+    logging.info("Enqueued SMS from %s as %s", number, message_id)
 
 
 def main(argv: list[str] | None = None) -> None:
-    logging.basicConfig(level=logging_utils.get_loglevel())
+    # One short-lived process per SMS: write log lines directly instead of starting a thread.
+    logging_utils.configure_logging(background=False)
     argv = sys.argv[1:] if argv is None else argv
     try:
         parts = int(os.getenv("SMS_MESSAGES", "1"))
@@ -92,7 +163,12 @@ def main(argv: list[str] | None = None) -> None:
         sys.exit(1)
 
     number, text = parse_sms(parts)
-    delivery_mode = "queue" if "--enqueue" in argv else normalize_delivery_mode(os.getenv("DELIVERY_MODE"))
+    if "--enqueue" in argv:
+        delivery_mode = "queue"
+    elif "--hybrid" in argv:
+        delivery_mode = "hybrid"
+    else:
+        delivery_mode = normalize_delivery_mode(os.getenv("DELIVERY_MODE"))
     if delivery_mode == "queue":
         enqueue_sms(number, text)
         return
@@ -104,6 +180,10 @@ def main(argv: list[str] | None = None) -> None:
         logging.error("%s", exc)
         sys.exit(1)
 
+    if delivery_mode == "hybrid":
+        timeout = env_utils.get_float_env("HYBRID_SEND_TIMEOUT", DEFAULT_HYBRID_SEND_TIMEOUT)
+        send_or_enqueue(bot, chat, number, text, timeout)
+        return
     send_to_telegram(bot, chat, number, text)
 
 
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Outbound SMS: a local HTTP API that queues send requests and a dispatcher that feeds gammu.
+
+Requests are stored in their own file queue (``SMSGW_OUTBOX_QUEUE_DIR``) with
+the same atomic write-and-rename scheme as the inbound queue; a request with
+many messages costs one directory fsync. The dispatcher claims due messages
+at ``OUTBOX_RATE`` per second, keeps at most ``OUTBOX_MAX_INFLIGHT`` of them in
+gammu's ``outbox/`` and reconciles each one once gammu has moved its file to
+``sent/`` or ``error/``.
+
+An outbox file name carries the queue id, so the file of a claimed message
+can always be found again, including after a restart::
+
+    OUTC<YYYYMMDD>_<HHMMSS>_00_<number>_<id>.txt
+"""
+from __future__ import annotations
+
+import codecs
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import env_utils
+import logging_utils
+import rate_limit
+import sms_queue
+from queue_worker import compute_backoff, is_due
+
+OUTBOX_QUEUE_DIR_ENV = "SMSGW_OUTBOX_QUEUE_DIR"
+OUTBOX_SPOOL_ENV = "OUTBOX_SPOOL_PATH"
+API_PORT_ENV = "OUTBOX_API_PORT"
+API_ADDR_ENV = "OUTBOX_API_ADDR"
+API_TOKEN_ENV = "OUTBOX_API_TOKEN"
+DEFAULT_API_PORT = 8088
+MAX_REQUEST_BYTES = 1 << 20
+MAX_MESSAGES_PER_REQUEST = 1000
+MAX_TEXT_LENGTH = 1530  # ten concatenated GSM-7 parts
+_NUMBER = re.compile(r"^\+?[0-9]{3,20}$")
+
+
+def resolve_outbound_dir(env=os.getenv) -> Path:
+    configured = env(OUTBOX_QUEUE_DIR_ENV)
+    if configured:
+        return Path(configured)
+    return Path(env("GAMMU_SPOOL_PATH", "/var/spool/gammu")) / "sms-outbound"
+
+
+def outbox_enabled(env=os.getenv) -> bool:
+    """The outbox runs when ``OUTBOX_API_PORT`` is set to a port; ``0`` or unset turns it off."""
+    try:
+        return int(env(API_PORT_ENV) or 0) > 0
+    except ValueError:
+        return False
+
+
+def resolve_spool_dir(env=os.getenv) -> Path:
+    """The gammu spool whose ``outbox/`` the dispatcher feeds; raises ``ValueError`` if no gammu-smsd reads it.
+
+    With ``MULTI_MODEM=true`` each modem's gammu-smsd reads only its own
+    ``modems/<id>/outbox``, so ``OUTBOX_SPOOL_PATH`` must name one of them;
+    the root spool's outbox would never be sent.
+    """
+    root = Path(env("GAMMU_SPOOL_PATH", "/var/spool/gammu"))
+    configured = env(OUTBOX_SPOOL_ENV)
+    # Same test as entrypoint.sh, which starts the per-modem instances.
+    if env("MULTI_MODEM") == "true" and (not configured or Path(configured).parent != root / "modems"):
+        raise ValueError(
+            f"With MULTI_MODEM=true set {OUTBOX_SPOOL_ENV} to the spool of the modem that sends, "
+            f"{root / 'modems'}/<modem id>"
+        )
+    return Path(configured) if configured else root
+
+
+def validate_message(message: object) -> Tuple[str, str]:
+    """Return ``(number, text)`` of a send request entry; raises ``ValueError`` when it is malformed."""
+    if not isinstance(message, dict):
+        raise ValueError("each message must be an object with 'number' and 'text'")
+    number = message.get("number")
+    text = message.get("text")
+    if not isinstance(number, str) or not _NUMBER.match(number):
+        raise ValueError(f"invalid number {number!r}")
+    if not isinstance(text, str) or not text:
+        raise ValueError("text must be a non-empty string")
+    if len(text) > MAX_TEXT_LENGTH:
+        raise ValueError(f"text is longer than {MAX_TEXT_LENGTH} characters")
+    return number, text
+
+
+def outbox_name(payload: Dict[str, object]) -> str:
+    stamp = time.strftime("%Y%m%d_%H%M%S", time.gmtime(float(payload["received_at"])))
+    return f"OUTC{stamp}_00_{payload['number']}_{payload['id']}.txt"
+
+
+def encode_outbox_text(text: str) -> bytes:
+    # Matches ``OutboxFormat = unicode`` in the generated smsdrc.
+    return codecs.BOM_UTF16_LE + text.encode("utf-16-le")
+
+
+def message_state(queue: sms_queue.FileQueue, message_id: str) -> Tuple[str, Dict[str, object]] | None:
+    if not re.fullmatch(r"[0-9A-Za-z-]+", message_id):
+        return None
+    for state in sms_queue.QUEUE_STATES:
+        path = queue.dirs[state] / f"{message_id}.json"
+        try:
+            return state, sms_queue.load_payload(path)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class OutboxDispatcher:
+    """Move queued outbound messages into gammu's outbox and track their outcome."""
+
+    def __init__(
+        self,
+        queue: sms_queue.FileQueue,
+        spool_dir: Path,
+        rate: float = 1.0,
+        burst: float = 5.0,
+        max_inflight: int = 10,
+        max_attempts: int = 3,
+        retry_delay: float = 60.0,
+        max_delay: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.queue = queue
+        self.outbox = spool_dir / "outbox"
+        self.sent = spool_dir / "sent"
+        self.error = spool_dir / "error"
+        for path in (self.outbox, self.sent, self.error):
+            path.mkdir(parents=True, exist_ok=True)
+        self.max_inflight = max(1, max_inflight)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._bucket = rate_limit.TokenBucket(rate, burst, clock()) if rate > 0 else None
+        self._ready_at: float | None = None
+
+    def _processing(self) -> List[sms_queue.QueueItem]:
+        items = []
+        for path in sorted(self.queue.dirs["processing"].glob("*.json")):
+            try:
+                items.append(sms_queue.QueueItem(path.stem, sms_queue.load_payload(path), path))
+            except (OSError, ValueError):
+                continue
+        return items
+
+    def _outcome(self, name: str) -> str | None:
+        if (self.sent / name).exists():
+            return "sent"
+        if (self.error / name).exists():
+            return "error"
+        return None
+
+    def reconcile(self) -> int:
+        """Settle in-flight messages that gammu has finished with; returns how many were settled."""
+        settled = 0
+        for item in self._processing():
+            name = outbox_name(item.payload)
+            outcome = self._outcome(name)
+            if outcome is None and (self.outbox / name).exists():
+                continue
+            # gammu renames outbox -> sent/error, so look again in case it just moved.
+            outcome = outcome or self._outcome(name)
+            if outcome == "sent":
+                logging.info("Sent SMS %s to %s", item.id, item.payload["number"])
+                self.queue.ack(item)
+            elif outcome == "error":
+                self._failed(item, name)
+            else:
+                # Claimed but never written (a crash in between): send it again.
+                self.queue.release(item)
+            settled += 1
+        return settled
+
+    def _failed(self, item: sms_queue.QueueItem, name: str) -> None:
+        payload = item.payload
+        attempts = int(payload.get("attempts") or 0) + 1
+        payload["attempts"] = attempts
+        payload["last_error"] = "gammu moved the message to error/"
+        if self.max_attempts > 0 and attempts >= self.max_attempts:
+            logging.warning("Sending SMS %s failed (%s/%s); giving up", item.id, attempts, self.max_attempts)
+            self.queue.fail(item)
+            return
+        # The next attempt reuses the file name, so the old error file must go.
+        (self.error / name).unlink(missing_ok=True)
+        payload["next_attempt_at"] = time.time() + compute_backoff(attempts, self.retry_delay, self.max_delay)
+        logging.warning("Sending SMS %s failed (%s/%s); retrying", item.id, attempts, self.max_attempts)
+        self.queue.retry(item)
+
+    def _take_token(self) -> bool:
+        if self._bucket is None:
+            return True
+        now = self._clock()
+        if self._ready_at is None:
+            self._ready_at = now + self._bucket.reserve(now)
+        if now < self._ready_at:
+            return False
+        self._ready_at = None
+        return True
+
+    def next_dispatch_in(self) -> float:
+        """Seconds until the rate limit lets the next message through (0 if it would now)."""
+        if self._ready_at is None:
+            return 0.0
+        return max(0.0, self._ready_at - self._clock())
+
+    def dispatch(self) -> int:
+        """Write due messages to gammu's outbox within the rate and in-flight limits; returns how many."""
+        free = self.max_inflight - len(list(self.queue.dirs["processing"].glob("*.json")))
+        written = 0
+        now = time.time()
+        for item in self.queue.pending():
+            if written >= free:
+                break
+            if item.payload is not None and not is_due(item.payload, now):
+                continue
+            if not self._take_token():
+                break
+            claimed = self.queue.claim(item)
+            if claimed is None:
+                continue
+            if claimed.payload is None:
+                logging.error("Outbound message %s is unreadable; moving it to failed", claimed.id)
+                self.queue.fail(claimed)
+                continue
+            name = outbox_name(claimed.payload)
+            data = encode_outbox_text(str(claimed.payload["text"]))
+            sms_queue.write_file_atomic(data, self.outbox / f".{name}.tmp", self.outbox / name, sync_dir=False)
+            written += 1
+        if written:
+            sms_queue._fsync_dir(self.outbox)
+        return written
+
+
+class _OutboxHandler(BaseHTTPRequestHandler):
+    queue: sms_queue.FileQueue
+    token: str = ""
+    wake: threading.Event
+
+    def _reply(self, status: int, body: Dict[str, object]) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self) -> bool:
+        if not self.token:
+            return True
+        supplied = self.headers.get("Authorization", "")
+        if hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {self.token}".encode("utf-8")):
+            return True
+        self._reply(401, {"error": "unauthorized"})
+        return False
+
+    def do_POST(self) -> None:
+        if self.path.split("?", 1)[0] != "/send":
+            self._reply(404, {"error": "not found"})
+            return
+        if not self._authorized():
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length <= 0 or length > MAX_REQUEST_BYTES:
+            self._reply(413 if length > MAX_REQUEST_BYTES else 400, {"error": "bad request size"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length))
+            messages = body.get("messages", [body]) if isinstance(body, dict) else None
+            if not isinstance(messages, list) or not messages or len(messages) > MAX_MESSAGES_PER_REQUEST:
+                raise ValueError(f"send between 1 and {MAX_MESSAGES_PER_REQUEST} messages")
+            payloads = [sms_queue.build_payload(*validate_message(message)) for message in messages]
+        except ValueError as exc:
+            self._reply(400, {"error": str(exc)})
+            return
+        ids = self.queue.enqueue_payloads(payloads)
+        self.wake.set()
+        self._reply(202, {"ids": ids})
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0]
+        if not path.startswith("/messages/"):
+            self._reply(404, {"error": "not found"})
+            return
+        if not self._authorized():
+            return
+        message_id = path[len("/messages/") :]
+        found = message_state(self.queue, message_id)
+        if found is None:
+            self._reply(404, {"error": "unknown message"})
+            return
+        state, payload = found
+        body: Dict[str, object] = {"id": message_id, "state": state, "number": payload.get("number")}
+        for field in sms_queue.RETRY_FIELDS:
+            if field in payload:
+                body[field] = payload[field]
+        self._reply(200, body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug("outbox api: " + format, *args)
+
+
+def start_api(
+    queue: sms_queue.FileQueue, port: int, addr: str = "127.0.0.1", token: str = "", wake: threading.Event | None = None
+) -> ThreadingHTTPServer:
+    """Serve the send API from a daemon thread; port 0 picks a free port."""
+    if not token and not ipaddress.ip_address(addr).is_loopback:
+        raise ValueError(f"{API_TOKEN_ENV} is required when the outbox API listens on {addr}")
+    attrs = {"queue": queue, "token": token, "wake": wake or threading.Event()}
+    server = ThreadingHTTPServer((addr, port), type("OutboxHandler", (_OutboxHandler,), attrs))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="outbox-api", daemon=True).start()
+    logging.info("Serving the outbox API on http://%s:%s/send", addr, server.server_address[1])
+    return server
+
+
+def run_outbox() -> None:
+    logging_utils.configure_logging()
+    try:
+        spool_dir = resolve_spool_dir()
+    except ValueError as exc:
+        logging.error("%s", exc)
+        raise SystemExit(1)
+    queue = sms_queue.FileQueue(resolve_outbound_dir())
+    dispatcher = OutboxDispatcher(
+        queue,
+        spool_dir,
+        rate=env_utils.get_float_env("OUTBOX_RATE", 1.0),
+        burst=env_utils.get_float_env("OUTBOX_BURST", 5.0),
+        max_inflight=env_utils.get_int_env("OUTBOX_MAX_INFLIGHT", 10),
+        max_attempts=env_utils.get_int_env("OUTBOX_MAX_RETRIES", 3),
+        retry_delay=env_utils.get_float_env("OUTBOX_RETRY_DELAY", 60.0),
+    )
+    poll_interval = env_utils.get_float_env("OUTBOX_POLL_INTERVAL", 1.0)
+    wake = threading.Event()
+    try:
+        server = start_api(
+            queue,
+            env_utils.get_int_env(API_PORT_ENV, DEFAULT_API_PORT),
+            os.getenv(API_ADDR_ENV) or "127.0.0.1",
+            os.getenv(API_TOKEN_ENV) or "",
+            wake,
+        )
+    except ValueError as exc:
+        logging.error("%s", exc)
+        raise SystemExit(1)
+    try:
+        while True:
+            try:
+                dispatcher.reconcile()
+                dispatcher.dispatch()
+            except Exception as exc:
+                logging.error("Outbox dispatch failed: %s", exc)
+            wait = poll_interval
+            if dispatcher.next_dispatch_in() > 0:
+                wait = min(wait, dispatcher.next_dispatch_in())
+            wake.wait(wait)
+            wake.clear()
+    finally:
+        server.shutdown()
+        queue.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    run_outbox()
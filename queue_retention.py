@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Retention for finished queue items: archive old sent/failed messages into daily segments.
+
+Archived messages are appended to ``<queue dir>/archive/<state>-YYYY-MM-DD.jsonl.gz``
+(one segment per state and UTC day, one JSON object per line) and then removed
+from the queue. Usage:
+
+    python3 queue_retention.py compact [--all]
+    python3 queue_retention.py query [--state sent] [--since 2024-01-01] [--until 2024-01-31]
+                                     [--number +49] [--text code] [--limit 100]
+    python3 queue_retention.py replay [filters as for query] [--dry-run]
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+import env_utils
+import logging_utils
+import sms_queue
+
+ARCHIVE_STATES = ("sent", "failed")
+ARCHIVE_DIRNAME = "archive"
+# Where a message was going and where it came from: routed copies keep their chat, bot or webhook.
+REPLAYED_FIELDS = ("chat_id", "destination", "bot", "webhook", "modem")
+_SEGMENT_NAME = re.compile(r"^(?P<state>[a-z]+)-(?P<day>\d{4}-\d{2}-\d{2})\.jsonl\.gz$")
+
+
+@dataclass
+class RetentionPolicy:
+    """Limits applied per finished state; a zero limit disables that check."""
+
+    max_age_days: float = 30.0
+    max_items: int = 10000
+    batch_size: int = 500
+    archive_days: float = 0.0
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        return cls(
+            max_age_days=env_utils.get_float_env("QUEUE_RETENTION_DAYS", cls.max_age_days),
+            max_items=env_utils.get_int_env("QUEUE_RETENTION_MAX_ITEMS", cls.max_items),
+            batch_size=max(1, env_utils.get_int_env("QUEUE_RETENTION_BATCH", cls.batch_size)),
+            archive_days=env_utils.get_float_env("QUEUE_ARCHIVE_DAYS", cls.archive_days),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age_days > 0 or self.max_items > 0
+
+
+def resolve_archive_dir(env=os.getenv) -> Path:
+    return sms_queue.resolve_queue_dir(env) / ARCHIVE_DIRNAME
+
+
+def message_timestamp(item: sms_queue.QueueItem) -> float | None:
+    """Receive time of an item: ``received_at`` or, failing that, the id's time prefix."""
+    received_at = (item.payload or {}).get("received_at")
+    if isinstance(received_at, (int, float)):
+        return float(received_at)
+    prefix = item.id.split("-", 1)[0]
+    if not prefix.isdigit():
+        return None
+    # Ids carry milliseconds (13 digits) or microseconds (16 digits).
+    return int(prefix) / (1000.0 if len(prefix) <= 13 else 1000000.0)
+
+
+def select_expired(
+    queue: sms_queue.QueueBackend, state: str, policy: RetentionPolicy, now: float
+) -> List[sms_queue.QueueItem]:
+    """Return the oldest items of ``state`` that exceed the count or age limit, at most one batch."""
+    excess = max(0, queue.count(state) - policy.max_items) if policy.max_items > 0 else 0
+    cutoff = now - policy.max_age_days * 86400 if policy.max_age_days > 0 else None
+    selected = []
+    for index, item in enumerate(queue.oldest(state, policy.batch_size)):
+        timestamp = message_timestamp(item)
+        expired = cutoff is not None and timestamp is not None and timestamp < cutoff
+        if index >= excess and not expired:
+            # Items are in arrival order, so nothing after this one is older.
+            break
+        selected.append(item)
+    return selected
+
+
+def _segment_day(timestamp: float | None) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp if timestamp is not None else time.time()))
+
+
+def archive_items(archive_dir: Path, state: str, items: Iterable[sms_queue.QueueItem]) -> int:
+    """Append ``items`` to their daily segments and fsync them before returning."""
+    by_day: Dict[str, List[Dict[str, object]]] = {}
+    archived_at = time.time()
+    for item in items:
+        record = dict(item.payload) if item.payload is not None else {"id": item.id, "unreadable": True}
+        record.setdefault("id", item.id)
+        record["state"] = state
+        record["archived_at"] = archived_at
+        by_day.setdefault(_segment_day(message_timestamp(item)), []).append(record)
+    if not by_day:
+        return 0
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for day, records in sorted(by_day.items()):
+        path = archive_dir / f"{state}-{day}.jsonl.gz"
+        lines = "".join(json.dumps(record, ensure_ascii=True) + "\n" for record in records)
+        # Every append is its own gzip member; gzip readers concatenate them.
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as handle:
+                handle.write(lines.encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+        count += len(records)
+    sms_queue._fsync_dir(archive_dir)
+    return count
+
+
+def prune_segments(archive_dir: Path, max_age_days: float, now: float) -> int:
+    if max_age_days <= 0 or not archive_dir.is_dir():
+        return 0
+    cutoff_day = _segment_day(now - max_age_days * 86400)
+    removed = 0
+    for path in archive_dir.iterdir():
+        match = _SEGMENT_NAME.match(path.name)
+        if match and match.group("day") < cutoff_day:
+            path.unlink()
+            removed += 1
+    return removed
+
+
+def compact_once(
+    queue: sms_queue.QueueBackend,
+    archive_dir: Path,
+    policy: RetentionPolicy,
+    now: float | None = None,
+) -> int:
+    """Archive and purge at most one batch per finished state; returns the number of items moved."""
+    now = time.time() if now is None else now
+    moved = 0
+    for state in ARCHIVE_STATES:
+        items = select_expired(queue, state, policy, now)
+        if not items:
+            continue
+        archive_items(archive_dir, state, items)
+        queue.purge(items)
+        moved += len(items)
+    prune_segments(archive_dir, policy.archive_days, now)
+    if moved:
+        logging.info("Archived %s finished messages to %s", moved, archive_dir)
+    return moved
+
+
+def iter_archive(
+    archive_dir: Path,
+    states: Iterable[str] = ARCHIVE_STATES,
+    since: str | None = None,
+    until: str | None = None,
+) -> Iterator[Dict[str, object]]:
+    """Yield archived records in segment order; ``since``/``until`` are inclusive YYYY-MM-DD days."""
+    if not archive_dir.is_dir():
+        return
+    wanted = set(states)
+    segments = []
+    for path in archive_dir.iterdir():
+        match = _SEGMENT_NAME.match(path.name)
+        if not match or match.group("state") not in wanted:
+            continue
+        day = match.group("day")
+        if (since and day < since) or (until and day > until):
+            continue
+        segments.append((day, match.group("state"), path))
+    for _, _, path in sorted(segments):
+        with gzip.open(path, "rt", encoding="utf-8") as handle:
+            for line in handle:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def record_matches(record: Dict[str, object], number: str | None = None, text: str | None = None) -> bool:
+    if number and not str(record.get("number", "")).startswith(number):
+        return False
+    if text and text.lower() not in str(record.get("text", "")).lower():
+        return False
+    return True
+
+
+def replay(queue: sms_queue.QueueBackend, records: Iterable[Dict[str, object]]) -> int:
+    """Enqueue archived messages again as new pending items, still addressed as they were routed."""
+    payloads = []
+    for record in records:
+        number, text = record.get("number"), record.get("text")
+        if not isinstance(number, str) or not isinstance(text, str):
+            continue
+        payload = sms_queue.build_payload(number, text)
+        payload.update(
+            {field: record[field] for field in REPLAYED_FIELDS if isinstance(record.get(field), str) and record[field]}
+        )
+        payloads.append(payload)
+    return len(queue.enqueue_payloads(payloads))
+
+
+def _add_filters(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--state", action="append", choices=ARCHIVE_STATES, help="state to search (repeatable)")
+    parser.add_argument("--since", help="first day to include (YYYY-MM-DD, UTC)")
+    parser.add_argument("--until", help="last day to include (YYYY-MM-DD, UTC)")
+    parser.add_argument("--number", help="sender number prefix")
+    parser.add_argument("--text", help="case-insensitive text substring")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many matches")
+
+
+def _filtered(archive_dir: Path, args: argparse.Namespace) -> Iterator[Dict[str, object]]:
+    matched = 0
+    for record in iter_archive(archive_dir, args.state or ARCHIVE_STATES, args.since, args.until):
+        if not record_matches(record, args.number, args.text):
+            continue
+        yield record
+        matched += 1
+        if args.limit and matched >= args.limit:
+            return
+
+
+def main(argv: List[str] | None = None) -> None:
+    logging_utils.configure_logging()
+    parser = argparse.ArgumentParser(description="Queue retention and archive tools")
+    parser.add_argument("--archive-dir", type=Path, help="archive directory (default: <queue dir>/archive)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compact = commands.add_parser("compact", help="archive sent/failed items beyond the retention limits")
+    compact.add_argument("--all", action="store_true", help="keep going until nothing is left to archive")
+    _add_filters(commands.add_parser("query", help="print archived messages as JSON lines"))
+    replay_parser = commands.add_parser("replay", help="enqueue archived messages again")
+    _add_filters(replay_parser)
+    replay_parser.add_argument("--dry-run", action="store_true", help="only count the matching messages")
+    args = parser.parse_args(argv)
+
+    archive_dir = args.archive_dir or resolve_archive_dir()
+    if args.command == "query":
+        for record in _filtered(archive_dir, args):
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return
+
+    queue = sms_queue.open_queue()
+    try:
+        if args.command == "compact":
+            policy = RetentionPolicy.from_env()
+            total = 0
+            while True:
+                moved = compact_once(queue, archive_dir, policy)
+                total += moved
+                if not args.all or not moved:
+                    break
+            logging.info("Compaction archived %s messages", total)
+        elif args.dry_run:
+            logging.info("Would replay %s messages", sum(1 for _ in _filtered(archive_dir, args)))
+        else:
+            logging.info("Replayed %s messages", replay(queue, _filtered(archive_dir, args)))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Wake the queue worker when new files land in a spool directory."""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+from pathlib import Path
+from typing import List
+
+WATCH_MODES = ("auto", "inotify", "poll")
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+class PollingWatcher:
+    """Fallback watcher: sleeps for the poll interval unless woken explicitly."""
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+
+    def wait(self, timeout: float) -> List[str]:
+        self._event.wait(timeout)
+        self._event.clear()
+        return []
+
+    def wake(self) -> None:
+        self._event.set()
+
+    def close(self) -> None:
+        self._event.set()
+
+
+class InotifyWatcher:
+    """Block until files are renamed into (or written in) ``path`` using Linux inotify."""
+
+    def __init__(self, path: Path) -> None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        libc = _load_libc()
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        watch = libc.inotify_add_watch(fd, os.fsencode(str(path)), IN_MOVED_TO | IN_CLOSE_WRITE)
+        if watch < 0:
+            error = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(error, os.strerror(error), str(path))
+        self._fd = fd
+        self._wake_r, self._wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def wait(self, timeout: float) -> List[str]:
+        """Return the names that arrived, or an empty list on timeout or wake-up.
+
+        A queue overflow is reported as ``["*"]`` so callers know to rescan.
+        """
+        readable, _, _ = select.select([self._fd, self._wake_r], [], [], max(0.0, timeout))
+        if self._wake_r in readable:
+            self._drain_pipe()
+        if self._fd in readable:
+            return self._read_events()
+        return []
+
+    def wake(self) -> None:
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        for fd in (self._fd, self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _drain_pipe(self) -> None:
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_events(self) -> List[str]:
+        names: List[str] = []
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                raw_name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    names.append("*")
+                elif raw_name:
+                    names.append(os.fsdecode(raw_name))
+
+
+def normalize_watch_mode(value: str | None) -> str:
+    mode = (value or "auto").strip().lower()
+    if mode in WATCH_MODES:
+        return mode
+    logging.warning("Unknown QUEUE_WATCH=%r; defaulting to auto", value)
+    return "auto"
+
+
+def open_watcher(path: Path, mode: str = "auto") -> InotifyWatcher | PollingWatcher:
+    """Prefer inotify unless ``mode`` is ``poll``; fall back to polling if it is unavailable."""
+    if mode == "poll":
+        return PollingWatcher()
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError) as exc:
+        logging.warning("inotify unavailable for %s (%s); falling back to polling", path, exc)
+        return PollingWatcher()
@@ -2,132 +2,715 @@
 """Worker that delivers queued SMS messages to Telegram."""
 from __future__ import annotations
 
-import json
 import logging
 import os
+import random
+import sqlite3
+import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Dict
-
-import requests
+from typing import Callable, Dict, List, Set, Tuple
 
+import dedup
+import env_utils
+import health
 import logging_utils
+import metrics
+import queue_retention
+import queue_watch
+import rate_limit
+import routing
 import sms_queue
-from on_receive import build_telegram_payload, get_env
+import telegram_client
+from on_receive import (
+    TELEGRAM_TEXT_LIMIT,
+    build_telegram_batch_payload,
+    build_telegram_payload,
+    build_telegram_payloads,
+    get_env,
+)
+
+DEFAULT_MAX_RETRY_DELAY = 300.0
+LEDGER_EVICTION_INTERVAL = 3600.0
+WORKER_MODES = ("threads", "async")
+
+
+def send_once(bot_token: str, chat_id: str, number: str, text: str) -> None:
+    """Deliver one message; raises on any request or API error."""
+    payload = build_telegram_payload(chat_id, number, text)
+    telegram_client.send_message(bot_token, payload)
+
+
+def send_parts(bot_token: str, chat_id: str, payload: Dict[str, object]) -> None:
+    """Deliver an SMS too long for one Telegram message as numbered parts; raises on any error.
+
+    ``parts_sent`` in the queue payload counts the parts already delivered,
+    so a retry continues after them instead of repeating them.
+    """
+    messages = build_telegram_payloads(chat_id, str(payload["number"]), str(payload["text"]))
+    for index in range(int(payload.get("parts_sent") or 0), len(messages)):
+        telegram_client.send_message(bot_token, messages[index])
+        payload["parts_sent"] = index + 1
+
+
+def send_batch(bot_token: str, chat_id: str, payloads: List[Dict[str, object]]) -> None:
+    """Deliver several messages as one Telegram message; raises on any request or API error."""
+    messages = [(str(payload["number"]), str(payload["text"])) for payload in payloads]
+    telegram_client.send_message(bot_token, build_telegram_batch_payload(chat_id, messages))
+
+
+def compute_backoff(
+    attempts: int,
+    base_delay: float,
+    max_delay: float,
+    retry_after: float | None = None,
+    rng: Callable[[], float] = random.random,
+) -> float:
+    """Delay before the next attempt: exponential with equal jitter, or the server's retry_after."""
+    if retry_after is not None and retry_after > 0:
+        return float(retry_after)
+    exponent = min(max(attempts - 1, 0), 32)
+    delay = min(max_delay, base_delay * (2**exponent))
+    return delay / 2 + rng() * delay / 2
+
+
+def is_due(payload: Dict[str, object], now: float) -> bool:
+    next_attempt_at = payload.get("next_attempt_at")
+    if not isinstance(next_attempt_at, (int, float)):
+        return True
+    return next_attempt_at <= now
+
+
+def resolve_chat_id(payload: Dict[str, object], default_chat_id: str) -> str:
+    chat_id = payload.get("chat_id")
+    if isinstance(chat_id, str) and chat_id:
+        return chat_id
+    return default_chat_id
+
 
+def lane_key(payload: Dict[str, object], default_chat_id: str) -> str:
+    """Deliveries sharing a key are made in order: one lane per routed destination or chat."""
+    return sms_queue.lane_of(payload, default_chat_id)
 
-def _get_int_env(name: str, default: int) -> int:
-    value = os.getenv(name)
-    if value is None:
-        return default
+
+def resolve_bot_token(payload: Dict[str, object], bot_token: str, router: routing.Router | None) -> str:
+    bot = payload.get("bot")
+    if not isinstance(bot, str) or not bot:
+        return bot_token
+    if router is None:
+        raise ValueError(f"Message is routed to bot {bot!r} but no routing rules are loaded")
+    return router.bot_token(bot)
+
+
+def fan_out_item(queue: sms_queue.QueueBackend, item: sms_queue.QueueItem, router: routing.Router) -> bool:
+    """Replace a claimed, unrouted item by one queue item per destination; returns whether it did.
+
+    Each destination is then delivered, retried and failed on its own, so a
+    slow or broken destination never holds back the others.
+    """
+    payload = item.payload
+    if payload.get("destination") or payload.get("chat_id"):
+        return False
+    children = router.fan_out(payload)
+    if children is None:
+        return False
     try:
-        return int(value)
-    except ValueError:
-        logging.warning("Invalid %s=%r; using %s", name, value, default)
-        return default
+        queue.enqueue_payloads(children)
+    except Exception as exc:
+        logging.error("Fan-out of %s failed: %s", item.id, exc)
+        queue.release(item)
+        return True
+    queue.ack(item)
+    logging.info("Routed SMS from %s to %s destination(s)", payload["number"], len(children))
+    return True
+
+
+class DeliveryPool:
+    """Run deliveries on a thread pool with one in-order lane per chat."""
+
+    def __init__(self, size: int, on_done: Callable[[], None] | None = None) -> None:
+        self.size = max(1, size)
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="delivery")
+        self._lock = threading.Lock()
+        self._lanes: Dict[str, Future] = {}
+        self._on_done = on_done
+
+    def busy(self, chat_id: str) -> bool:
+        with self._lock:
+            return chat_id in self._lanes
+
+    def submit(self, chat_id: str, fn: Callable[..., None], *args: object) -> None:
+        with self._lock:
+            if chat_id in self._lanes:
+                raise RuntimeError(f"Lane for chat {chat_id} is already running")
+            future = self._executor.submit(fn, *args)
+            self._lanes[chat_id] = future
+        future.add_done_callback(lambda done, key=chat_id: self._release(key, done))
+
+    def _release(self, chat_id: str, future: Future) -> None:
+        with self._lock:
+            if self._lanes.get(chat_id) is future:
+                del self._lanes[chat_id]
+        exc = future.exception()
+        if exc is not None:
+            logging.error("Delivery lane for chat %s crashed: %s", chat_id, exc)
+        if self._on_done is not None:
+            self._on_done()
+
+    def drain(self) -> None:
+        with self._lock:
+            running = list(self._lanes.values())
+        wait(running)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
 
+def has_message_fields(payload: Dict[str, object] | None) -> bool:
+    return isinstance(payload, dict) and isinstance(payload.get("number"), str) and isinstance(payload.get("text"), str)
 
-def _get_float_env(name: str, default: float) -> float:
-    value = os.getenv(name)
-    if value is None:
-        return default
+
+def claim_item(queue: sms_queue.QueueBackend, item: sms_queue.QueueItem) -> sms_queue.QueueItem | None:
+    claimed = queue.claim(item)
+    if claimed is None:
+        return None
+    if not has_message_fields(claimed.payload):
+        logging.error("Invalid queue payload %s: missing number/text fields", claimed.id)
+        queue.fail(claimed)
+        return None
+    return claimed
+
+
+def permanent_failure(exc: Exception) -> bool:
+    """Whether ``exc`` is a 4xx answer that sending the same request again cannot change.
+
+    That is a Bot API 400 or 403 (chat not found, message too long, bot
+    blocked) or any webhook 4xx. 408 and 429 are worth retrying, and so are
+    the Bot API's 401 and 404: a bad token or API URL fails every message
+    alike, so they wait for the fix instead of all ending in failed.
+    """
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if not isinstance(status, int) or not 400 <= status < 500 or status in (408, 429):
+        return False
+    return not isinstance(exc, telegram_client.TelegramAPIError) or status not in (401, 404)
+
+
+def schedule_retry(
+    queue: sms_queue.QueueBackend,
+    item: sms_queue.QueueItem,
+    exc: Exception,
+    max_attempts: int,
+    retry_delay: float,
+    max_delay: float,
+) -> bool:
+    """Reschedule ``item`` after ``exc``, or fail it for good; returns whether it was rescheduled."""
+    payload = item.payload
+    attempts = int(payload.get("attempts") or 0) + 1
+    payload["attempts"] = attempts
+    payload["last_error"] = str(exc)[:500]
+    permanent = permanent_failure(exc)
+    if permanent or (max_attempts > 0 and attempts >= max_attempts):
+        payload.pop("next_attempt_at", None)
+        if permanent:
+            logging.warning("Delivery rejected: %s; not retrying", exc, extra=log_fields(item, attempts))
+        else:
+            logging.warning(
+                "Delivery failed (%s/%s): %s; giving up", attempts, max_attempts, exc, extra=log_fields(item, attempts)
+            )
+        metrics.FAILED.inc()
+        queue.fail(item)
+        return False
+    delay = compute_backoff(attempts, retry_delay, max_delay, getattr(exc, "retry_after", None))
+    payload["next_attempt_at"] = time.time() + delay
+    limit = max_attempts if max_attempts > 0 else "inf"
+    logging.warning(
+        "Delivery failed (%s/%s): %s; retrying in %.1fs", attempts, limit, exc, delay, extra=log_fields(item, attempts)
+    )
+    metrics.RETRIES.inc()
+    queue.retry(item)
+    return True
+
+
+def log_fields(item: sms_queue.QueueItem, attempt: int | None = None) -> Dict[str, object]:
+    """``extra=`` for log lines about ``item``, picked up by ``LOG_FORMAT=json``."""
+    fields = logging_utils.message_fields(item.id, item.payload.get("number"), item.payload.get("received_at"))
+    if attempt is not None:
+        fields["attempt"] = attempt
+    return fields
+
+
+def skip_duplicate(queue: sms_queue.QueueBackend, item: sms_queue.QueueItem, chat_id: str) -> bool:
+    """Ack a claimed item without sending it if the delivery ledger shows it was already delivered."""
+    ledger = dedup.get_ledger()
+    if ledger is None:
+        return False
     try:
-        return float(value)
-    except ValueError:
-        logging.warning("Invalid %s=%r; using %s", name, value, default)
-        return default
+        if ledger.delivered(item.id):
+            reason = "delivered"
+            logging.warning("Message %s was already delivered; not sending it again", item.id, extra=log_fields(item))
+        elif ledger.duplicate_of(item.payload, lane_key(item.payload, chat_id)) is not None:
+            reason = "content"
+            logging.warning(
+                "Message %s repeats an SMS from %s delivered just before",
+                item.id,
+                item.payload["number"],
+                extra=log_fields(item),
+            )
+        else:
+            return False
+    except sqlite3.Error as exc:
+        logging.error("Delivery ledger lookup failed: %s", exc)
+        return False
+    metrics.DUPLICATES.inc(reason=reason)
+    queue.ack(item)
+    return True
+
+
+def settle_delivered(queue: sms_queue.QueueBackend, items: List[sms_queue.QueueItem], chat_id: str) -> None:
+    """Record the delivered items in the ledger, then move them to sent."""
+    ledger = dedup.get_ledger()
+    if ledger is not None:
+        try:
+            ledger.record((item.id, item.payload, lane_key(item.payload, chat_id)) for item in items)
+        except sqlite3.Error as exc:
+            logging.error("Recording delivery in the ledger failed: %s", exc)
+    for item in items:
+        queue.ack(item)
+        record_delivery(item.payload)
+        logging.info("Delivered SMS from %s", item.payload["number"], extra=log_fields(item))
+    if len(items) > 1:
+        logging.info("Delivered %s SMS in one message", len(items))
+    heartbeat = health.get_heartbeat()
+    if heartbeat is not None:
+        heartbeat.beat(delivered=len(items))
+
 
+def record_delivery(payload: Dict[str, object]) -> None:
+    metrics.DELIVERED.inc()
+    modem = payload.get("modem")
+    if isinstance(modem, str) and modem:
+        metrics.MODEM_DELIVERED.inc(modem=modem)
+    received_at = payload.get("received_at")
+    if isinstance(received_at, (int, float)):
+        metrics.DELIVERY_LATENCY_SECONDS.observe(max(0.0, time.time() - received_at))
 
-def send_with_retries(
+
+def deliver_item(
+    queue: sms_queue.QueueBackend,
+    item: sms_queue.QueueItem,
     bot_token: str,
     chat_id: str,
-    number: str,
-    text: str,
     max_attempts: int,
     retry_delay: float,
+    max_delay: float = DEFAULT_MAX_RETRY_DELAY,
+    router: routing.Router | None = None,
 ) -> bool:
-    max_attempts = max(1, max_attempts)
-    payload = build_telegram_payload(chat_id, number, text)
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    for attempt in range(1, max_attempts + 1):
-        try:
-            requests.post(url, json=payload, timeout=10).raise_for_status()
-            logging.info("Delivered SMS from %s", number)
-            return True
-        except Exception as exc:  # pragma: no cover - request error paths are mocked in tests
-            logging.warning("Delivery failed (%s/%s): %s", attempt, max_attempts, exc)
-            if attempt < max_attempts:
-                time.sleep(retry_delay)
-    return False
+    """Deliver one item; returns whether its lane may go on, i.e. it was not rescheduled."""
+    payload = item.payload
+    webhook = payload.get("webhook")
+    try:
+        if isinstance(webhook, str) and webhook:
+            routing.send_webhook(webhook, payload)
+        else:
+            token = resolve_bot_token(payload, bot_token, router)
+            if rendered_length(payload) <= TELEGRAM_TEXT_LIMIT:
+                send_once(token, resolve_chat_id(payload, chat_id), str(payload["number"]), str(payload["text"]))
+            else:
+                send_parts(token, resolve_chat_id(payload, chat_id), payload)
+    except Exception as exc:
+        return not schedule_retry(queue, item, exc, max_attempts, retry_delay, max_delay)
+    settle_delivered(queue, [item], chat_id)
+    return True
 
 
-def load_payload(path: Path) -> Dict[str, object]:
-    with open(path, "r", encoding="utf-8") as handle:
-        return json.load(handle)
+def rendered_length(payload: Dict[str, object]) -> int:
+    # Telegram applies its limit after HTML parsing: the header line plus the text.
+    return len(str(payload["number"])) + 1 + len(str(payload["text"]))
 
 
-def recover_processing(dirs: Dict[str, Path]) -> None:
-    processing_dir = dirs["processing"]
-    pending_dir = dirs["pending"]
-    for item in sorted(processing_dir.glob("*.json")):
-        try:
-            sms_queue.move_item(item, pending_dir)
-        except FileNotFoundError:
+def coalesce(
+    items: List[sms_queue.QueueItem], window: float, limit: int = TELEGRAM_TEXT_LIMIT
+) -> List[List[sms_queue.QueueItem]]:
+    """Split a chat's lane into groups of messages received within ``window`` seconds of the group's first.
+
+    A group never exceeds ``limit`` characters once rendered with a blank
+    line between messages. ``window`` <= 0 keeps every message on its own.
+    """
+    groups: List[List[sms_queue.QueueItem]] = []
+    length = 0
+    for item in items:
+        size = rendered_length(item.payload)
+        if groups and window > 0:
+            first = groups[-1][0].payload.get("received_at")
+            received = item.payload.get("received_at")
+            if (
+                isinstance(first, (int, float))
+                and isinstance(received, (int, float))
+                and received - first <= window
+                and length + 2 + size <= limit
+            ):
+                groups[-1].append(item)
+                length += 2 + size
+                continue
+        groups.append([item])
+        length = size
+    return groups
+
+
+def deliver_group(
+    queue: sms_queue.QueueBackend,
+    group: List[sms_queue.QueueItem],
+    bot_token: str,
+    chat_id: str,
+    max_attempts: int,
+    retry_delay: float,
+    max_delay: float = DEFAULT_MAX_RETRY_DELAY,
+    router: routing.Router | None = None,
+) -> bool:
+    """Deliver a coalesced group as one message; on failure only the head's retry state advances.
+
+    A merged message the API rejects outright is sent again one item at a
+    time, so that only the offending item fails.
+    """
+    if len(group) == 1:
+        return deliver_item(queue, group[0], bot_token, chat_id, max_attempts, retry_delay, max_delay, router)
+    head = group[0]
+    try:
+        token = resolve_bot_token(head.payload, bot_token, router)
+        send_batch(token, resolve_chat_id(head.payload, chat_id), [item.payload for item in group])
+    except Exception as exc:
+        if permanent_failure(exc):
+            for index, item in enumerate(group):
+                if not deliver_item(queue, item, bot_token, chat_id, max_attempts, retry_delay, max_delay, router):
+                    for rest in group[index + 1 :]:
+                        queue.release(rest)
+                    return False
+            return True
+        schedule_retry(queue, head, exc, max_attempts, retry_delay, max_delay)
+        for rest in group[1:]:
+            queue.release(rest)
+        return False
+    settle_delivered(queue, group, chat_id)
+    metrics.COALESCED.inc(len(group) - 1)
+    return True
+
+
+def deliver_lane(
+    queue: sms_queue.QueueBackend,
+    lane: List[sms_queue.QueueItem],
+    bot_token: str,
+    chat_id: str,
+    max_attempts: int,
+    retry_delay: float,
+    max_delay: float = DEFAULT_MAX_RETRY_DELAY,
+    coalesce_window: float = 0.0,
+    router: routing.Router | None = None,
+) -> None:
+    # Webhooks receive one request per SMS; only Telegram messages are merged.
+    groups = coalesce(lane, 0.0 if lane and lane[0].payload.get("webhook") else coalesce_window)
+    for index, group in enumerate(groups):
+        if deliver_group(queue, group, bot_token, chat_id, max_attempts, retry_delay, max_delay, router):
             continue
+        # The failed head is rescheduled; hand the rest back untouched so the
+        # chat is not delivered out of order.
+        for rest in groups[index + 1 :]:
+            for item in rest:
+                queue.release(item)
+        return
 
 
 def process_queue_once(
-    dirs: Dict[str, Path],
+    queue: sms_queue.QueueBackend,
     bot_token: str,
     chat_id: str,
     max_attempts: int,
     retry_delay: float,
+    pool: DeliveryPool | None = None,
+    max_delay: float = DEFAULT_MAX_RETRY_DELAY,
+    coalesce_window: float = 0.0,
+    router: routing.Router | None = None,
 ) -> bool:
-    pending_items = sorted(dirs["pending"].glob("*.json"))
-    if not pending_items:
-        return False
-    for item in pending_items:
-        try:
-            processing_item = sms_queue.move_item(item, dirs["processing"])
-        except FileNotFoundError:
+    """Run one pass over the pending items and return whether any delivery was started.
+
+    Items whose ``next_attempt_at`` lies in the future are skipped, and so is
+    everything queued behind them for the same chat. With ``coalesce_window``
+    > 0 the due items of each chat are merged into as few messages as
+    :func:`coalesce` allows. With a ``router``, new items are first fanned
+    out into one item per destination, picked up by the next pass.
+    """
+    now = time.time()
+    blocked: Set[str] = set()
+    lanes: Dict[str, List[sms_queue.QueueItem]] = {}
+    started = False
+    for item in queue.pending():
+        # ``meta`` carries the scheduling fields; for record files the body is
+        # only read for items that get claimed.
+        destination = lane_key(item.meta or {}, chat_id)
+        if destination in blocked or (pool is not None and pool.busy(destination)):
+            continue
+        if item.meta is not None and not is_due(item.meta, now):
+            blocked.add(destination)
+            continue
+        claimed = claim_item(queue, item)
+        if claimed is None or skip_duplicate(queue, claimed, chat_id):
+            continue
+        if router is not None and fan_out_item(queue, claimed, router):
+            started = True
             continue
+        destination = lane_key(claimed.payload, chat_id)
+        if pool is not None or coalesce_window > 0:
+            lanes.setdefault(destination, []).append(claimed)
+            continue
+        started = True
+        if not deliver_item(queue, claimed, bot_token, chat_id, max_attempts, retry_delay, max_delay, router):
+            blocked.add(destination)
+
+    # Items of a chat whose lane is still running stay pending so that a later
+    # pass picks them up behind the in-flight ones, preserving per-chat order.
+    for destination, lane in lanes.items():
+        args = (queue, lane, bot_token, chat_id, max_attempts, retry_delay, max_delay, coalesce_window, router)
+        if pool is not None:
+            pool.submit(destination, deliver_lane, *args)
+        else:
+            deliver_lane(*args)
+    return started or bool(lanes)
+
+
+def register_queue_metrics(queue: sms_queue.QueueBackend, registry: metrics.Registry = metrics.REGISTRY) -> None:
+    """Expose queue depth and the oldest pending message's age, computed at scrape time."""
+
+    def depth() -> Dict[tuple, int]:
+        return {(state,): count for state, count in queue.counts().items()}
+
+    def oldest_pending_age() -> float:
+        items = queue.oldest("pending", 1)
+        timestamp = queue_retention.message_timestamp(items[0]) if items else None
+        return max(0.0, time.time() - timestamp) if timestamp is not None else 0.0
+
+    registry.gauge("smsgw_queue_depth", "Queued messages by state.", depth, ["state"])
+    registry.gauge("smsgw_queue_oldest_pending_age_seconds", "Age of the oldest pending message.", oldest_pending_age)
+
+
+def run_retention(queue: sms_queue.QueueBackend, archive_dir: Path, policy: queue_retention.RetentionPolicy) -> int:
+    """Archive one batch of expired items; retention errors never stop delivery."""
+    try:
+        return queue_retention.compact_once(queue, archive_dir, policy)
+    except Exception as exc:
+        logging.error("Queue retention failed: %s", exc)
+        return 0
+
+
+def shard_arg(argv: List[str]) -> Tuple[int, int] | None:
+    """The ``--shard <index>/<count>`` option; raises ``ValueError`` when it is malformed."""
+    if "--shard" not in argv:
+        return None
+    position = argv.index("--shard") + 1
+    if position >= len(argv):
+        raise ValueError("--shard needs <index>/<count>")
+    return sms_queue.parse_shard(argv[position])
+
+
+def worker_limiter(workers: int, sharding: bool) -> rate_limit.RateLimiter:
+    """The share of the Bot API limits for one of ``workers`` processes.
+
+    The global budget belongs to the bot, so it is always split. A chat needs
+    its rate split only without sharding; otherwise one worker serves it.
+    """
+    share = 1.0 / workers
+    return rate_limit.RateLimiter.from_env(share=share, chat_share=1.0 if sharding else share)
+
+
+def metrics_port_for(port: int, shard: Tuple[int, int] | None) -> int:
+    """Each worker serves its own counters, worker ``i`` on ``port + i``; 0 keeps the endpoint off."""
+    if port <= 0 or shard is None:
+        return port
+    return port + shard[0]
+
+
+def keep_leases(queue: sms_queue.QueueBackend, lease: float, stop: threading.Event) -> None:
+    """Renew this worker's leases and re-queue items whose lease ran out, until ``stop`` is set.
+
+    Renewing three times per lease keeps a live worker's items safe through
+    a missed round or two; the items of a crashed worker are picked up at
+    most ``lease`` plus a third of it after its last renewal.
+    """
+    while not stop.wait(lease / 3):
         try:
-            payload = load_payload(processing_item)
-            number = payload.get("number")
-            text = payload.get("text")
-            if not isinstance(number, str) or not isinstance(text, str):
-                raise ValueError("Missing number/text fields")
+            queue.renew()
+            recovered = queue.recover(lease)
         except Exception as exc:
-            logging.error("Invalid queue payload %s: %s", processing_item, exc)
-            sms_queue.move_item(processing_item, dirs["failed"])
+            logging.error("Lease upkeep failed: %s", exc)
             continue
-        if send_with_retries(bot_token, chat_id, number, text, max_attempts, retry_delay):
-            sms_queue.move_item(processing_item, dirs["sent"])
-        else:
-            sms_queue.move_item(processing_item, dirs["failed"])
-    return True
+        if recovered:
+            logging.warning("Re-queued %s messages whose worker stopped renewing its lease", recovered)
 
 
-def run_worker() -> None:
-    logging.basicConfig(level=logging_utils.get_loglevel())
+def evict_ledger(ledger: dedup.DeliveryLedger) -> None:
+    try:
+        removed = ledger.evict()
+    except sqlite3.Error as exc:
+        logging.error("Delivery ledger eviction failed: %s", exc)
+        return
+    if removed:
+        logging.info("Evicted %s expired delivery ledger entries", removed)
+
+
+def normalize_worker_mode(value: str | None) -> str:
+    mode = (value or "threads").strip().lower()
+    if mode not in WORKER_MODES:
+        logging.warning("Unknown QUEUE_WORKER_MODE=%r, using threads", value)
+        return "threads"
+    return mode
+
+
+def run_worker(argv: List[str] | None = None) -> None:
+    logging_utils.configure_logging()
+    argv = sys.argv[1:] if argv is None else argv
+    if "--requeue-failed" in argv:
+        queue = sms_queue.open_queue()
+        try:
+            logging.info("Requeued %s failed messages", queue.requeue_failed())
+        finally:
+            queue.close()
+        return
     try:
         bot_token = get_env("TELEGRAM_BOT_TOKEN")
         chat_id = get_env("TELEGRAM_CHAT_ID")
     except EnvironmentError as exc:
         logging.error("%s", exc)
         raise SystemExit(1)
+    try:
+        router = routing.load_router(chat_id)
+    except (OSError, ValueError) as exc:
+        logging.error("Invalid routing rules: %s", exc)
+        raise SystemExit(1)
+
+    try:
+        shard = shard_arg(argv)
+    except ValueError as exc:
+        logging.error("%s", exc)
+        raise SystemExit(1)
+
+    # ``--shard <index>/<count>`` makes this one of ``count`` workers on the
+    # spool. processing/ then also holds the others' live items, so only
+    # those whose lease ran out are taken back.
+    workers = shard[1] if shard is not None else 1
+    lease = env_utils.get_float_env(sms_queue.LEASE_ENV, sms_queue.DEFAULT_LEASE_SECONDS)
+    shared = workers > 1 and lease > 0
+    sharding = workers > 1 and env_utils.get_bool_env("QUEUE_SHARDING", True)
+    queue = sms_queue.open_queue(shard=shard if sharding else None, default_chat_id=chat_id)
+    recovered = queue.recover(lease if shared else 0.0)
+    if recovered:
+        logging.info("Recovered %s in-flight messages", recovered)
+    if workers > 1:
+        # The Bot API limits apply to the bot, not to each process.
+        rate_limit.set_limiter(worker_limiter(workers, sharding))
+    # Retention and the spool-wide metrics run once per spool, in the first worker.
+    primary = shard is None or shard[0] == 0
+
+    poll_interval = env_utils.get_float_env("QUEUE_POLL_INTERVAL", 2.0)
+    max_attempts = env_utils.get_int_env("QUEUE_MAX_RETRIES", 5)
+    retry_delay = env_utils.get_float_env("QUEUE_RETRY_DELAY", 5.0)
+    max_delay = env_utils.get_float_env("QUEUE_RETRY_MAX_DELAY", DEFAULT_MAX_RETRY_DELAY)
+    concurrency = env_utils.get_int_env("QUEUE_CONCURRENCY", 1)
+    worker_mode = normalize_worker_mode(os.getenv("QUEUE_WORKER_MODE"))
+    coalesce_window = env_utils.get_float_env("QUEUE_COALESCE_WINDOW", 0.0)
+    retention = queue_retention.RetentionPolicy.from_env()
+    retention_interval = env_utils.get_float_env("QUEUE_RETENTION_INTERVAL", 300.0)
+    archive_dir = queue_retention.resolve_archive_dir()
+    next_compaction = time.monotonic()
+    try:
+        ledger = dedup.open_ledger()
+    except sqlite3.Error as exc:
+        logging.error("Cannot open the delivery ledger: %s", exc)
+        raise SystemExit(1)
+    dedup.set_ledger(ledger)
+    next_eviction = time.monotonic()
+    heartbeat = None
+    if health.health_enabled():
+        heartbeat = health.Heartbeat(
+            health.resolve_state_dir() / health.heartbeat_name(shard),
+            env_utils.get_float_env("HEALTH_HEARTBEAT_INTERVAL", health.DEFAULT_HEARTBEAT_INTERVAL),
+        )
+        health.set_heartbeat(heartbeat)
 
-    base_dir = sms_queue.resolve_queue_dir()
-    dirs = sms_queue.ensure_queue_dirs(base_dir)
-    recover_processing(dirs)
+    # The watcher wakes the loop as soon as a new item lands in the queue or a
+    # delivery lane finishes; the poll interval is only a backstop.
+    watch_mode = queue_watch.normalize_watch_mode(os.getenv("QUEUE_WATCH"))
+    watcher = queue_watch.open_watcher(queue.watch_dir, watch_mode) if queue.watch_dir else queue_watch.PollingWatcher()
+    pool = DeliveryPool(concurrency, on_done=watcher.wake) if concurrency > 1 and worker_mode == "threads" else None
+    # With inotify reporting arrivals the pending items are kept in memory;
+    # polling alone would miss items that other processes enqueue.
+    indexed = isinstance(watcher, queue_watch.InotifyWatcher) and queue.index_pending(
+        env_utils.get_float_env(sms_queue.INDEX_RESCAN_ENV, sms_queue.DEFAULT_INDEX_RESCAN)
+    )
+    metrics_server = None
+    metrics_port = metrics_port_for(env_utils.get_int_env(metrics.METRICS_PORT_ENV, 0), shard)
+    if metrics_port > 0:
+        # Counters are per process; the spool-wide gauges are left to the
+        # first worker so that summing over the workers stays correct.
+        if primary:
+            register_queue_metrics(queue)
+            metrics.register_watchdog_metrics()
+        metrics_server = metrics.start_server(metrics_port, os.getenv(metrics.METRICS_ADDR_ENV) or "0.0.0.0")
+    stop_leases = threading.Event()
+    if shared:
+        threading.Thread(target=keep_leases, args=(queue, lease, stop_leases), name="leases", daemon=True).start()
 
-    poll_interval = _get_float_env("QUEUE_POLL_INTERVAL", 2.0)
-    max_attempts = _get_int_env("QUEUE_MAX_RETRIES", 5)
-    retry_delay = _get_float_env("QUEUE_RETRY_DELAY", 5.0)
+    def housekeeping() -> None:
+        nonlocal next_compaction, next_eviction
+        if heartbeat is not None:
+            heartbeat.beat()
+        if primary and retention.enabled and retention_interval > 0 and time.monotonic() >= next_compaction:
+            run_retention(queue, archive_dir, retention)
+            next_compaction = time.monotonic() + retention_interval
+        if primary and ledger is not None and time.monotonic() >= next_eviction:
+            evict_ledger(ledger)
+            next_eviction = time.monotonic() + LEDGER_EVICTION_INTERVAL
+
+    try:
+        if worker_mode == "async":
+            import async_worker
 
-    while True:
-        if not process_queue_once(dirs, bot_token, chat_id, max_attempts, retry_delay):
-            time.sleep(poll_interval)
+            async_worker.run(
+                queue,
+                watcher,
+                housekeeping,
+                bot_token,
+                chat_id,
+                max_attempts,
+                retry_delay,
+                max_delay,
+                coalesce_window,
+                router,
+                poll_interval,
+                indexed,
+            )
+            return
+        while True:
+            housekeeping()
+            if not process_queue_once(
+                queue, bot_token, chat_id, max_attempts, retry_delay, pool, max_delay, coalesce_window, router
+            ):
+                queue.flush()
+                queue.arrived(watcher.wait(poll_interval))
+            elif indexed:
+                # Take in arrivals between busy passes without blocking.
+                queue.arrived(watcher.wait(0))
+    finally:
+        stop_leases.set()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if pool is not None:
+            pool.shutdown()
+        watcher.close()
+        queue.close()
+        health.set_heartbeat(None)
+        if ledger is not None:
+            dedup.set_ledger(None)
+            ledger.close()
 
 
 if __name__ == "__main__":  # pragma: no cover
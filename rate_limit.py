@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Token-bucket rate limiting for Bot API sends: one global bucket plus one bucket per chat.
+
+Telegram allows roughly 30 messages per second per bot and about one per
+second per chat (20 per minute in groups). Callers reserve a token from both
+buckets before each send and sleep until the reservation is due, so a busy
+queue drains at the configured rates instead of bursting into 429s. A 429's
+``retry_after`` pauses the affected chat until the server's deadline.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict
+
+import env_utils
+
+DEFAULT_GLOBAL_RATE = 25.0
+DEFAULT_CHAT_RATE = 1.0
+DEFAULT_CHAT_BURST = 3.0
+_MAX_IDLE_BUCKETS = 1000
+
+
+class TokenBucket:
+    """Reservation-based token bucket; not thread-safe on its own.
+
+    ``reserve`` always takes a token, letting the balance go negative, and
+    returns how long the caller has to wait for it. Concurrent callers are
+    therefore spaced ``1 / rate`` apart instead of all waking at once.
+    """
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, now: float) -> float:
+        start = max(now, self.blocked_until)
+        self._refill(start)
+        self.tokens -= 1.0
+        wait = start - now
+        if self.tokens < 0:
+            wait += -self.tokens / self.rate
+        return wait
+
+    def block(self, until: float) -> None:
+        """Hand out nothing before ``until`` and start again from an empty bucket."""
+        if until > self.blocked_until:
+            self.blocked_until = until
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = until
+
+    def idle(self, now: float) -> bool:
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Global and per-chat token buckets shared by every delivery path of a process.
+
+    A rate of 0 disables that bucket.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = DEFAULT_GLOBAL_RATE,
+        global_burst: float | None = None,
+        chat_rate: float = DEFAULT_CHAT_RATE,
+        chat_burst: float = DEFAULT_CHAT_BURST,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        now = clock()
+        burst = global_burst if global_burst is not None else global_rate
+        self._global = TokenBucket(global_rate, burst, now) if global_rate > 0 else None
+        self._chats: Dict[str, TokenBucket] = {}
+
+    @classmethod
+    def from_env(cls, share: float = 1.0, chat_share: float = 1.0) -> "RateLimiter":
+        """Limiter configured from the environment for one of several processes.
+
+        ``share`` scales the global rate and burst, ``chat_share`` the per-chat
+        rate, which only needs a cut when a chat can be served by several of them.
+        """
+        global_rate = env_utils.get_float_env("TELEGRAM_RATE_GLOBAL", DEFAULT_GLOBAL_RATE)
+        return cls(
+            global_rate=global_rate * share,
+            global_burst=env_utils.get_float_env("TELEGRAM_RATE_GLOBAL_BURST", global_rate) * share,
+            chat_rate=env_utils.get_float_env("TELEGRAM_RATE_CHAT", DEFAULT_CHAT_RATE) * chat_share,
+            chat_burst=env_utils.get_float_env("TELEGRAM_RATE_CHAT_BURST", DEFAULT_CHAT_BURST),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self._global is not None or self.chat_rate > 0
+
+    def _chat_bucket(self, chat_id: str, now: float) -> TokenBucket | None:
+        if self.chat_rate <= 0:
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_IDLE_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def reserve(self, chat_id: str) -> float:
+        """Reserve one send for ``chat_id`` and return the seconds to wait before making it."""
+        with self._lock:
+            now = self._clock()
+            wait = self._global.reserve(now) if self._global is not None else 0.0
+            bucket = self._chat_bucket(chat_id, now)
+            if bucket is not None:
+                wait = max(wait, bucket.reserve(now))
+            return wait
+
+    def acquire(self, chat_id: str) -> float:
+        """Block until a send to ``chat_id`` is allowed; returns the time slept."""
+        if not self.enabled:
+            return 0.0
+        wait = self.reserve(chat_id)
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def penalize(self, chat_id: str, retry_after: float) -> None:
+        """Apply a 429 ``retry_after``: no sends to ``chat_id`` before the server's deadline."""
+        if retry_after <= 0:
+            return
+        with self._lock:
+            now = self._clock()
+            bucket = self._chat_bucket(chat_id, now)
+            if bucket is not None:
+                bucket.block(now + retry_after)
+
+
+_limiter: RateLimiter | None = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> RateLimiter:
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter.from_env()
+        return _limiter
+
+
+def set_limiter(limiter: RateLimiter | None) -> None:
+    """Replace the process-wide limiter; ``None`` re-reads the environment on next use."""
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
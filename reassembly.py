@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Multipart SMS reassembly: incremental text normalization, concatenation index and splitting.
+
+Only the standard library is imported, because the receive hook loads this
+module once per SMS.
+
+* ``TextBuilder`` normalizes the parts of a message one at a time, exactly
+  as ``on_receive.clean_text`` normalizes their concatenation. It stops
+  consuming input once ``limit`` characters are out, so the work and memory
+  per message are bounded however long the input is.
+* ``ConcatIndex`` collects the segments of concatenated SMS by the
+  reference in their user data header (UDH). Segments that arrive out of
+  order, or after gammu's ``MultipartTimeout``, end up in the same message.
+* ``split_text`` cuts a long text into pieces for several Telegram
+  messages, preferring line and word boundaries.
+"""
+from __future__ import annotations
+
+import re
+import time
+from typing import Callable, Dict, Generic, Hashable, Iterable, List, Tuple, TypeVar
+
+# The longest concatenated SMS: 255 segments of 153 GSM 7-bit characters.
+MAX_TEXT_LENGTH = 255 * 153
+DEFAULT_MULTIPART_TIMEOUT = 600.0
+DEFAULT_MAX_OPEN = 1000
+
+_LONE_NEWLINE = re.compile(r"\n(?!\n)")
+_SPACE_RUN = re.compile(r" {2,}")
+
+T = TypeVar("T")
+
+
+def _normalize(text: str) -> str:
+    return _SPACE_RUN.sub(" ", _LONE_NEWLINE.sub(" ", text))
+
+
+class TextBuilder:
+    """Fold single line breaks and repeated spaces in text fed chunk by chunk.
+
+    Whether a trailing newline folds and whether trailing spaces collapse
+    depends on what follows, so only the trailing run of spaces and newlines
+    is held back; everything before it is final once fed.
+    """
+
+    def __init__(self, limit: int = MAX_TEXT_LENGTH) -> None:
+        self.limit = limit
+        self._chunks: List[str] = []
+        self._length = 0
+        self._tail = ""
+        self._started = False
+
+    @property
+    def full(self) -> bool:
+        return self._length >= self.limit
+
+    def feed(self, chunk: str) -> bool:
+        """Add ``chunk``; returns ``False`` once the limit is reached and further input would be dropped."""
+        if self.full:
+            return False
+        if not self._started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return True
+            self._started = True
+        data = self._tail + chunk
+        body = data.rstrip(" \n")
+        self._tail = data[len(body) :]
+        if body:
+            body = _normalize(body)
+            self._chunks.append(body)
+            self._length += len(body)
+        return not self.full
+
+    def text(self) -> str:
+        return ("".join(self._chunks) + _normalize(self._tail) or "(empty)")[: self.limit]
+
+
+def normalize_parts(parts: Iterable[str], limit: int = MAX_TEXT_LENGTH, separator: str = "") -> str:
+    """Join and normalize ``parts``, reading no further than needed for ``limit`` characters."""
+    builder = TextBuilder(limit)
+    first = True
+    for part in parts:
+        if not builder.feed(part if first else separator + part):
+            break
+        first = False
+    return builder.text()
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """Cut ``text`` into pieces of at most ``limit`` characters.
+
+    A piece ends at the last line break, or failing that the last space, in
+    its second half; otherwise it is cut hard. The whitespace at a cut is
+    dropped.
+    """
+    limit = max(1, limit)
+    pieces = []
+    while len(text) > limit:
+        window = text[: limit + 1]
+        cut = window.rfind("\n")
+        if cut < limit // 2:
+            cut = window.rfind(" ")
+        if cut < limit // 2:
+            pieces.append(text[:limit])
+            text = text[limit:]
+            continue
+        pieces.append(text[:cut])
+        text = text[cut + 1 :]
+    pieces.append(text)
+    return pieces
+
+
+def parse_concat_udh(udh: str | bytes) -> Tuple[int, int, int] | None:
+    """``(reference, total, sequence)`` from a UDH's concatenation element, or ``None``.
+
+    ``udh`` is the raw header or its hex form, length byte included. Both
+    the 8-bit (IEI 0x00) and the 16-bit (IEI 0x08) reference are understood.
+    """
+    if isinstance(udh, str):
+        try:
+            udh = bytes.fromhex(udh.strip())
+        except ValueError:
+            return None
+    if not udh:
+        return None
+    end = min(len(udh), udh[0] + 1)
+    offset = 1
+    while offset + 2 <= end:
+        iei, length = udh[offset], udh[offset + 1]
+        data = udh[offset + 2 : offset + 2 + length]
+        if len(data) < length:
+            return None
+        if iei == 0x00 and length == 3:
+            reference, total, sequence = data[0], data[1], data[2]
+        elif iei == 0x08 and length == 4:
+            reference, total, sequence = (data[0] << 8) | data[1], data[2], data[3]
+        else:
+            offset += 2 + length
+            continue
+        if total < 1 or not 1 <= sequence <= total:
+            return None
+        return reference, total, sequence
+    return None
+
+
+class ConcatMessage(Generic[T]):
+    """Segments of one concatenated SMS collected so far, with the items that carried them."""
+
+    __slots__ = ("key", "total", "items", "sequences", "started")
+
+    def __init__(self, key: Hashable, total: int, started: float) -> None:
+        self.key = key
+        self.total = total
+        self.items: List[T] = []
+        self.sequences: set = set()
+        self.started = started
+
+    @property
+    def complete(self) -> bool:
+        return len(self.sequences) >= self.total
+
+
+class ConcatIndex(Generic[T]):
+    """Open concatenated SMS keyed by sender and UDH reference.
+
+    ``add`` returns a message once all its segments are in. Messages still
+    missing segments ``timeout`` seconds after their first one, or the
+    oldest ones when more than ``max_open`` are open, come out of
+    ``expired`` as they are, so a lost segment cannot hold a message back
+    forever or let the index grow without bound.
+    """
+
+    def __init__(
+        self,
+        timeout: float = DEFAULT_MULTIPART_TIMEOUT,
+        max_open: int = DEFAULT_MAX_OPEN,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.timeout = timeout
+        self.max_open = max(1, max_open)
+        self._clock = clock
+        self._open: Dict[Hashable, ConcatMessage[T]] = {}
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    def add(
+        self,
+        sender: Hashable,
+        reference: int,
+        total: int,
+        sequences: Iterable[int],
+        item: T,
+        at: float | None = None,
+    ) -> ConcatMessage[T] | None:
+        """File ``item``, which carries the given segment numbers; returns the message if that completed it.
+
+        ``at`` is when the item arrived (default: now); the timeout counts
+        from the first item of a message.
+        """
+        key = (sender, reference, total)
+        message = self._open.get(key)
+        if message is None:
+            message = self._open[key] = ConcatMessage(key, total, self._clock() if at is None else at)
+        message.items.append(item)
+        message.sequences.update(sequences)
+        if not message.complete:
+            return None
+        return self._open.pop(key)
+
+    def expired(self, now: float | None = None) -> List[ConcatMessage[T]]:
+        now = self._clock() if now is None else now
+        done = [message for message in self._open.values() if now - message.started >= self.timeout]
+        for message in done:
+            del self._open[message.key]
+        if len(self._open) > self.max_open:
+            oldest = sorted(self._open.values(), key=lambda message: message.started)
+            for message in oldest[: len(self._open) - self.max_open]:
+                del self._open[message.key]
+                done.append(message)
+        return done
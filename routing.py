@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Routing rules that fan an SMS out to several chats, bots and webhooks.
+
+Rules live in a JSON file named by ``SMSGW_ROUTES``::
+
+    {
+      "bots": {"alerts": "123456:ABC..."},
+      "routes": [
+        {"numbers": ["+4917", "+4930"], "destinations": ["telegram:-100123"]},
+        {"keywords": ["OTP", "code"], "destinations": ["telegram:-100456@alerts", "webhook:https://hooks.example/sms"]}
+      ],
+      "default": ["telegram:-100789"]
+    }
+
+A rule matches when the sender starts with one of its ``numbers`` prefixes
+and the text contains one of its ``keywords`` (case-insensitive); an omitted
+list matches anything. An SMS goes to the union of the destinations of all
+matching rules, or to ``default`` (the ``TELEGRAM_CHAT_ID`` chat unless
+configured) when none matches.
+
+Rules are compiled once into a prefix trie for numbers and a single combined
+regular expression for keywords, so matching costs one walk over the sender
+and one scan over the text however many rules there are.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Set
+
+import telegram_client
+
+ROUTES_ENV = "SMSGW_ROUTES"
+DESTINATION_KINDS = ("telegram", "webhook")
+
+
+class _TrieNode:
+    __slots__ = ("children", "values")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _TrieNode] = {}
+        self.values: Set[int] = set()
+
+
+class PrefixTrie:
+    """Map string prefixes to sets of rule indexes."""
+
+    def __init__(self) -> None:
+        self._root = _TrieNode()
+
+    def add(self, prefix: str, value: int) -> None:
+        node = self._root
+        for char in prefix:
+            node = node.children.setdefault(char, _TrieNode())
+        node.values.add(value)
+
+    def match(self, key: str) -> Set[int]:
+        """Return the values of every prefix of ``key``."""
+        node = self._root
+        found = set(node.values)
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                break
+            found |= node.values
+        return found
+
+
+class KeywordIndex:
+    """Find every rule whose keywords occur in a text with one regex scan.
+
+    The combined pattern is a lookahead over all keywords, longest first, so
+    it reports the longest keyword starting at each position without
+    consuming input. Keywords that are prefixes of a longer one at the same
+    position are folded into the longer keyword's rule set up front.
+    """
+
+    def __init__(self, keywords: Dict[str, Set[int]]) -> None:
+        self._rules: Dict[str, Set[int]] = {}
+        ordered = sorted(keywords, key=len, reverse=True)
+        for keyword in ordered:
+            rules = set()
+            for other in ordered:
+                if keyword.startswith(other):
+                    rules |= keywords[other]
+            self._rules[keyword] = rules
+        alternatives = "|".join(re.escape(keyword) for keyword in ordered)
+        self._pattern = re.compile(f"(?=({alternatives}))", re.IGNORECASE) if ordered else None
+
+    def match(self, text: str) -> Set[int]:
+        found: Set[int] = set()
+        if self._pattern is None:
+            return found
+        for match in self._pattern.finditer(text):
+            found |= self._rules.get(match.group(1).lower(), set())
+        return found
+
+
+def parse_destination(spec: str, bots: Dict[str, str]) -> Dict[str, str]:
+    """Turn ``telegram:<chat>[@<bot>]`` or ``webhook:<url>`` into the payload fields it delivers to."""
+    kind, _, target = spec.partition(":")
+    if kind not in DESTINATION_KINDS or not target:
+        raise ValueError(f"Invalid destination {spec!r}; expected telegram:<chat>[@<bot>] or webhook:<url>")
+    if kind == "webhook":
+        return {"webhook": target}
+    chat_id, _, bot = target.partition("@")
+    if bot and bot not in bots:
+        raise ValueError(f"Destination {spec!r} names unknown bot {bot!r}")
+    fields = {"chat_id": chat_id}
+    if bot:
+        fields["bot"] = bot
+    return fields
+
+
+def _unique(values: Iterable[str]) -> List[str]:
+    return list(dict.fromkeys(values))
+
+
+class Router:
+    """Compiled routing rules; see the module docstring for the file format."""
+
+    def __init__(
+        self,
+        routes: List[Dict[str, object]],
+        default_chat_id: str,
+        bots: Dict[str, str] | None = None,
+        default: List[str] | None = None,
+    ) -> None:
+        self.bots = dict(bots or {})
+        self.default_destination = f"telegram:{default_chat_id}"
+        self.default = _unique(default or [self.default_destination])
+        self._destinations: List[List[str]] = []
+        self._fields: Dict[str, Dict[str, str]] = {}
+        self._numbers = PrefixTrie()
+        self._any_number: Set[int] = set()
+        self._any_keyword: Set[int] = set()
+        keywords: Dict[str, Set[int]] = {}
+        for index, route in enumerate(routes):
+            destinations = _unique(str(spec) for spec in route.get("destinations") or [])
+            if not destinations:
+                raise ValueError(f"Route {index} has no destinations")
+            self._destinations.append(destinations)
+            numbers = [normalize_number(str(prefix)) for prefix in route.get("numbers") or []]
+            for prefix in numbers:
+                self._numbers.add(prefix, index)
+            if not numbers:
+                self._any_number.add(index)
+            words = [str(keyword).lower() for keyword in route.get("keywords") or [] if str(keyword)]
+            for word in words:
+                keywords.setdefault(word, set()).add(index)
+            if not words:
+                self._any_keyword.add(index)
+        self._keywords = KeywordIndex(keywords)
+        for spec in self.default + [spec for specs in self._destinations for spec in specs]:
+            self._fields[spec] = parse_destination(spec, self.bots)
+
+    @classmethod
+    def from_file(cls, path: Path, default_chat_id: str) -> "Router":
+        config = json.loads(Path(path).read_text(encoding="utf-8"))
+        if not isinstance(config, dict) or not isinstance(config.get("routes", []), list):
+            raise ValueError(f"{path}: expected an object with a 'routes' list")
+        return cls(config.get("routes", []), default_chat_id, config.get("bots"), config.get("default"))
+
+    def route(self, number: str, text: str) -> List[str]:
+        """Return the destinations for an SMS in rule order, without duplicates."""
+        by_number = self._numbers.match(normalize_number(number)) | self._any_number
+        matched = by_number & (self._keywords.match(text) | self._any_keyword)
+        if not matched:
+            return list(self.default)
+        return _unique(spec for index in sorted(matched) for spec in self._destinations[index])
+
+    def webhooks(self) -> List[str]:
+        """Every webhook URL the rules deliver to."""
+        return [fields["webhook"] for fields in self._fields.values() if "webhook" in fields]
+
+    def fan_out(self, payload: Dict[str, object]) -> List[Dict[str, object]] | None:
+        """Build one queue payload per destination, or ``None`` to deliver ``payload`` as it is.
+
+        Child ids derive from the parent's, so fanning the same parent out
+        again after a crash re-enqueues the same children instead of new ones.
+        """
+        destinations = self.route(str(payload["number"]), str(payload["text"]))
+        if destinations == [self.default_destination]:
+            return None
+        children = []
+        for index, spec in enumerate(destinations):
+            child: Dict[str, object] = {
+                "id": f"{payload['id']}-{index}",
+                "number": payload["number"],
+                "text": payload["text"],
+                "received_at": payload.get("received_at"),
+                "parent": payload["id"],
+                "destination": spec,
+            }
+            if "modem" in payload:
+                child["modem"] = payload["modem"]
+            child.update(self._fields[spec])
+            children.append(child)
+        return children
+
+    def bot_token(self, name: str) -> str:
+        try:
+            return self.bots[name]
+        except KeyError:
+            raise ValueError(f"Unknown bot {name!r}") from None
+
+
+def normalize_number(number: str) -> str:
+    return "".join(number.split())
+
+
+def load_router(default_chat_id: str, env=os.getenv) -> Router | None:
+    """Load the rules named by ``SMSGW_ROUTES``; ``None`` when routing is not configured."""
+    path = env(ROUTES_ENV)
+    if not path:
+        return None
+    return Router.from_file(Path(path), default_chat_id)
+
+
+def webhook_body(payload: Dict[str, object]) -> Dict[str, object]:
+    """The JSON a webhook receives for a queued SMS; routed copies carry the original message's id."""
+    return {
+        "id": payload.get("parent") or payload.get("id"),
+        "number": payload["number"],
+        "text": payload["text"],
+        "received_at": payload.get("received_at"),
+    }
+
+
+def send_webhook(url: str, payload: Dict[str, object]) -> None:
+    """POST an SMS as JSON to ``url`` over the shared session; raises on request or HTTP errors."""
+    response = telegram_client.get_session().post(
+        url, json=webhook_body(payload), timeout=telegram_client.get_timeouts()
+    )
+    response.raise_for_status()
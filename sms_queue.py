@@ -1,16 +1,56 @@
 #!/usr/bin/env python3
-"""Durable file queue helpers for SMS delivery."""
+"""Durable queue helpers for SMS delivery.
+
+The file spool below is the default backend; ``sqlite_queue`` provides a
+second implementation of :class:`QueueBackend`, selected with
+``SMSGW_QUEUE_BACKEND=sqlite``.
+
+Spool files are JSON (``<id>.json``) or, with ``QUEUE_RECORD_FORMAT=record``,
+compact records (``<id>.rec``): a fixed little-endian header with the
+fields the worker schedules by, followed by the payload as UTF-8 JSON.
+``pending`` then reads only the headers, with one bounded ``read`` each,
+and loads a body when its item is actually used. Both kinds can share a spool, so switching
+the format needs no migration.
+"""
 from __future__ import annotations
 
+import bisect
 import json
+import logging
+import math
 import os
+import struct
+import threading
 import time
-import uuid
+import zlib
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
 
 QUEUE_DIR_ENV = "SMSGW_QUEUE_DIR"
+QUEUE_BACKEND_ENV = "SMSGW_QUEUE_BACKEND"
+GROUP_COMMIT_ENV = "QUEUE_GROUP_COMMIT_MS"
 QUEUE_SUBDIRS = ("pending", "processing", "sent", "failed", "tmp")
+QUEUE_STATES = ("pending", "processing", "sent", "failed")
+QUEUE_BACKENDS = ("file", "sqlite")
+RETRY_FIELDS = ("attempts", "next_attempt_at", "last_error")
+LEASE_ENV = "QUEUE_LEASE_SECONDS"
+DEFAULT_LEASE_SECONDS = 120.0
+RECORD_FORMAT_ENV = "QUEUE_RECORD_FORMAT"
+RECORD_FORMATS = ("json", "record")
+JSON_SUFFIX = ".json"
+RECORD_SUFFIX = ".rec"
+RECORD_MAGIC = b"SMQR"
+RECORD_VERSION = 1
+# magic, version, flags (unused), destination length, chat_id length, attempts,
+# next_attempt_at and received_at (NaN when absent), body length. The
+# destination and chat_id bytes follow, then the body.
+RECORD_HEADER = struct.Struct("<4sBBHHIddI")
+# Header plus typical destination and chat ids; longer ids cost a second read.
+RECORD_HEADER_READ = 512
+# Fields a scheduling pass needs, kept per item by the pending index.
+META_FIELDS = ("attempts", "next_attempt_at", "received_at", "destination", "chat_id")
+INDEX_RESCAN_ENV = "QUEUE_INDEX_RESCAN"
+DEFAULT_INDEX_RESCAN = 60.0
 
 
 def resolve_queue_dir(env=os.getenv) -> Path:
@@ -39,29 +79,778 @@ def _fsync_dir(path: Path) -> None:
         os.close(fd)
 
 
-def enqueue_message(number: str, text: str, base_dir: Path) -> Path:
-    dirs = ensure_queue_dirs(base_dir)
-    message_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex}"
-    payload = {
-        "id": message_id,
+def shard_of(key: str, shards: int) -> int:
+    """Stable shard index of ``key``; unlike ``hash()`` it is the same in every process."""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def lane_of(payload: Dict[str, object], default_chat_id: str) -> str:
+    """Deliveries sharing this key are made in order: the routed destination, else the chat."""
+    for field in ("destination", "chat_id"):
+        value = payload.get(field)
+        if isinstance(value, str) and value:
+            return value
+    return default_chat_id
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse ``"<index>/<count>"`` as given to ``queue_worker.py --shard``."""
+    index, _, count = value.partition("/")
+    shard = (int(index), int(count))
+    if not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"invalid shard {value!r}; expected <index>/<count> with index < count")
+    return shard
+
+
+def new_message_id() -> str:
+    # Microsecond prefix keeps ids in arrival order; older millisecond ids still sort first.
+    # The suffix has the shape of uuid4().hex without importing uuid on the receive path.
+    return f"{time.time_ns() // 1000}-{os.urandom(16).hex()}"
+
+
+def build_payload(number: str, text: str, chat_id: str | None = None) -> Dict[str, object]:
+    payload: Dict[str, object] = {
+        "id": new_message_id(),
         "number": number,
         "text": text,
         "received_at": time.time(),
     }
+    if chat_id:
+        payload["chat_id"] = chat_id
+    return payload
+
+
+def enqueue_message(number: str, text: str, base_dir: Path, chat_id: str | None = None) -> Path:
+    dirs = ensure_queue_dirs(base_dir)
+    payload = build_payload(number, text, chat_id)
+    message_id = payload["id"]
     tmp_path = dirs["tmp"] / f"{message_id}.json"
     final_path = dirs["pending"] / f"{message_id}.json"
-    with open(tmp_path, "w", encoding="utf-8") as handle:
-        json.dump(payload, handle, ensure_ascii=True)
+    _write_json_atomic(payload, tmp_path, final_path)
+    return final_path
+
+
+def write_file_atomic(data: bytes, tmp_path: Path, final_path: Path, sync_dir: bool = True) -> None:
+    """Write ``data`` to ``tmp_path``, fsync it and rename it over ``final_path``.
+
+    With ``sync_dir`` False the caller fsyncs ``final_path.parent`` itself,
+    typically once for a whole batch of files.
+    """
+    with open(tmp_path, "wb") as handle:
+        handle.write(data)
         handle.flush()
         os.fsync(handle.fileno())
     os.replace(tmp_path, final_path)
-    _fsync_dir(final_path.parent)
-    return final_path
+    if sync_dir:
+        _fsync_dir(final_path.parent)
+
+
+def _write_json_atomic(payload: Dict[str, object], tmp_path: Path, final_path: Path, sync_dir: bool = True) -> None:
+    if final_path.suffix == RECORD_SUFFIX:
+        data = encode_record(payload)
+    else:
+        data = json.dumps(payload, ensure_ascii=True).encode("ascii")
+    write_file_atomic(data, tmp_path, final_path, sync_dir)
+
+
+def _header_string(payload: Dict[str, object], key: str) -> bytes:
+    value = payload.get(key)
+    return value.encode("utf-8", "surrogatepass")[:0xFFFF] if isinstance(value, str) else b""
+
+
+def _header_float(payload: Dict[str, object], key: str) -> float:
+    value = payload.get(key)
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else math.nan
+
+
+def encode_record(payload: Dict[str, object]) -> bytes:
+    """Serialize ``payload`` as a record: scheduling header, then the whole payload as JSON."""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8", "surrogatepass")
+    destination = _header_string(payload, "destination")
+    chat_id = _header_string(payload, "chat_id")
+    attempts = payload.get("attempts")
+    header = RECORD_HEADER.pack(
+        RECORD_MAGIC,
+        RECORD_VERSION,
+        0,
+        len(destination),
+        len(chat_id),
+        min(attempts, 0xFFFFFFFF) if isinstance(attempts, int) and attempts > 0 else 0,
+        _header_float(payload, "next_attempt_at"),
+        _header_float(payload, "received_at"),
+        len(body),
+    )
+    return b"".join((header, destination, chat_id, body))
+
+
+def _record_header(data: bytes, with_body: bool = True) -> Tuple[Dict[str, object], int, int]:
+    """Decode the header at the start of ``data``; returns the metadata plus the body offset and length.
+
+    With ``with_body`` False, ``data`` only needs to reach the end of the
+    header strings.
+    """
+    if len(data) < RECORD_HEADER.size:
+        raise ValueError("truncated record header")
+    magic, version, _, destination_len, chat_len, attempts, next_attempt_at, received_at, body_len = (
+        RECORD_HEADER.unpack_from(data)
+    )
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        raise ValueError(f"not a version {RECORD_VERSION} queue record")
+    offset = RECORD_HEADER.size + destination_len + chat_len
+    if len(data) < (offset + body_len if with_body else offset):
+        raise ValueError("truncated queue record")
+    meta: Dict[str, object] = {"attempts": attempts}
+    if destination_len:
+        meta["destination"] = data[RECORD_HEADER.size : RECORD_HEADER.size + destination_len].decode(
+            "utf-8", "surrogatepass"
+        )
+    if chat_len:
+        meta["chat_id"] = data[RECORD_HEADER.size + destination_len : offset].decode("utf-8", "surrogatepass")
+    if not math.isnan(next_attempt_at):
+        meta["next_attempt_at"] = next_attempt_at
+    if not math.isnan(received_at):
+        meta["received_at"] = received_at
+    return meta, offset, body_len
+
+
+def decode_record(data: bytes) -> Dict[str, object]:
+    _, offset, length = _record_header(data)
+    return json.loads(data[offset : offset + length].decode("utf-8", "surrogatepass"))
+
+
+def load_record_meta(path: Path) -> Dict[str, object]:
+    """The header fields of the record at ``path``; the body is neither read nor decoded.
+
+    A plain bounded read: mapping the file costs more syscalls than reading
+    a few hundred bytes, and took four times as long per item.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, RECORD_HEADER_READ)
+        if len(data) >= RECORD_HEADER.size:
+            needed = RECORD_HEADER.size + sum(RECORD_HEADER.unpack_from(data)[3:5])
+            if needed > len(data):
+                data += os.read(fd, needed - len(data))
+    finally:
+        os.close(fd)
+    return _record_header(data, with_body=False)[0]
 
 
-def move_item(path: Path, dest_dir: Path) -> Path:
+def load_payload(path: Path) -> Dict[str, object]:
+    if path.suffix == RECORD_SUFFIX:
+        return decode_record(path.read_bytes())
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def list_items(directory: Path) -> List[Path]:
+    """Spool files of both formats in ``directory``, in name (and so arrival) order."""
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return []
+    with entries:
+        return sorted(Path(entry.path) for entry in entries if entry.name.endswith((JSON_SUFFIX, RECORD_SUFFIX)))
+
+
+def payload_meta(payload: Dict[str, object]) -> Dict[str, object]:
+    """The scheduling fields of ``payload``, as ``load_record_meta`` returns them for a record."""
+    return {key: payload[key] for key in META_FIELDS if key in payload}
+
+
+def rewrite_item(path: Path, payload: Dict[str, object], tmp_dir: Path, sync_dir: bool = True) -> Path:
+    """Atomically replace the payload stored at ``path`` (e.g. to persist retry state), keeping its format."""
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    _write_json_atomic(payload, tmp_dir / path.name, path, sync_dir)
+    return path
+
+
+def move_item(path: Path, dest_dir: Path, sync_dir: bool = True) -> Path:
     dest_dir.mkdir(parents=True, exist_ok=True)
     dest_path = dest_dir / path.name
     os.replace(path, dest_path)
-    _fsync_dir(dest_dir)
+    if sync_dir:
+        _fsync_dir(dest_dir)
     return dest_path
+
+
+class DirSyncBatcher:
+    """Group directory fsyncs of renames into one fsync per directory per batch.
+
+    The first rename of a batch arms a timer; when it fires (or on an explicit
+    ``flush``) every directory touched since is fsynced once. A rename is
+    therefore durable at most ``window`` seconds after it happened.
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._dirty: Set[Path] = set()
+        self._timer: threading.Timer | None = None
+
+    def mark(self, directory: Path) -> None:
+        with self._lock:
+            self._dirty.add(directory)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        for directory in sorted(dirty):
+            _fsync_dir(directory)
+
+
+class PendingIndex:
+    """Names of the files in ``pending/`` in arrival order, with their scheduling fields once read.
+
+    A sorted list rather than a heap: every pass walks the whole index in
+    order, and new ids carry the newest timestamp, so adding one is an
+    append. Delivery threads update it concurrently with the worker loop.
+    """
+
+    def __init__(self) -> None:
+        self._names: List[str] = []
+        self._meta: Dict[str, Dict[str, object] | None] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def reset(self, names: Iterable[str]) -> None:
+        names = sorted(set(names))
+        with self._lock:
+            self._names = names
+            self._meta = dict.fromkeys(names)
+
+    def add(self, name: str, meta: Dict[str, object] | None = None) -> None:
+        """Track ``name``; without ``meta`` its fields are read again on the next pass, as the file may be new."""
+        with self._lock:
+            known = name in self._meta
+            self._meta[name] = meta
+            if known:
+                return
+            if not self._names or name > self._names[-1]:
+                self._names.append(name)
+            else:
+                bisect.insort(self._names, name)
+
+    def remember(self, name: str, meta: Dict[str, object]) -> None:
+        with self._lock:
+            if name in self._meta:
+                self._meta[name] = meta
+
+    def discard(self, name: str) -> None:
+        with self._lock:
+            if name not in self._meta:
+                return
+            del self._meta[name]
+            del self._names[bisect.bisect_left(self._names, name)]
+
+    def entries(self) -> List[Tuple[str, Dict[str, object] | None]]:
+        with self._lock:
+            return [(name, self._meta[name]) for name in self._names]
+
+
+class QueueItem:
+    """A queued message plus the backend-specific handle used to move it between states.
+
+    ``payload`` is ``None`` when the stored record could not be decoded. A
+    plain class rather than a dataclass: ``dataclasses`` pulls in ``inspect``,
+    which would dominate the receive hook's import time.
+
+    With a ``loader`` the payload is read on first access. ``meta`` then
+    holds the scheduling fields (``attempts``, ``next_attempt_at``,
+    ``received_at``, ``destination``, ``chat_id``) that were available
+    without it; otherwise ``meta`` is the payload itself.
+    """
+
+    __slots__ = ("id", "_payload", "handle", "_meta", "_loader")
+
+    def __init__(
+        self,
+        id: str,
+        payload: Dict[str, object] | None = None,
+        handle: object = None,
+        meta: Dict[str, object] | None = None,
+        loader: Callable[[], Dict[str, object] | None] | None = None,
+    ) -> None:
+        self.id = id
+        self._payload = payload
+        self.handle = handle
+        self._meta = meta
+        self._loader = loader
+
+    @property
+    def payload(self) -> Dict[str, object] | None:
+        if self._loader is not None:
+            self._payload, self._loader = self._loader(), None
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload: Dict[str, object] | None) -> None:
+        self._payload, self._loader = payload, None
+
+    @property
+    def meta(self) -> Dict[str, object] | None:
+        if self._loader is not None:
+            return self._meta
+        return self._payload
+
+    def __repr__(self) -> str:
+        return f"QueueItem(id={self.id!r}, payload={self.payload!r}, handle={self.handle!r})"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, QueueItem):
+            return NotImplemented
+        return (self.id, self.payload, self.handle) == (other.id, other.payload, other.handle)
+
+
+class QueueBackend:
+    """State machine shared by the queue backends: pending -> processing -> sent | failed.
+
+    Retries go from processing back to pending with updated retry fields in
+    the payload. Implementations must make ``claim`` atomic so an item is
+    only ever handed out once.
+
+    A claim is a lease: it records when the item was claimed, ``renew``
+    refreshes that time for the items this instance still holds, and
+    ``recover(lease)`` only returns items whose lease has run out. Several
+    worker processes can therefore share one queue, each optionally limited
+    to one ``shard`` (``(index, count)``) of the delivery lanes, so that a
+    chat is only ever served by one worker and stays in order.
+    """
+
+    #: Directory the worker may watch with inotify to learn about new items.
+    watch_dir: Path | None = None
+    shard: Tuple[int, int] | None = None
+    #: Lane of the items without a destination or chat, see :func:`lane_of`.
+    default_chat_id: str = ""
+
+    def _owns(self, payload: Dict[str, object] | None) -> bool:
+        if self.shard is None:
+            return True
+        return shard_of(lane_of(payload or {}, self.default_chat_id), self.shard[1]) == self.shard[0]
+
+    def enqueue(self, number: str, text: str, chat_id: str | None = None) -> str:
+        raise NotImplementedError
+
+    def enqueue_many(self, messages: Iterable[Tuple[str, str, str | None]]) -> List[str]:
+        """Enqueue ``(number, text, chat_id)`` tuples in order; backends may commit them together."""
+        return self.enqueue_payloads([build_payload(number, text, chat_id) for number, text, chat_id in messages])
+
+    def enqueue_payloads(self, payloads: List[Dict[str, object]]) -> List[str]:
+        """Enqueue prepared payloads (each with an ``id``) as one batch.
+
+        A payload whose id is already in the queue, in any state, is skipped,
+        so callers that derive ids deterministically can safely re-run a batch.
+        """
+        raise NotImplementedError
+
+    def pending(self) -> Iterator[QueueItem]:
+        """Yield pending items in arrival order."""
+        raise NotImplementedError
+
+    def index_pending(self, rescan_interval: float) -> bool:
+        """Serve ``pending`` from memory, listing the storage again every ``rescan_interval`` seconds.
+
+        Only sound when the caller reports items added by other processes
+        through ``arrived``. Returns whether the backend keeps such an index.
+        """
+        return False
+
+    def arrived(self, names: Iterable[str]) -> None:
+        """Note pending items added by other processes, by file name; ``"*"`` means some were missed."""
+
+    def claim(self, item: QueueItem) -> QueueItem | None:
+        """Move ``item`` to processing; return ``None`` if something else took it first."""
+        raise NotImplementedError
+
+    def ack(self, item: QueueItem) -> None:
+        raise NotImplementedError
+
+    def fail(self, item: QueueItem) -> None:
+        raise NotImplementedError
+
+    def retry(self, item: QueueItem) -> None:
+        """Persist ``item.payload`` and return the item to pending."""
+        raise NotImplementedError
+
+    def release(self, item: QueueItem) -> None:
+        """Return a claimed item to pending unchanged."""
+        raise NotImplementedError
+
+    def recover(self, lease: float = 0.0) -> int:
+        """Return processing items not renewed for ``lease`` seconds to pending.
+
+        With a lease, items held by this instance are left alone; ``lease=0``
+        returns everything, as a sole worker does at startup.
+        """
+        raise NotImplementedError
+
+    def renew(self) -> int:
+        """Refresh the lease of every item this instance holds in processing; returns how many."""
+        return 0
+
+    def requeue_failed(self) -> int:
+        """Move failed items back to pending with fresh retry state."""
+        raise NotImplementedError
+
+    def counts(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+    def count(self, state: str) -> int:
+        return self.counts()[state]
+
+    def oldest(self, state: str, limit: int) -> List[QueueItem]:
+        """Return up to ``limit`` items of ``state`` in arrival order (used by retention)."""
+        raise NotImplementedError
+
+    def purge(self, items: Iterable[QueueItem]) -> None:
+        """Delete finished items for good once they have been archived."""
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Make state changes that are still buffered durable."""
+        return None
+
+    def close(self) -> None:
+        self.flush()
+
+
+class FileQueue(QueueBackend):
+    """One file per message, moved between state directories with atomic renames.
+
+    New messages are written as ``record_format`` (``json`` or ``record``);
+    existing files of either kind are read and keep their format when
+    rewritten.
+
+    With ``group_commit_window`` > 0 the worker-side transitions (claim, ack,
+    fail, retry, release) skip their per-rename directory fsync and share one
+    per batch via :class:`DirSyncBatcher`. Enqueues always sync immediately.
+
+    The lease of a claimed item is the mtime of its file in ``processing/``,
+    set on claim and refreshed by ``renew``; it costs no extra file.
+
+    After ``index_pending`` the pending files are tracked in a
+    :class:`PendingIndex` instead of listing ``pending/`` on every pass. This
+    queue's own transitions update it, ``arrived`` adds what a watcher saw
+    other processes write, and a periodic rescan catches anything missed.
+    Names of files that another worker took are dropped when a pass finds
+    the file gone.
+    """
+
+    def __init__(
+        self,
+        base_dir: Path,
+        group_commit_window: float = 0.0,
+        shard: Tuple[int, int] | None = None,
+        record_format: str = "json",
+        default_chat_id: str = "",
+    ) -> None:
+        self.base_dir = base_dir
+        self.dirs = ensure_queue_dirs(base_dir)
+        self.watch_dir = self.dirs["pending"]
+        self.shard = shard
+        self.default_chat_id = default_chat_id
+        self.suffix = RECORD_SUFFIX if record_format == "record" else JSON_SUFFIX
+        self._batcher = DirSyncBatcher(group_commit_window) if group_commit_window > 0 else None
+        self._held: Dict[str, Path] = {}
+        self._held_lock = threading.Lock()
+        self._index: PendingIndex | None = None
+        self._rescan_interval = 0.0
+        self._next_rescan = 0.0
+
+    def _hold(self, item: QueueItem) -> None:
+        with self._held_lock:
+            self._held[item.id] = item.handle
+
+    def _drop(self, item: QueueItem) -> None:
+        with self._held_lock:
+            self._held.pop(item.id, None)
+
+    def _move(self, path: Path, state: str) -> Path:
+        dest_dir = self.dirs[state]
+        if self._batcher is None:
+            return move_item(path, dest_dir)
+        moved = move_item(path, dest_dir, sync_dir=False)
+        self._batcher.mark(dest_dir)
+        return moved
+
+    def _track(self, path: Path, payload: Dict[str, object] | None = None) -> None:
+        if self._index is not None:
+            self._index.add(path.name, payload_meta(payload) if payload is not None else None)
+
+    def _untrack(self, path: Path) -> None:
+        if self._index is not None:
+            self._index.discard(path.name)
+
+    def _rewrite(self, path: Path, payload: Dict[str, object]) -> None:
+        # The rewrite lands in the directory that the following _move syncs.
+        rewrite_item(path, payload, self.dirs["tmp"], sync_dir=self._batcher is None)
+
+    def enqueue(self, number: str, text: str, chat_id: str | None = None) -> str:
+        if self.suffix == JSON_SUFFIX:
+            path = enqueue_message(number, text, self.base_dir, chat_id)
+            self._track(path)
+            return path.stem
+        return self.enqueue_payloads([build_payload(number, text, chat_id)])[0]
+
+    def enqueue_payloads(self, payloads: List[Dict[str, object]]) -> List[str]:
+        # Every file is fsynced before its rename; the pending directory is
+        # fsynced once for the whole batch instead of once per message.
+        ids = []
+        for payload in payloads:
+            message_id = str(payload["id"])
+            name = message_id + self.suffix
+            if self._exists(message_id):
+                ids.append(message_id)
+                continue
+            _write_json_atomic(payload, self.dirs["tmp"] / name, self.dirs["pending"] / name, sync_dir=False)
+            self._track(self.dirs["pending"] / name, payload)
+            ids.append(message_id)
+        if ids:
+            _fsync_dir(self.dirs["pending"])
+        return ids
+
+    def _exists(self, message_id: str) -> bool:
+        return any(
+            (self.dirs[state] / (message_id + suffix)).exists()
+            for state in QUEUE_STATES
+            for suffix in (JSON_SUFFIX, RECORD_SUFFIX)
+        )
+
+    def index_pending(self, rescan_interval: float) -> bool:
+        if rescan_interval <= 0:
+            return False
+        self._index = PendingIndex()
+        self._rescan_interval = rescan_interval
+        self._next_rescan = 0.0
+        return True
+
+    def arrived(self, names: Iterable[str]) -> None:
+        if self._index is None:
+            return
+        for name in names:
+            if name == "*":
+                self._next_rescan = 0.0
+            elif name.endswith((JSON_SUFFIX, RECORD_SUFFIX)):
+                self._track(self.dirs["pending"] / name)
+
+    def _pending_entries(self) -> List[Tuple[str, Dict[str, object] | None]]:
+        if self._index is None:
+            return [(path.name, None) for path in list_items(self.dirs["pending"])]
+        if time.monotonic() >= self._next_rescan:
+            self._index.reset(path.name for path in list_items(self.dirs["pending"]))
+            self._next_rescan = time.monotonic() + self._rescan_interval
+        return self._index.entries()
+
+    def pending(self) -> Iterator[QueueItem]:
+        directory = self.dirs["pending"]
+        for name, meta in self._pending_entries():
+            path = directory / name
+            if meta is None and path.suffix != RECORD_SUFFIX:
+                payload = self._read(path)
+                if payload is not None:
+                    self._remember(name, payload_meta(payload))
+                elif self._gone(path):
+                    continue
+                if self._owns(payload):
+                    yield QueueItem(path.stem, payload, path)
+                continue
+            if meta is None:
+                # Only the header is read here; the body loads when the payload is used.
+                meta = self._read_meta(path)
+                if meta is not None:
+                    self._remember(name, meta)
+                elif self._gone(path):
+                    continue
+            if not self._owns(meta):
+                continue
+            yield QueueItem(path.stem, handle=path, meta=meta, loader=lambda path=path: self._read(path))
+
+    def _remember(self, name: str, meta: Dict[str, object]) -> None:
+        if self._index is not None:
+            self._index.remember(name, meta)
+
+    def _gone(self, path: Path) -> bool:
+        # Claimed by another worker since it was listed or reported.
+        if path.exists():
+            return False
+        self._untrack(path)
+        return True
+
+    def claim(self, item: QueueItem) -> QueueItem | None:
+        try:
+            # The lease starts now. Touching the file before the rename (which
+            # keeps the mtime) means no other worker can see it in processing/
+            # with a stale, already expired time.
+            self._untrack(item.handle)
+            os.utime(item.handle)
+            path = self._move(item.handle, "processing")
+        except FileNotFoundError:
+            return None
+        claimed = QueueItem(item.id, self._read(path), path)
+        self._hold(claimed)
+        return claimed
+
+    def ack(self, item: QueueItem) -> None:
+        self._drop(item)
+        item.handle = self._move(item.handle, "sent")
+
+    def fail(self, item: QueueItem) -> None:
+        self._drop(item)
+        if item.payload is not None:
+            self._rewrite(item.handle, item.payload)
+        item.handle = self._move(item.handle, "failed")
+
+    def retry(self, item: QueueItem) -> None:
+        self._drop(item)
+        self._rewrite(item.handle, item.payload)
+        item.handle = self._move(item.handle, "pending")
+        self._track(item.handle, item.payload)
+
+    def release(self, item: QueueItem) -> None:
+        self._drop(item)
+        item.handle = self._move(item.handle, "pending")
+        self._track(item.handle, item.payload)
+
+    def recover(self, lease: float = 0.0) -> int:
+        expired_before = time.time() - lease
+        with self._held_lock:
+            held = set(self._held) if lease > 0 else set()
+        count = 0
+        for path in list_items(self.dirs["processing"]):
+            if path.stem in held:
+                continue
+            try:
+                if lease > 0 and path.stat().st_mtime > expired_before:
+                    continue
+                self._track(move_item(path, self.dirs["pending"]))
+            except FileNotFoundError:
+                continue
+            count += 1
+        return count
+
+    def renew(self) -> int:
+        with self._held_lock:
+            held = list(self._held.items())
+        renewed = 0
+        for message_id, path in held:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Settled meanwhile, or recovered by another worker after the lease ran out.
+                with self._held_lock:
+                    if self._held.get(message_id) == path:
+                        del self._held[message_id]
+                continue
+            renewed += 1
+        return renewed
+
+    def requeue_failed(self) -> int:
+        count = 0
+        for path in list_items(self.dirs["failed"]):
+            payload = self._read(path)
+            if payload is not None:
+                for key in RETRY_FIELDS:
+                    payload.pop(key, None)
+                rewrite_item(path, payload, self.dirs["tmp"])
+            try:
+                self._track(move_item(path, self.dirs["pending"]), payload)
+            except FileNotFoundError:
+                continue
+            count += 1
+        return count
+
+    def count(self, state: str) -> int:
+        return len(list_items(self.dirs[state]))
+
+    def oldest(self, state: str, limit: int) -> List[QueueItem]:
+        paths = list_items(self.dirs[state])[:limit]
+        return [QueueItem(path.stem, self._read(path), path) for path in paths]
+
+    def purge(self, items: Iterable[QueueItem]) -> None:
+        for item in items:
+            try:
+                item.handle.unlink()
+            except FileNotFoundError:
+                continue
+
+    def flush(self) -> None:
+        if self._batcher is not None:
+            self._batcher.flush()
+
+    def counts(self) -> Dict[str, int]:
+        return {state: self.count(state) for state in QUEUE_STATES}
+
+    @staticmethod
+    def _read(path: Path) -> Dict[str, object] | None:
+        try:
+            payload = load_payload(path)
+        except (OSError, ValueError):
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    @staticmethod
+    def _read_meta(path: Path) -> Dict[str, object] | None:
+        try:
+            return load_record_meta(path)
+        except (OSError, ValueError):
+            return None
+
+
+def normalize_backend(value: str | None) -> str:
+    backend = (value or "file").strip().lower()
+    if backend in QUEUE_BACKENDS:
+        return backend
+    logging.warning("Unknown %s=%r; defaulting to file", QUEUE_BACKEND_ENV, value)
+    return "file"
+
+
+def open_queue(env=os.getenv, shard: Tuple[int, int] | None = None, default_chat_id: str = "") -> QueueBackend:
+    """Open the backend selected by ``SMSGW_QUEUE_BACKEND`` under the resolved queue dir.
+
+    ``shard`` limits ``pending`` to one share of the delivery lanes (see
+    :func:`lane_of`); items without a destination or chat belong to the lane
+    of ``default_chat_id``.
+    """
+    base_dir = resolve_queue_dir(env)
+    if normalize_backend(env(QUEUE_BACKEND_ENV)) == "sqlite":
+        # Imported lazily so the receive hook only pays for sqlite3 when it is used.
+        import sqlite_queue
+
+        return sqlite_queue.SQLiteQueue(
+            sqlite_queue.resolve_db_path(base_dir, env), shard=shard, default_chat_id=default_chat_id
+        )
+    return FileQueue(
+        base_dir,
+        group_commit_window=_group_commit_window(env),
+        shard=shard,
+        record_format=_record_format(env),
+        default_chat_id=default_chat_id,
+    )
+
+
+def _record_format(env=os.getenv) -> str:
+    value = (env(RECORD_FORMAT_ENV) or "json").strip().lower()
+    if value in RECORD_FORMATS:
+        return value
+    logging.warning("Unknown %s=%r; defaulting to json", RECORD_FORMAT_ENV, value)
+    return "json"
+
+
+def _group_commit_window(env=os.getenv) -> float:
+    value = env(GROUP_COMMIT_ENV)
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value) / 1000.0)
+    except ValueError:
+        logging.warning("Invalid %s=%r; group commit disabled", GROUP_COMMIT_ENV, value)
+        return 0.0
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""SQLite (WAL) queue backend and a migration tool for existing file spools.
+
+Usage:
+    python3 sqlite_queue.py import-spool [SPOOL_DIR] [--db PATH] [--delete]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import logging_utils
+import sms_queue
+
+DB_PATH_ENV = "SMSGW_QUEUE_DB"
+DB_FILENAME = "queue.sqlite3"
+WAKE_SUFFIX = ".wake"
+DEFAULT_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_state_id ON messages (state, id);
+CREATE INDEX IF NOT EXISTS messages_state_next_attempt ON messages (state, next_attempt_at);
+"""
+
+
+def resolve_db_path(base_dir: Path, env=os.getenv) -> Path:
+    configured = env(DB_PATH_ENV)
+    if configured:
+        return Path(configured)
+    return base_dir / DB_FILENAME
+
+
+def _encode(payload: Dict[str, object] | None) -> str:
+    return json.dumps(payload or {}, ensure_ascii=True)
+
+
+def _decode(raw: str) -> Dict[str, object] | None:
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def _next_attempt_at(payload: Dict[str, object] | None) -> float:
+    value = (payload or {}).get("next_attempt_at")
+    return float(value) if isinstance(value, (int, float)) else 0.0
+
+
+class SQLiteQueue(sms_queue.QueueBackend):
+    """Queue stored in one WAL-mode SQLite database.
+
+    State changes are single-row ``UPDATE`` statements guarded by the current
+    state, so claiming is atomic even with several connections. Each thread
+    gets its own connection. A lease is the row's ``updated_at``.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        shard: Tuple[int, int] | None = None,
+        default_chat_id: str = "",
+    ) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.shard = shard
+        self.default_chat_id = default_chat_id
+        self._held: Set[str] = set()
+        self._held_lock = threading.Lock()
+        self.wake_path = path.with_name(path.name + WAKE_SUFFIX)
+        self.watch_dir = path.parent
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # FULL keeps the per-commit fsync guarantee of the file spool.
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _update(self, sql: str, params: tuple) -> int:
+        return self._connection().execute(sql, params).rowcount
+
+    def enqueue(self, number: str, text: str, chat_id: str | None = None) -> str:
+        payload = sms_queue.build_payload(number, text, chat_id)
+        self._connection().execute(
+            "INSERT INTO messages (id, state, next_attempt_at, updated_at, payload) VALUES (?, 'pending', 0, ?, ?)",
+            (payload["id"], time.time(), _encode(payload)),
+        )
+        self._ring()
+        return str(payload["id"])
+
+    def enqueue_payloads(self, payloads: List[Dict[str, object]]) -> List[str]:
+        if not payloads:
+            return []
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO messages (id, state, next_attempt_at, updated_at, payload) "
+                "VALUES (?, 'pending', 0, ?, ?)",
+                [(payload["id"], now, _encode(payload)) for payload in payloads],
+            )
+        self._ring()
+        return [str(payload["id"]) for payload in payloads]
+
+    def _ring(self) -> None:
+        # Closing a written file raises IN_CLOSE_WRITE in the database directory,
+        # which wakes a worker that watches ``watch_dir`` with inotify.
+        try:
+            with open(self.wake_path, "a", encoding="utf-8"):
+                pass
+        except OSError:
+            pass
+
+    def _hold(self, message_id: str) -> None:
+        with self._held_lock:
+            self._held.add(message_id)
+
+    def _drop(self, message_id: str) -> None:
+        with self._held_lock:
+            self._held.discard(message_id)
+
+    def pending(self) -> Iterator[sms_queue.QueueItem]:
+        """Pending rows in id order, read in pages until ``batch_size`` due rows were yielded.
+
+        Rows still backing off are yielded too, so that the worker holds back
+        the rest of their chat, but they do not count against the batch: a
+        long run of deferred rows at the head cannot starve due rows behind it.
+        Rows of other shards' lanes are skipped and do not count either.
+        """
+        sql = "SELECT id, next_attempt_at, payload FROM messages WHERE state = 'pending' AND id > ? ORDER BY id LIMIT ?"
+        now = time.time()
+        due = 0
+        after = ""
+        while due < self.batch_size:
+            rows = self._connection().execute(sql, (after, self.batch_size)).fetchall()
+            for message_id, next_attempt_at, raw in rows:
+                payload = _decode(raw)
+                if not self._owns(payload):
+                    continue
+                due += next_attempt_at <= now
+                yield sms_queue.QueueItem(message_id, payload)
+            if len(rows) < self.batch_size:
+                return
+            after = rows[-1][0]
+
+    def claim(self, item: sms_queue.QueueItem) -> sms_queue.QueueItem | None:
+        with self.transaction() as conn:
+            claimed = conn.execute(
+                "UPDATE messages SET state = 'processing', updated_at = ? WHERE id = ? AND state = 'pending'",
+                (time.time(), item.id),
+            ).rowcount
+            row = conn.execute("SELECT payload FROM messages WHERE id = ?", (item.id,)).fetchone() if claimed else None
+        if row is None:
+            return None
+        self._hold(item.id)
+        return sms_queue.QueueItem(item.id, _decode(row[0]))
+
+    def ack(self, item: sms_queue.QueueItem) -> None:
+        self._drop(item.id)
+        self._update(
+            "UPDATE messages SET state = 'sent', updated_at = ? WHERE id = ? AND state = 'processing'",
+            (time.time(), item.id),
+        )
+
+    def fail(self, item: sms_queue.QueueItem) -> None:
+        self._drop(item.id)
+        if item.payload is None:
+            self._update("UPDATE messages SET state = 'failed', updated_at = ? WHERE id = ?", (time.time(), item.id))
+            return
+        self._update(
+            "UPDATE messages SET state = 'failed', updated_at = ?, payload = ? WHERE id = ?",
+            (time.time(), _encode(item.payload), item.id),
+        )
+
+    def retry(self, item: sms_queue.QueueItem) -> None:
+        self._drop(item.id)
+        self._update(
+            "UPDATE messages SET state = 'pending', updated_at = ?, next_attempt_at = ?, payload = ? "
+            "WHERE id = ? AND state = 'processing'",
+            (time.time(), _next_attempt_at(item.payload), _encode(item.payload), item.id),
+        )
+
+    def release(self, item: sms_queue.QueueItem) -> None:
+        self._drop(item.id)
+        self._update(
+            "UPDATE messages SET state = 'pending', updated_at = ? WHERE id = ? AND state = 'processing'",
+            (time.time(), item.id),
+        )
+
+    def recover(self, lease: float = 0.0) -> int:
+        now = time.time()
+        with self._held_lock:
+            held = list(self._held) if lease > 0 else []
+        with self.transaction() as conn:
+            sql = "UPDATE messages SET state = 'pending', updated_at = ? WHERE state = 'processing'"
+            params: tuple = (now,)
+            if lease > 0:
+                sql += " AND updated_at <= ?"
+                params += (now - lease,)
+            if held:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS held (id TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM held")
+                conn.executemany("INSERT INTO held (id) VALUES (?)", [(message_id,) for message_id in held])
+                sql += " AND id NOT IN (SELECT id FROM held)"
+            return conn.execute(sql, params).rowcount
+
+    def renew(self) -> int:
+        with self._held_lock:
+            held = list(self._held)
+        if not held:
+            return 0
+        with self.transaction() as conn:
+            renewed = conn.executemany(
+                "UPDATE messages SET updated_at = ? WHERE id = ? AND state = 'processing'",
+                [(time.time(), message_id) for message_id in held],
+            ).rowcount
+        return renewed
+
+    def requeue_failed(self) -> int:
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT id, payload FROM messages WHERE state = 'failed'").fetchall()
+            now = time.time()
+            for message_id, raw in rows:
+                payload = _decode(raw)
+                if payload is not None:
+                    for key in sms_queue.RETRY_FIELDS:
+                        payload.pop(key, None)
+                    raw = _encode(payload)
+                conn.execute(
+                    "UPDATE messages SET state = 'pending', next_attempt_at = 0, updated_at = ?, payload = ? "
+                    "WHERE id = ?",
+                    (now, raw, message_id),
+                )
+        return len(rows)
+
+    def counts(self) -> Dict[str, int]:
+        counts = {state: 0 for state in sms_queue.QUEUE_STATES}
+        for state, count in self._connection().execute("SELECT state, COUNT(*) FROM messages GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def count(self, state: str) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM messages WHERE state = ?", (state,)).fetchone()[0]
+
+    def oldest(self, state: str, limit: int) -> List[sms_queue.QueueItem]:
+        rows = (
+            self._connection()
+            .execute("SELECT id, payload FROM messages WHERE state = ? ORDER BY id LIMIT ?", (state, limit))
+            .fetchall()
+        )
+        return [sms_queue.QueueItem(message_id, _decode(raw)) for message_id, raw in rows]
+
+    def purge(self, items: Iterable[sms_queue.QueueItem]) -> None:
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM messages WHERE id = ?", [(item.id,) for item in items])
+
+    def close(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+def import_spool(spool_dir: Path, queue: SQLiteQueue, delete: bool = False) -> Dict[str, int]:
+    """Copy every item of a file spool into ``queue``, keeping its state and retry fields.
+
+    Items found in ``processing/`` are imported as pending. Ids already present
+    in the database are skipped, so the import can be re-run safely.
+    """
+    imported = {state: 0 for state in sms_queue.QUEUE_STATES}
+    sources = (("pending", "pending"), ("processing", "pending"), ("sent", "sent"), ("failed", "failed"))
+    for directory, state in sources:
+        paths = []
+        with queue.transaction() as conn:
+            for path in sms_queue.list_items(spool_dir / directory):
+                try:
+                    payload = sms_queue.load_payload(path)
+                except OSError as exc:
+                    logging.warning("Skipping %s: %s", path, exc)
+                    continue
+                except ValueError:
+                    payload = None
+                if not isinstance(payload, dict):
+                    logging.warning("Skipping unreadable payload %s", path)
+                    continue
+                message_id = str(payload.get("id") or path.stem)
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO messages (id, state, next_attempt_at, updated_at, payload) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (message_id, state, _next_attempt_at(payload), path.stat().st_mtime, _encode(payload)),
+                ).rowcount
+                imported[state] += inserted
+                paths.append(path)
+        # Unreadable files are left in place for manual inspection.
+        if delete:
+            for path in paths:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+    return imported
+
+
+def main(argv: List[str] | None = None) -> None:
+    logging_utils.configure_logging()
+    parser = argparse.ArgumentParser(description="SQLite queue backend tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import-spool", help="import a file spool into the SQLite queue")
+    importer.add_argument("spool_dir", nargs="?", type=Path, help="spool directory (default: SMSGW_QUEUE_DIR)")
+    importer.add_argument("--db", type=Path, help=f"database path (default: {DB_PATH_ENV} or <spool>/{DB_FILENAME})")
+    importer.add_argument("--delete", action="store_true", help="remove spool files once imported")
+    args = parser.parse_args(argv)
+
+    spool_dir = args.spool_dir or sms_queue.resolve_queue_dir()
+    queue = SQLiteQueue(args.db or resolve_db_path(spool_dir))
+    try:
+        imported = import_spool(spool_dir, queue, delete=args.delete)
+    finally:
+        queue.close()
+    logging.info(
+        "Imported %s into %s",
+        ", ".join(f"{count} {state}" for state, count in imported.items()),
+        queue.path,
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
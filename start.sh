@@ -16,7 +16,11 @@ GAMMU_CONFIG_PATH="${GAMMU_CONFIG_PATH:-/etc/gammu-smsdrc}"
 log "Starting with device $DEVICE baudrate $BAUDRATE"
 
 if [[ "$DELIVERY_MODE" == "queue" ]]; then
-    RUN_ON_RECEIVE="python3 /app/on_receive.py --enqueue"
+    RUN_ON_RECEIVE="python3 -S /app/on_receive.py --enqueue"
+elif [[ "$DELIVERY_MODE" == "hybrid" ]]; then
+    RUN_ON_RECEIVE="python3 /app/on_receive.py --hybrid"
+elif [[ "$DELIVERY_MODE" == "inbox" ]]; then
+    RUN_ON_RECEIVE=""
 elif [[ "$DELIVERY_MODE" != "direct" ]]; then
     log "Unknown DELIVERY_MODE '$DELIVERY_MODE'; defaulting to direct"
     DELIVERY_MODE="direct"
@@ -40,10 +44,14 @@ inboxpath    = ${GAMMU_SPOOL_PATH}/inbox/
 outboxpath   = ${GAMMU_SPOOL_PATH}/outbox/
 sentpath     = ${GAMMU_SPOOL_PATH}/sent/
 errorpath    = ${GAMMU_SPOOL_PATH}/error/
-RunOnReceive = ${RUN_ON_RECEIVE}
 debuglevel   = ${LOGLEVEL}
 logfile      = /dev/stdout
+OutboxFormat = unicode
+TransmitFormat = auto
 EOF_CONF
+    if [[ -n "$RUN_ON_RECEIVE" ]]; then
+        echo "RunOnReceive = ${RUN_ON_RECEIVE}" >> "$GAMMU_CONFIG_PATH"
+    fi
 else
     log "Using existing smsdrc from volume"
 fi
@@ -53,9 +61,14 @@ if [ "${1:-}" = "--dry-run" ]; then
     exit 0
 fi
 
-if [[ "$DELIVERY_MODE" == "queue" ]]; then
+if [[ "$DELIVERY_MODE" != "direct" ]]; then
     log "Starting queue worker"
     python3 /app/queue_worker.py &
 fi
 
+if [[ "$DELIVERY_MODE" == "inbox" ]]; then
+    log "Starting inbox ingester"
+    python3 /app/inbox_ingest.py &
+fi
+
 exec gammu-smsd -c "$GAMMU_CONFIG_PATH"
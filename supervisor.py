@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""Process supervisor for gammu-smsd, the queue worker and the inbox ingester.
+
+Replaces the bash watchdog loop of ``entrypoint.sh``:
+
+* gammu-smsd's output is matched line by line against one compiled pattern;
+  ``MODEM_TIMEOUT_THRESHOLD`` consecutive hang lines stop it at once.
+* A hang is first answered by restarting gammu-smsd, which is usually enough
+  and takes seconds. A USB reset follows only if the modem hangs again
+  before it has run stably for ``SUPERVISOR_STABLE_SECONDS``. After a reset the
+  modem is probed every second instead of sleeping ``RESET_SETTLE_SECONDS``.
+* The queue worker and the inbox ingester are restarted with exponential
+  backoff whenever they exit.
+* SIGTERM and SIGINT stop every child gracefully.
+
+Modem detection, probing and the sysfs VID/PID reset are the shell functions
+of ``entrypoint.sh``, called through :class:`ShellHelpers`, so there is one
+implementation of each.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, TextIO
+
+import env_utils
+import logging_utils
+
+DEFAULT_ENTRYPOINT = Path(__file__).resolve().with_name("entrypoint.sh")
+DEFAULT_SMSD_CONFIG = "/tmp/gammu-smsdrc"
+DELIVERY_MODES = ("direct", "queue", "inbox", "hybrid")
+SMSD_HANG_PATTERN = re.compile(
+    r"TIMEOUT|No response in specified timeout|Probably the phone is not connected|Already hit 250 errors",
+    re.IGNORECASE,
+)
+
+
+def resolve_delivery_mode(value: str | None) -> str:
+    mode = (value or "direct").strip().lower()
+    if mode not in DELIVERY_MODES:
+        logging.warning("Unknown DELIVERY_MODE=%r; defaulting to direct", value)
+        return "direct"
+    return mode
+
+
+class ResetBackoff:
+    """The reset spacing of ``reset_usb_modem``.
+
+    The first reset is immediate. Later ones wait at least ``min_interval``
+    seconds after the previous one, plus ``step`` for every reset within
+    ``window`` seconds of the last, up to ``maximum``.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 60.0,
+        step: float = 30.0,
+        maximum: float = 300.0,
+        window: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.min_interval = min_interval
+        self.step = step
+        self.maximum = maximum
+        self.window = window
+        self._clock = clock
+        self._last: float | None = None
+        self._backoff = 0.0
+
+    @classmethod
+    def from_env(cls) -> "ResetBackoff":
+        return cls(
+            env_utils.get_float_env("RESET_MIN_INTERVAL", 60.0),
+            env_utils.get_float_env("RESET_BACKOFF_STEP", 30.0),
+            env_utils.get_float_env("RESET_BACKOFF_MAX", 300.0),
+            env_utils.get_float_env("RESET_BACKOFF_WINDOW", 300.0),
+        )
+
+    def delay(self) -> float:
+        """Seconds to wait before the next reset; call once per reset."""
+        if self._last is None:
+            return 0.0
+        since = self._clock() - self._last
+        if since < self.window:
+            self._backoff = min(self.maximum, self._backoff + self.step)
+        else:
+            self._backoff = 0.0
+        return max(0.0, self.min_interval + self._backoff - since)
+
+    def record(self) -> None:
+        self._last = self._clock()
+
+
+class ShellHelpers:
+    """Run the modem helpers of ``entrypoint.sh`` in a bash subprocess."""
+
+    def __init__(self, script: Path = DEFAULT_ENTRYPOINT, env: Dict[str, str] | None = None) -> None:
+        self.script = script
+        self.env = env
+
+    def _run(self, body: str, extra_env: Dict[str, str] | None = None) -> subprocess.CompletedProcess:
+        env = dict(os.environ if self.env is None else self.env)
+        env.update(extra_env or {})
+        # Sourced with a different $0, the script only defines its functions and skips main().
+        command = f'. "$1"; set +e; {body}'
+        return subprocess.run(
+            ["bash", "-c", command, "supervisor", str(self.script)],
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+            check=False,
+        )
+
+    def detect(self) -> str | None:
+        """Find a working modem, write the smsd config and return its port."""
+        result = self._run('resolve_delivery_mode; detect_modem >&2 && printf "%s" "$MODEM_PORT"')
+        return result.stdout.strip() if result.returncode == 0 and result.stdout.strip() else None
+
+    def probe(self, port: str) -> bool:
+        return self._run('probe_modem "$MODEM_PORT" >/dev/null', {"MODEM_PORT": port}).returncode == 0
+
+    def reset(self, port: str | None) -> bool:
+        # The settle time and backoff are handled by the supervisor.
+        extra = {"RESET_SETTLE_SECONDS": "0"}
+        if port:
+            extra["MODEM_PORT"] = port
+        return self._run("reset_usb_modem >&2", extra).returncode == 0
+
+
+class ManagedChild:
+    """A long-running child that is restarted with exponential backoff whenever it exits.
+
+    The backoff returns to ``min_delay`` once the child has stayed up for
+    ``stable_after`` seconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        argv: Sequence[str],
+        min_delay: float = 1.0,
+        max_delay: float = 30.0,
+        stable_after: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.argv = list(argv)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.restarts = 0
+        self._clock = clock
+        self._process: subprocess.Popen | None = None
+        self._started_at = 0.0
+        self._delay = min_delay
+        self._restart_at: float | None = None
+
+    @property
+    def pid(self) -> int | None:
+        return self._process.pid if self._process is not None else None
+
+    def start(self) -> None:
+        logging.info("Starting %s", self.name)
+        self._process = subprocess.Popen(self.argv)
+        self._started_at = self._clock()
+        self._restart_at = None
+
+    def poll(self) -> None:
+        """Notice an exit and restart the child once its backoff has passed."""
+        now = self._clock()
+        if self._restart_at is not None:
+            if now >= self._restart_at:
+                self.restarts += 1
+                self.start()
+            return
+        if self._process is None or self._process.poll() is None:
+            return
+        if now - self._started_at >= self.stable_after:
+            self._delay = self.min_delay
+        logging.warning("%s exited (rc=%s); restarting in %.1fs", self.name, self._process.returncode, self._delay)
+        self._restart_at = now + self._delay
+        self._delay = min(self.max_delay, self._delay * 2)
+
+    def stop(self, timeout: float) -> None:
+        self._restart_at = None
+        terminate(self._process, timeout)
+
+
+def terminate(process: subprocess.Popen | None, timeout: float) -> None:
+    """SIGTERM, then SIGKILL if the process is still running after ``timeout`` seconds."""
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class Supervisor:
+    """Keep gammu-smsd running on a working modem and the delivery processes alive."""
+
+    def __init__(
+        self,
+        smsd_argv: Sequence[str],
+        helpers: ShellHelpers,
+        children: Sequence[ManagedChild] = (),
+        threshold: int = 3,
+        backoff: ResetBackoff | None = None,
+        settle: float = 20.0,
+        stable_after: float = 300.0,
+        detect_retry: float = 5.0,
+        reset_after: float = 60.0,
+        stop_timeout: float = 10.0,
+        output: TextIO | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.smsd_argv = list(smsd_argv)
+        self.helpers = helpers
+        self.children = list(children)
+        self.threshold = max(1, threshold)
+        self.backoff = backoff or ResetBackoff()
+        self.settle = settle
+        self.stable_after = stable_after
+        self.detect_retry = detect_retry
+        self.reset_after = reset_after
+        self.stop_timeout = stop_timeout
+        self.output = output
+        self.resets = 0
+        self.smsd_starts = 0
+        self._clock = clock
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._hang = threading.Event()
+        self._smsd: subprocess.Popen | None = None
+        self._port: str | None = None
+        self._soft_restart_ok = True
+
+    def request_stop(self, *_: object) -> None:
+        self._stopping.set()
+        self._wake.set()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping.is_set()
+
+    def _sleep(self, seconds: float, step: float = 0.5) -> bool:
+        """Wait while tending the children; returns False as soon as a stop is requested."""
+        deadline = self._clock() + seconds
+        while not self.stopping:
+            self._poll_children()
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                return True
+            self._wake.wait(min(step, remaining))
+            self._wake.clear()
+        return False
+
+    def _poll_children(self) -> None:
+        for child in self.children:
+            child.poll()
+
+    def run(self) -> int:
+        for child in self.children:
+            child.start()
+        try:
+            while not self.stopping:
+                if not self._wait_for_modem():
+                    break
+                outcome = self._run_smsd()
+                if outcome == "hang":
+                    self._recover()
+                elif outcome == "exit":
+                    logging.warning("[watchdog] gammu-smsd exited; restarting detection")
+        finally:
+            self._shutdown()
+        return 0
+
+    def _wait_for_modem(self) -> bool:
+        logging.info("Starting modem detection")
+        started = self._clock()
+        while not self.stopping:
+            port = self.helpers.detect()
+            if port:
+                self._port = port
+                return True
+            if self._clock() - started > self.reset_after:
+                self._reset()
+                started = self._clock()
+            logging.info("Modem not detected yet; retrying in %.0fs", self.detect_retry)
+            if not self._sleep(self.detect_retry):
+                return False
+        return False
+
+    def _read_smsd(self, stream: TextIO) -> None:
+        count = 0
+        for line in stream:
+            if self.output is not None:
+                self.output.write(line)
+                self.output.flush()
+            if SMSD_HANG_PATTERN.search(line):
+                count += 1
+                logging.warning("[watchdog] Modem timeout pattern %s/%s", count, self.threshold)
+                if count >= self.threshold:
+                    self._hang.set()
+                    self._wake.set()
+            else:
+                count = 0
+        self._wake.set()
+
+    def _run_smsd(self) -> str:
+        """Run gammu-smsd until it exits, hangs or a stop is requested."""
+        logging.info("Starting sms-daemon on %s", self._port)
+        self._hang.clear()
+        self._smsd = subprocess.Popen(
+            self.smsd_argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
+        )
+        self.smsd_starts += 1
+        started = self._clock()
+        reader = threading.Thread(target=self._read_smsd, args=(self._smsd.stdout,), daemon=True)
+        reader.start()
+        try:
+            while not self.stopping and not self._hang.is_set() and self._smsd.poll() is None:
+                self._poll_children()
+                self._wake.wait(0.5)
+                self._wake.clear()
+            if self._clock() - started >= self.stable_after:
+                self._soft_restart_ok = True
+            if self._hang.is_set():
+                logging.warning("[watchdog] Threshold reached; stopping gammu-smsd")
+                return "hang"
+            return "stop" if self.stopping else "exit"
+        finally:
+            terminate(self._smsd, self.stop_timeout)
+            reader.join(self.stop_timeout)
+            self._smsd = None
+
+    def _recover(self) -> None:
+        if self._soft_restart_ok:
+            # A restart clears most hangs without touching the USB bus.
+            self._soft_restart_ok = False
+            logging.warning("[watchdog] Restarting gammu-smsd before resetting USB")
+            return
+        self._reset()
+        self._soft_restart_ok = True
+
+    def _reset(self) -> None:
+        delay = self.backoff.delay()
+        if delay > 0:
+            logging.info("[watchdog] Backoff active; waiting %.0fs before reset", delay)
+            if not self._sleep(delay):
+                return
+        logging.warning("[watchdog] Resetting USB modem")
+        self.helpers.reset(self._port)
+        self.backoff.record()
+        self.resets += 1
+        if self._port:
+            # Poll instead of sleeping the whole settle time: most modems
+            # re-enumerate and answer again within a few seconds.
+            deadline = self._clock() + self.settle
+            while self._clock() < deadline and not self.helpers.probe(self._port):
+                if not self._sleep(1.0):
+                    return
+
+    def _shutdown(self) -> None:
+        terminate(self._smsd, self.stop_timeout)
+        for child in self.children:
+            child.stop(self.stop_timeout)
+
+
+def build_children(
+    mode: str,
+    python: str = sys.executable,
+    app_dir: Path | None = None,
+    outbox: bool = False,
+    workers: int = 1,
+    health: bool = False,
+) -> List[ManagedChild]:
+    app_dir = app_dir or Path(__file__).resolve().parent
+    children = []
+    if outbox:
+        children.append(ManagedChild("outbox", [python, str(app_dir / "outbox.py")]))
+    if health:
+        children.append(ManagedChild("health server", [python, str(app_dir / "health.py")]))
+    if mode in ("queue", "inbox", "hybrid"):
+        worker = [python, str(app_dir / "queue_worker.py")]
+        if workers <= 1:
+            children.append(ManagedChild("queue worker", worker))
+        else:
+            for index in range(workers):
+                children.append(ManagedChild(f"queue worker {index}", worker + ["--shard", f"{index}/{workers}"]))
+    if mode == "inbox":
+        children.append(ManagedChild("inbox ingester", [python, str(app_dir / "inbox_ingest.py")]))
+    return children
+
+
+def smsd_command(config: str = DEFAULT_SMSD_CONFIG) -> List[str]:
+    return ["stdbuf", "-oL", "-eL", "gammu-smsd", "-c", config] if _which("stdbuf") else ["gammu-smsd", "-c", config]
+
+
+def _which(name: str) -> bool:
+    return any(os.access(os.path.join(path, name), os.X_OK) for path in os.get_exec_path())
+
+
+def main() -> int:
+    logging_utils.configure_logging(text_format="[supervisor] %(message)s")
+    os.environ.setdefault("GAMMU_SPOOL_PATH", "/var/spool/gammu")
+    mode = resolve_delivery_mode(os.getenv("DELIVERY_MODE"))
+    supervisor = Supervisor(
+        smsd_command(),
+        ShellHelpers(),
+        build_children(
+            mode,
+            outbox=env_utils.get_int_env("OUTBOX_API_PORT", 0) > 0,
+            workers=env_utils.get_int_env("QUEUE_WORKERS", 1),
+            health=env_utils.get_int_env("HEALTH_PORT", 0) > 0,
+        ),
+        threshold=env_utils.get_int_env("MODEM_TIMEOUT_THRESHOLD", 3),
+        backoff=ResetBackoff.from_env(),
+        settle=env_utils.get_float_env("RESET_SETTLE_SECONDS", 20.0),
+        stable_after=env_utils.get_float_env("SUPERVISOR_STABLE_SECONDS", 300.0),
+        stop_timeout=env_utils.get_float_env("SUPERVISOR_STOP_TIMEOUT", 10.0),
+        output=sys.stdout,
+    )
+    signal.signal(signal.SIGTERM, supervisor.request_stop)
+    signal.signal(signal.SIGINT, supervisor.request_stop)
+    return supervisor.run()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Shared Telegram Bot API client with keep-alive connection pooling."""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import env_utils
+import metrics
+import rate_limit
+
+API_URL_ENV = "TELEGRAM_API_URL"
+DEFAULT_API_URL = "https://api.telegram.org"
+
+
+class TelegramAPIError(requests.HTTPError):
+    """HTTP error from the Bot API, carrying its ``retry_after`` hint when present."""
+
+    def __init__(self, message: str, response: requests.Response, retry_after: float | None = None) -> None:
+        super().__init__(message, response=response)
+        self.status_code = response.status_code
+        self.retry_after = retry_after
+
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def get_timeouts() -> Tuple[float, float]:
+    return (
+        env_utils.get_float_env("TELEGRAM_CONNECT_TIMEOUT", 5.0),
+        env_utils.get_float_env("TELEGRAM_READ_TIMEOUT", 10.0),
+    )
+
+
+def build_session(pool_size: int) -> requests.Session:
+    """Create a session whose adapter keeps up to ``pool_size`` idle connections per host."""
+    pool_size = max(1, pool_size)
+    session = requests.Session()
+    # Retries are handled by the callers, which know whether to sleep or reschedule.
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session(env_utils.get_int_env("TELEGRAM_POOL_SIZE", 10))
+        return _session
+
+
+def reset_session() -> None:
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def api_url(bot_token: str, method: str = "sendMessage") -> str:
+    base = (os.getenv(API_URL_ENV) or DEFAULT_API_URL).rstrip("/")
+    return f"{base}/bot{bot_token}/{method}"
+
+
+def send_message(
+    bot_token: str,
+    payload: Dict[str, str],
+    timeout: float | Tuple[float, float] | None = None,
+) -> requests.Response:
+    """POST ``payload`` to sendMessage over the shared session and raise on HTTP errors.
+
+    The send first waits for the process-wide rate limiter; a 429 response
+    pauses further sends to the same chat for its ``retry_after``.
+    """
+    chat_id = str(payload.get("chat_id", ""))
+    limiter = rate_limit.get_limiter()
+    limiter.acquire(chat_id)
+    started = time.perf_counter()
+    try:
+        response = get_session().post(
+            api_url(bot_token),
+            json=payload,
+            timeout=timeout if timeout is not None else get_timeouts(),
+        )
+    except requests.RequestException:
+        metrics.TELEGRAM_REQUESTS.inc(code="error")
+        raise
+    finally:
+        metrics.TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started)
+    metrics.TELEGRAM_REQUESTS.inc(code=response.status_code)
+    if response.status_code >= 400:
+        error = api_error(response)
+        if error.retry_after:
+            limiter.penalize(chat_id, error.retry_after)
+        raise error
+    return response
+
+
+def parse_retry_after(response: requests.Response) -> float | None:
+    """Return the flood-wait delay from a 429 body (``parameters.retry_after``) or header."""
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if isinstance(body, dict):
+        parameters = body.get("parameters")
+        if isinstance(parameters, dict) and isinstance(parameters.get("retry_after"), (int, float)):
+            return float(parameters["retry_after"])
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            return None
+    return None
+
+
+def api_error(response: requests.Response) -> TelegramAPIError:
+    """Build the error for a failed Bot API response from its status and ``description``."""
+    description = ""
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if isinstance(body, dict) and isinstance(body.get("description"), str):
+        description = body["description"]
+    message = f"{response.status_code} {response.reason or ''}".strip()
+    if description:
+        message = f"{message}: {description}"
+    retry_after = parse_retry_after(response) if response.status_code == 429 else None
+    return TelegramAPIError(message, response, retry_after)
@@ -0,0 +1,11 @@
+import pytest
+
+import rate_limit
+
+
+@pytest.fixture(autouse=True)
+def unlimited_telegram_rate():
+    """Tests send bursts to one chat; rate limiting is covered in test_rate_limit.py."""
+    rate_limit.set_limiter(rate_limit.RateLimiter(global_rate=0, chat_rate=0))
+    yield
+    rate_limit.set_limiter(None)
@@ -0,0 +1,29 @@
+import pytest
+import requests
+
+from benchmarks import bench_pipeline
+from benchmarks.stub_telegram import StubTelegramServer
+
+
+def test_stub_injects_errors_and_flood_waits():
+    with StubTelegramServer(error_rate=0.5, flood_rate=0.5, retry_after=7, seed=1) as server:
+        responses = [requests.post(f"{server.url}/botx/sendMessage", json={"text": "x"}, timeout=5) for _ in range(20)]
+    assert {response.status_code for response in responses} == {500, 429}
+    flood = next(response for response in responses if response.status_code == 429)
+    assert flood.json()["parameters"]["retry_after"] == 7
+    assert server.errors + server.floods == 20 and not server.requests
+
+
+@pytest.mark.parametrize("source", ["on_receive", "enqueue"])
+def test_pipeline_delivers_everything_under_faults(source):
+    result = bench_pipeline.run_benchmark(
+        messages=40, source=source, error_rate=0.1, flood_rate=0.05, retry_after=0, concurrency=2, timeout=60
+    )
+    assert result["delivered"] == 40
+    assert result["http_errors"] + result["http_429"] > 0
+    assert 0 < result["latency_p50"] <= result["latency_p99"]
+    assert result["worker_cpu_seconds"] > 0 and result["worker_max_rss_mb"] > 0
+    # Regression guards for the durable path: one file and one directory
+    # fsync per enqueue, and a bounded number per delivery attempt.
+    assert result["producer_fsyncs_per_message"] == 2
+    assert 0 < result["worker_fsyncs_per_message"] < 12
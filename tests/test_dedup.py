@@ -0,0 +1,74 @@
+from unittest import mock
+
+import pytest
+
+import dedup
+import queue_worker
+import sms_queue
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = dedup.DeliveryLedger(tmp_path / "dedup.sqlite3", ttl=3600, window=60)
+    dedup.set_ledger(ledger)
+    yield ledger
+    dedup.set_ledger(None)
+    ledger.close()
+
+
+def test_ledger_records_ids_and_contents(tmp_path):
+    now = [1000.0]
+    ledger = dedup.DeliveryLedger(tmp_path / "dedup.sqlite3", ttl=100, window=60, clock=lambda: now[0])
+    payload = {"number": "+1", "text": "hello", "received_at": 990.0}
+    ledger.record([("a", payload, "chat")])
+    assert ledger.delivered("a") and not ledger.delivered("b")
+    assert ledger.duplicate_of({"number": "+1", "text": "hello", "received_at": 1040.0}, "chat") == 990.0
+    assert ledger.duplicate_of({"number": "+1", "text": "hello", "received_at": 1100.0}, "chat") is None
+    assert ledger.duplicate_of({"number": "+1", "text": "hello", "received_at": 1000.0}, "other") is None
+    assert ledger.duplicate_of({"number": "+2", "text": "hello", "received_at": 1000.0}, "chat") is None
+
+    ledger.close()
+    reopened = dedup.DeliveryLedger(tmp_path / "dedup.sqlite3", ttl=100, window=60, clock=lambda: now[0])
+    assert reopened.delivered("a")
+    now[0] = 1060.0
+    assert reopened.evict() == 1
+    assert reopened.delivered("a")
+    now[0] = 1200.0
+    assert reopened.evict() == 1
+    assert not reopened.delivered("a")
+    reopened.close()
+
+
+def test_crash_between_send_and_ack_does_not_resend(tmp_path, ledger):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+1", "hello")
+    with mock.patch("queue_worker.telegram_client.send_message") as send:
+        with mock.patch.object(queue, "ack", side_effect=SystemExit("killed")):
+            with pytest.raises(SystemExit):
+                queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0)
+        assert queue.recover() == 1
+        queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0)
+    send.assert_called_once()
+    assert queue.counts()["sent"] == 1
+
+
+def test_repeated_sms_within_window_is_skipped(tmp_path, ledger):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    first = sms_queue.build_payload("+1", "code 1234")
+    repeat = dict(first, id=sms_queue.new_message_id(), received_at=first["received_at"] + 30)
+    later = dict(first, id=sms_queue.new_message_id(), received_at=first["received_at"] + 300)
+    with mock.patch("queue_worker.telegram_client.send_message") as send:
+        for payload in (first, repeat, later):
+            queue.enqueue_payloads([payload])
+            queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0)
+    assert send.call_count == 2
+    assert queue.counts()["sent"] == 3
+
+
+def test_coalesced_group_is_recorded(tmp_path, ledger):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    ids = queue.enqueue_many([("+1", "a", None), ("+2", "b", None)])
+    with mock.patch("queue_worker.telegram_client.send_message") as send:
+        queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0, coalesce_window=10)
+    send.assert_called_once()
+    assert all(ledger.delivered(message_id) for message_id in ids)
@@ -1,11 +1,19 @@
 import json
+import os
+import subprocess
+import sys
+import threading
+import time
 from unittest import mock
 
+import pytest
 import requests
 
 import on_receive
 import queue_worker
 import sms_queue
+import telegram_client
+from benchmarks.stub_telegram import StubTelegramServer
 
 
 def test_enqueue_message(tmp_path):
@@ -19,16 +27,137 @@ def test_enqueue_message(tmp_path):
     assert list((base_dir / "tmp").iterdir()) == []
 
 
-@mock.patch("queue_worker.time.sleep", return_value=None)
-@mock.patch("queue_worker.requests.post")
-def test_worker_retries(mock_post, mock_sleep):
-    response = mock.Mock()
-    response.raise_for_status.return_value = None
-    mock_post.side_effect = [requests.RequestException("fail"), response]
+def test_failed_delivery_is_rescheduled(tmp_path):
+    base_dir = tmp_path / "queue"
+    sms_queue.enqueue_message("123", "hi", base_dir)
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+
+    with mock.patch("queue_worker.telegram_client.send_message", side_effect=requests.RequestException("fail")):
+        assert queue_worker.process_queue_once(queue, "token", "chat", 3, 10.0)
+        # The retry is not due yet, so the next pass does nothing.
+        assert not queue_worker.process_queue_once(queue, "token", "chat", 3, 10.0)
+
+    (item,) = dirs["pending"].glob("*.json")
+    payload = json.loads(item.read_text())
+    assert payload["attempts"] == 1
+    assert payload["last_error"] == "fail"
+    assert time.time() + 4 <= payload["next_attempt_at"] <= time.time() + 10.5
+
+    with mock.patch("queue_worker.time.time", return_value=payload["next_attempt_at"] + 1):
+        with mock.patch("queue_worker.telegram_client.send_message") as mock_send:
+            assert queue_worker.process_queue_once(queue, "token", "chat", 3, 10.0)
+    mock_send.assert_called_once()
+    assert len(list(dirs["sent"].glob("*.json"))) == 1
+
+
+def test_retries_exhausted_moves_to_failed(tmp_path):
+    base_dir = tmp_path / "queue"
+    sms_queue.enqueue_message("123", "hi", base_dir)
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+
+    with mock.patch("queue_worker.telegram_client.send_message", side_effect=requests.RequestException("down")):
+        for _ in range(2):
+            queue_worker.process_queue_once(queue, "token", "chat", 2, 0.0)
+
+    (item,) = dirs["failed"].glob("*.json")
+    payload = json.loads(item.read_text())
+    assert payload["attempts"] == 2
+    assert payload["last_error"] == "down"
+    assert queue.requeue_failed() == 1
+    (item,) = dirs["pending"].glob("*.json")
+    assert "attempts" not in json.loads(item.read_text())
+
+
+def test_not_due_item_blocks_its_chat_only(tmp_path):
+    base_dir = tmp_path / "queue"
+    sms_queue.enqueue_message("123", "a0", base_dir, chat_id="chat-a")
+    sms_queue.enqueue_message("123", "a1", base_dir, chat_id="chat-a")
+    sms_queue.enqueue_message("456", "b0", base_dir, chat_id="chat-b")
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+    head = sorted(dirs["pending"].glob("*.json"))[0]
+    payload = json.loads(head.read_text())
+    payload["next_attempt_at"] = time.time() + 60
+    head.write_text(json.dumps(payload))
+
+    with mock.patch("queue_worker.send_once") as mock_send:
+        assert queue_worker.process_queue_once(queue, "token", "default", 3, 1.0)
+    assert [call.args[1:] for call in mock_send.call_args_list] == [("chat-b", "456", "b0")]
+    assert len(list(dirs["pending"].glob("*.json"))) == 2
+
+
+def test_compute_backoff():
+    assert queue_worker.compute_backoff(1, 5.0, 300.0, rng=lambda: 1.0) == 5.0
+    assert queue_worker.compute_backoff(3, 5.0, 300.0, rng=lambda: 0.0) == 10.0
+    assert queue_worker.compute_backoff(20, 5.0, 300.0, rng=lambda: 1.0) == 300.0
+    assert queue_worker.compute_backoff(2, 5.0, 300.0, retry_after=42) == 42.0
+
+
+def test_retry_after_from_429(tmp_path):
+    base_dir = tmp_path / "queue"
+    sms_queue.enqueue_message("123", "hi", base_dir)
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps(
+        {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 17}}
+    ).encode()
+
+    with mock.patch("telegram_client.get_session") as mock_session:
+        mock_session.return_value.post.return_value = response
+        started = time.time()
+        queue_worker.process_queue_once(queue, "token", "chat", 5, 1.0)
+
+    (item,) = dirs["pending"].glob("*.json")
+    payload = json.loads(item.read_text())
+    assert "429" in payload["last_error"]
+    assert started + 17 <= payload["next_attempt_at"] <= time.time() + 17
+
 
-    assert queue_worker.send_with_retries("token", "chat", "123", "hi", max_attempts=2, retry_delay=0.01)
-    assert mock_post.call_count == 2
-    assert mock_sleep.call_count == 1
+def rejecting_send(status, description):
+    """``send_message`` stand-in that the Bot API rejects for any text containing "poison"."""
+    sent = []
+
+    def send(token, payload):
+        if "poison" in payload["text"]:
+            response = requests.Response()
+            response.status_code = status
+            response._content = json.dumps({"ok": False, "description": description}).encode()
+            raise telegram_client.api_error(response)
+        sent.append(payload["text"])
+
+    return send, sent
+
+
+@pytest.mark.parametrize("coalesce_window", [0.0, 60.0])
+def test_rejected_head_does_not_stall_its_chat(tmp_path, coalesce_window):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue_many(("+1", text, None) for text in ("poison", "first", "second"))
+    send, sent = rejecting_send(400, "Bad Request: chat not found")
+    with mock.patch("queue_worker.telegram_client.send_message", side_effect=send):
+        # Unlimited retries would otherwise hold the chat behind the head forever.
+        assert queue_worker.process_queue_once(queue, "token", "chat", 0, 60.0, coalesce_window=coalesce_window)
+    assert [text.rsplit("\n", 1)[-1] for text in sent] == ["first", "second"]
+    assert queue.counts() == {"pending": 0, "processing": 0, "sent": 2, "failed": 1}
+    (failed,) = queue.oldest("failed", 1)
+    assert failed.payload["last_error"] == "400: Bad Request: chat not found"
+
+
+def test_permanent_failures():
+    def error(status, cls=telegram_client.TelegramAPIError):
+        response = requests.Response()
+        response.status_code = status
+        return cls("error", response=response) if cls is requests.HTTPError else telegram_client.api_error(response)
+
+    assert queue_worker.permanent_failure(error(400)) and queue_worker.permanent_failure(error(403))
+    # A bad token or API URL holds every message until it is fixed.
+    assert not any(queue_worker.permanent_failure(error(status)) for status in (401, 404, 408, 429, 500))
+    assert queue_worker.permanent_failure(error(404, requests.HTTPError))
+    assert not queue_worker.permanent_failure(error(503, requests.HTTPError))
+    assert not queue_worker.permanent_failure(requests.ConnectionError("down"))
 
 
 def test_direct_mode_sends_immediately(monkeypatch):
@@ -42,3 +171,335 @@ def test_direct_mode_sends_immediately(monkeypatch):
     with mock.patch("on_receive.send_to_telegram") as mock_send:
         on_receive.main([])
     mock_send.assert_called_once()
+
+
+def test_pool_delivers_in_order_per_chat(tmp_path):
+    base_dir = tmp_path / "queue"
+    for index in range(4):
+        sms_queue.enqueue_message("123", f"a{index}", base_dir, chat_id="chat-a")
+        sms_queue.enqueue_message("456", f"b{index}", base_dir, chat_id="chat-b")
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+    delivered = []
+
+    def fake_send(bot_token, chat_id, number, text):
+        time.sleep(0.01)
+        delivered.append((chat_id, text))
+
+    pool = queue_worker.DeliveryPool(2)
+    try:
+        with mock.patch("queue_worker.send_once", side_effect=fake_send):
+            assert queue_worker.process_queue_once(queue, "token", "default", 1, 0.0, pool)
+            pool.drain()
+    finally:
+        pool.shutdown()
+
+    assert [text for chat, text in delivered if chat == "chat-a"] == ["a0", "a1", "a2", "a3"]
+    assert [text for chat, text in delivered if chat == "chat-b"] == ["b0", "b1", "b2", "b3"]
+    assert len(list(dirs["sent"].glob("*.json"))) == 8
+    assert list(dirs["pending"].glob("*.json")) == []
+
+
+def test_pool_leaves_busy_chat_pending(tmp_path):
+    base_dir = tmp_path / "queue"
+    sms_queue.enqueue_message("123", "first", base_dir)
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+    release = threading.Event()
+
+    def blocking_send(*args):
+        release.wait(5)
+
+    pool = queue_worker.DeliveryPool(2)
+    try:
+        with mock.patch("queue_worker.send_once", side_effect=blocking_send):
+            assert queue_worker.process_queue_once(queue, "token", "chat", 1, 0.0, pool)
+            sms_queue.enqueue_message("123", "second", base_dir)
+            assert not queue_worker.process_queue_once(queue, "token", "chat", 1, 0.0, pool)
+            assert len(list(dirs["pending"].glob("*.json"))) == 1
+            release.set()
+            pool.drain()
+            assert queue_worker.process_queue_once(queue, "token", "chat", 1, 0.0, pool)
+            pool.drain()
+    finally:
+        release.set()
+        pool.shutdown()
+
+    assert len(list(dirs["sent"].glob("*.json"))) == 2
+
+
+def test_pool_lane_stops_after_failure(tmp_path):
+    base_dir = tmp_path / "queue"
+    for index in range(3):
+        sms_queue.enqueue_message("123", f"m{index}", base_dir)
+    queue = sms_queue.FileQueue(base_dir)
+    dirs = queue.dirs
+
+    pool = queue_worker.DeliveryPool(2)
+    try:
+        with mock.patch("queue_worker.send_once", side_effect=requests.RequestException("fail")) as mock_send:
+            assert queue_worker.process_queue_once(queue, "token", "chat", 5, 30.0, pool)
+            pool.drain()
+    finally:
+        pool.shutdown()
+
+    assert mock_send.call_count == 1
+    pending = sorted(dirs["pending"].glob("*.json"))
+    assert [json.loads(item.read_text())["text"] for item in pending] == ["m0", "m1", "m2"]
+    assert json.loads(pending[0].read_text())["attempts"] == 1
+    assert list(dirs["processing"].glob("*.json")) == []
+
+
+def test_group_commit_batches_dir_fsyncs(tmp_path):
+    def run(queue):
+        for index in range(10):
+            queue.enqueue("123", f"m{index}")
+        with mock.patch("sms_queue._fsync_dir") as mock_fsync:
+            for item in list(queue.pending()):
+                queue.ack(queue.claim(item))
+            queue.flush()
+        return mock_fsync.call_count
+
+    assert run(sms_queue.FileQueue(tmp_path / "plain")) == 20
+    batched = sms_queue.FileQueue(tmp_path / "batched", group_commit_window=60)
+    assert run(batched) == 2
+    assert len(list(batched.dirs["sent"].glob("*.json"))) == 10
+
+
+def test_group_commit_window_flushes_on_timer(tmp_path):
+    batcher = sms_queue.DirSyncBatcher(0.05)
+    with mock.patch("sms_queue._fsync_dir") as mock_fsync:
+        batcher.mark(tmp_path)
+        batcher.mark(tmp_path)
+        deadline = time.monotonic() + 5
+        while not mock_fsync.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+    mock_fsync.assert_called_once_with(tmp_path)
+
+
+def test_group_commit_env(tmp_path):
+    env = {"SMSGW_QUEUE_DIR": str(tmp_path), "QUEUE_GROUP_COMMIT_MS": "250"}
+    assert sms_queue.open_queue(env.get)._batcher.window == 0.25
+    env["QUEUE_GROUP_COMMIT_MS"] = "nope"
+    assert sms_queue.open_queue(env.get)._batcher is None
+
+
+def make_item(number, text, received_at):
+    return sms_queue.QueueItem(f"{number}-{text}", {"number": number, "text": text, "received_at": received_at})
+
+
+def test_coalesce_respects_window_and_length_limit():
+    items = [make_item("+1", "a", 100.0), make_item("+2", "b", 101.0), make_item("+1", "c", 104.0)]
+    assert [len(group) for group in queue_worker.coalesce(items, 0)] == [1, 1, 1]
+    assert [len(group) for group in queue_worker.coalesce(items, 2.0)] == [2, 1]
+    assert [len(group) for group in queue_worker.coalesce(items, 10.0)] == [3]
+    # "+1\na" renders to 4 characters, plus 2 for each separator.
+    assert [len(group) for group in queue_worker.coalesce(items, 10.0, limit=10)] == [2, 1]
+    big = [make_item("+1", "x" * 3000, 100.0), make_item("+1", "y" * 1200, 100.5)]
+    assert [len(group) for group in queue_worker.coalesce(big, 10.0)] == [1, 1]
+
+
+def test_coalesced_delivery_sends_one_message_per_chat(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+100", "Code 1 <b>")
+    queue.enqueue("+200", "Code 2")
+    queue.enqueue("+300", "Other chat", chat_id="other")
+
+    with mock.patch("queue_worker.telegram_client.send_message") as mock_send:
+        assert queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0, coalesce_window=5.0)
+
+    assert mock_send.call_count == 2
+    payloads = {call.args[1]["chat_id"]: call.args[1] for call in mock_send.call_args_list}
+    assert payloads["chat"]["text"] == "<b>+100</b>\nCode 1 &lt;b&gt;\n\n<b>+200</b>\nCode 2"
+    assert payloads["chat"]["parse_mode"] == "HTML"
+    assert payloads["other"]["text"] == on_receive.build_telegram_payload("other", "+300", "Other chat")["text"]
+    assert queue.counts()["sent"] == 3
+
+
+def test_coalesced_failure_retries_only_the_head(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    for index in range(3):
+        queue.enqueue("+100", f"m{index}")
+
+    with mock.patch("queue_worker.telegram_client.send_message", side_effect=requests.RequestException("fail")) as send:
+        assert queue_worker.process_queue_once(queue, "token", "chat", 3, 10.0, coalesce_window=5.0)
+    send.assert_called_once()
+    payloads = [item.payload for item in queue.pending()]
+    assert [payload["text"] for payload in payloads] == ["m0", "m1", "m2"]
+    assert [payload.get("attempts") for payload in payloads] == [1, None, None]
+
+
+def test_recover_only_takes_expired_leases(tmp_path):
+    first = sms_queue.FileQueue(tmp_path)
+    second = sms_queue.FileQueue(tmp_path)
+    first.enqueue("+1", "held")
+    first.enqueue("+1", "abandoned")
+    held, abandoned = [first.claim(item) for item in first.pending()]
+    old = time.time() - 600
+    os.utime(abandoned.handle, (old, old))
+    # A renewal every third of the lease keeps a live worker's items.
+    os.utime(held.handle, (old, old))
+    assert first.renew() == 2
+    os.utime(abandoned.handle, (old, old))
+
+    assert second.recover(lease=60) == 1
+    assert [item.payload["text"] for item in second.pending()] == ["abandoned"]
+    assert first.recover(lease=0.001) == 0
+    first.ack(held)
+    assert first.renew() == 0
+
+
+@pytest.mark.parametrize("record_format", ["json", "record"])
+def test_shards_partition_pending_by_lane(tmp_path, record_format):
+    queue = sms_queue.FileQueue(tmp_path, record_format=record_format)
+    ids = {queue.enqueue("+1", str(index), chat_id=f"chat-{index % 8}") for index in range(40)}
+    routed = dict(sms_queue.build_payload("+1", "routed", "chat-0"), destination="telegram:-100")
+    ids.update(queue.enqueue_payloads([routed]) + [queue.enqueue("+1", "default")])
+    shards = [
+        list(sms_queue.FileQueue(tmp_path, shard=(index, 3), default_chat_id="chat-0").pending()) for index in range(3)
+    ]
+    assert {item.id for shard in shards for item in shard} == ids
+    assert sum(len(shard) for shard in shards) == 42 and all(shards)
+    # A lane is never split between workers; chat-less items ride with the default chat.
+    lanes = [{queue_worker.lane_key(item.meta, "chat-0") for item in shard} for shard in shards]
+    assert sum(len(lane) for lane in lanes) == len(set.union(*lanes)) == 9
+    assert sms_queue.parse_shard("2/3") == (2, 3)
+    for bad in ("3/3", "x", "1"):
+        with pytest.raises(ValueError):
+            sms_queue.parse_shard(bad)
+
+
+@pytest.mark.parametrize("sharding", ["true", "false"])
+def test_several_workers_deliver_each_message_once(tmp_path, sharding):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue_many(("+1", f"m{index}", None) for index in range(60))
+    env = dict(os.environ)
+    env.update(
+        {
+            "SMSGW_QUEUE_DIR": str(tmp_path / "queue"),
+            "TELEGRAM_BOT_TOKEN": "token",
+            "TELEGRAM_CHAT_ID": "chat",
+            "QUEUE_SHARDING": sharding,
+            "QUEUE_POLL_INTERVAL": "0.2",
+            "TELEGRAM_RATE_GLOBAL": "0",
+            "TELEGRAM_RATE_CHAT": "0",
+        }
+    )
+    with StubTelegramServer(latency=0.005) as server:
+        env["TELEGRAM_API_URL"] = server.url
+        workers = [
+            subprocess.Popen([sys.executable, "queue_worker.py", "--shard", f"{index}/3"], env=env)
+            for index in range(3)
+        ]
+        try:
+            deadline = time.monotonic() + 30
+            while queue.count("sent") < 60 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.3)
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait(timeout=10)
+        texts = [request["payload"]["text"] for request in server.requests]
+    assert len(texts) == 60 and len(set(texts)) == 60
+    assert queue.counts() == {"pending": 0, "processing": 0, "sent": 60, "failed": 0}
+
+
+def test_split_message_resumes_after_the_parts_already_sent(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+1", "word " * 2000)
+    sent = []
+
+    def flaky_send(bot_token, payload):
+        if len(sent) == 1 and not flaky_send.failed:
+            flaky_send.failed = True
+            raise requests.ConnectionError("reset")
+        sent.append(payload["text"])
+
+    flaky_send.failed = False
+    with mock.patch("queue_worker.telegram_client.send_message", side_effect=flaky_send):
+        queue_worker.process_queue_once(queue, "token", "chat", 5, 0.0)
+        (item,) = queue.pending()
+        assert item.payload["parts_sent"] == 1
+        queue_worker.process_queue_once(queue, "token", "chat", 5, 0.0)
+    assert [text.split("\n", 1)[0] for text in sent] == ["<b>+1</b> (1/3)", "<b>+1</b> (2/3)", "<b>+1</b> (3/3)"]
+    assert queue.counts()["sent"] == 1
+
+
+def test_record_round_trip_and_header():
+    payload = sms_queue.build_payload("+1", "Grüße \ud83d", chat_id="chat-a")
+    payload.update(attempts=2, next_attempt_at=1234.5, destination="route-1")
+    data = sms_queue.encode_record(payload)
+    assert sms_queue.decode_record(data) == payload
+    meta, _, _ = sms_queue._record_header(data)
+    assert meta == {
+        "attempts": 2,
+        "destination": "route-1",
+        "chat_id": "chat-a",
+        "next_attempt_at": 1234.5,
+        "received_at": payload["received_at"],
+    }
+    with pytest.raises(ValueError):
+        sms_queue.decode_record(data[:-1])
+    with pytest.raises(ValueError):
+        sms_queue.decode_record(b"{}" + data)
+
+
+def test_record_spool_reads_headers_and_keeps_legacy_json(tmp_path):
+    base_dir = tmp_path / "queue"
+    legacy = sms_queue.enqueue_message("+1", "old", base_dir)
+    queue = sms_queue.FileQueue(base_dir, record_format="record")
+    new_id = queue.enqueue("+2", "new", chat_id="chat-b")
+    assert (queue.dirs["pending"] / f"{new_id}.rec").exists() and legacy.suffix == ".json"
+    assert queue.enqueue_payloads([{"id": new_id, "number": "+2", "text": "again"}]) == [new_id]
+    assert queue.count("pending") == 2
+
+    with mock.patch("sms_queue.load_payload", wraps=sms_queue.load_payload) as load:
+        items = list(queue.pending())
+        assert load.call_count == 1
+        assert items[1].meta["chat_id"] == "chat-b" and "text" not in items[1].meta
+        assert items[1].payload["text"] == "new"
+        assert load.call_count == 2
+
+    with mock.patch("queue_worker.send_once", side_effect=[None, requests.RequestException("down")]) as send:
+        queue_worker.process_queue_once(queue, "token", "chat", 5, 30.0)
+    assert send.call_count == 2
+    (item,) = queue.pending()
+    assert item.handle.suffix == ".rec" and item.meta["attempts"] == 1
+    assert item.meta["next_attempt_at"] > time.time()
+    assert queue.counts() == {"pending": 1, "processing": 0, "sent": 1, "failed": 0}
+
+
+def test_pending_index_follows_transitions_arrivals_and_rescans(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path)
+    assert queue.index_pending(60.0)
+    first = queue.enqueue("+1", "first")
+    with mock.patch("sms_queue.list_items", wraps=sms_queue.list_items) as listing:
+        assert [item.id for item in queue.pending()] == [first]
+        # Written by another process: invisible until a watcher reports it.
+        other = sms_queue.FileQueue(tmp_path)
+        second = other.enqueue("+2", "second", chat_id="chat-b")
+        assert [item.id for item in queue.pending()] == [first]
+        queue.arrived([f"{second}.json", "ignored.tmp"])
+        assert [item.id for item in queue.pending()] == [first, second]
+
+        # Retries go back with their fields cached, so blocked passes read nothing.
+        with mock.patch("queue_worker.send_once", side_effect=requests.RequestException("down")):
+            queue_worker.process_queue_once(queue, "token", "chat", 5, 30.0)
+        with mock.patch("sms_queue.load_payload") as load:
+            assert [item.id for item in queue.pending()] == [first, second]
+            assert not queue_worker.process_queue_once(queue, "token", "chat", 5, 30.0)
+            load.assert_not_called()
+
+        # A file taken by someone else is dropped once a pass finds it gone.
+        third = other.enqueue("+3", "third", chat_id="chat-c")
+        queue.arrived([f"{third}.json"])
+        other.ack(other.claim(sms_queue.QueueItem(third, None, other.dirs["pending"] / f"{third}.json")))
+        assert not queue_worker.process_queue_once(queue, "token", "chat", 5, 30.0)
+        assert [item.id for item in queue.pending()] == [first, second]
+        assert listing.call_count == 1
+
+        fourth = other.enqueue("+4", "fourth")
+        queue.arrived(["*"])
+        assert [item.id for item in queue.pending()] == [first, second, fourth]
+        assert listing.call_count == 2
@@ -1,9 +1,14 @@
 import os
 import re
 import subprocess
+import sys
 import time
 from pathlib import Path
 
+import pytest
+
+import sms_queue
+
 ENTRYPOINT = Path("entrypoint.sh").read_text().splitlines()
 CUT = next(i for i, line in enumerate(ENTRYPOINT) if line.strip() == 'if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then')
 FUNCTIONS = "\n".join(ENTRYPOINT[:CUT])
@@ -117,3 +122,104 @@ def test_single_instance(tmp_path):
 
 def test_reset_usb_modem_defined():
     assert re.search(r"^reset_usb_modem\(\)", FUNCTIONS, re.M)
+
+
+def make_identify_stub(dir_path, delay=0.0):
+    """A gammu stub that answers for every port whose name contains "modem", with an IMEI per name."""
+    path = Path(dir_path) / "gammu"
+    path.write_text(
+        "#!/usr/bin/env bash\n"
+        f"/bin/sleep {delay}\n"
+        'dev=$(readlink -f "$(sed -n "s/^device=//p" "$2")")\n'
+        'case "$dev" in\n'
+        '  *modemA*) echo "IMEI                 : 111" ;;\n'
+        '  *modemB*) echo "IMEI                 : 222" ;;\n'
+        '  *modemC*) echo "Manufacturer         : Test" ;;\n'
+        "  *) exit 1 ;;\n"
+        "esac\n"
+    )
+    path.chmod(0o755)
+
+
+def test_probes_run_concurrently(tmp_path):
+    make_identify_stub(tmp_path, delay=1.0)
+    ports = [tmp_path / name for name in ("dead0", "dead1", "dead2", "modemA-if00")]
+    for port in ports:
+        port.touch()
+    env = setup_env(tmp_path)
+    env["MODEM_PORTS"] = " ".join(str(port) for port in ports)
+    started = time.monotonic()
+    res = run_bash('detect_modem; echo "MODEM_PORT=${MODEM_PORT}"', env)
+    assert time.monotonic() - started < 3.5
+    assert f"MODEM_PORT={ports[-1]}" in res.stdout
+    assert res.stderr.count("probing") == 4
+
+
+def test_detect_modems_dedupes_by_imei(tmp_path):
+    make_identify_stub(tmp_path)
+    names = ["modemA-if00", "modemA-if02", "modemB-if00", "modemC-if00", "dead0"]
+    for name in names:
+        (tmp_path / name).touch()
+    (tmp_path / "alias").symlink_to(tmp_path / "modemB-if00")
+    env = setup_env(tmp_path)
+    env["MODEM_PORTS"] = " ".join(str(tmp_path / name) for name in ["alias"] + names)
+    snippet = (
+        'detect_modems; printf "%s\\n" "${DETECTED_MODEMS[@]}"\n'
+        'MODEM_INSTANCE_PIDS[111]=1; MODEM_INSTANCE_PORTS[111]="$1"\n'
+        'echo ---; detect_modems; printf "%s\\n" "${DETECTED_MODEMS[@]}"\n'
+    )
+    script = FUNCTIONS + "\nset +e\n" + snippet
+    res = subprocess.run(
+        ["bash", "-c", script, "bash", str(tmp_path / "modemA-if00")], env=env, capture_output=True, text=True
+    )
+    output = "".join(line for line in res.stdout.splitlines(keepends=True) if not line.startswith("[entrypoint]"))
+    first, second = output.split("---\n")
+    assert first.splitlines() == [
+        f"222 {tmp_path}/alias",
+        f"111 {tmp_path}/modemA-if00",
+        f"modemC-if00 {tmp_path}/modemC-if00",
+    ]
+    assert second.splitlines() == [f"222 {tmp_path}/alias", f"modemC-if00 {tmp_path}/modemC-if00"]
+    assert res.stderr.count(f"probing {tmp_path}/modemA-if00") == 1
+
+
+def test_instance_config_uses_its_own_spool(tmp_path):
+    env = setup_env(tmp_path)
+    env["GAMMU_SPOOL_PATH"] = str(tmp_path / "spool")
+    env["DELIVERY_MODE"] = "queue"
+    config = tmp_path / "smsdrc-111"
+    snippet = (
+        f'resolve_delivery_mode; GAMMU_SPOOL_PATH="$GAMMU_SPOOL_PATH/modems/111"\n'
+        f'generate_config /dev/ttyUSB3 {config}; echo "SMSD_CONFIG=$SMSD_CONFIG"'
+    )
+    res = run_bash(snippet, env)
+    assert f"SMSD_CONFIG={config}" in res.stdout
+    text = config.read_text()
+    assert "device = /dev/ttyUSB3" in text
+    assert f"inboxpath    = {tmp_path}/spool/modems/111/inbox/" in text
+    assert f"outboxpath   = {tmp_path}/spool/modems/111/outbox/" in text
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_modem_instance_hooks_feed_the_root_queue(tmp_path, backend):
+    env = os.environ.copy()
+    for name in ("SMSGW_QUEUE_DIR", "SMSGW_QUEUE_DB", "SMSGW_DEDUP_DB"):
+        env.pop(name, None)
+    env.update(
+        GAMMU_SPOOL_PATH=str(tmp_path),
+        SMSGW_QUEUE_BACKEND=backend,
+        SMS_MESSAGES="1",
+        SMS_1_NUMBER="+1",
+        SMS_1_TEXT="Hi",
+    )
+    res = run_bash(
+        'enter_modem_spool m1; echo "spool=$GAMMU_SPOOL_PATH dedup=$SMSGW_DEDUP_DB"; '
+        f"{sys.executable} -S on_receive.py --enqueue",
+        env,
+    )
+    assert res.returncode == 0, res.stderr
+    assert f"spool={tmp_path}/modems/m1 dedup={tmp_path}/sms-queue/dedup.sqlite3" in res.stdout
+    queue = sms_queue.open_queue({"SMSGW_QUEUE_DIR": str(tmp_path / "sms-queue"), "SMSGW_QUEUE_BACKEND": backend}.get)
+    assert queue.count("pending") == 1
+    queue.close()
+    assert not (tmp_path / "modems" / "m1" / "sms-queue").exists()
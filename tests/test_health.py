@@ -0,0 +1,187 @@
+import json
+import time
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import pytest
+
+import health
+import queue_worker
+import sms_queue
+import supervisor
+
+MONITOR_OUTPUT = """Client: Gammu 1.42.0 on Linux
+PhoneID: modem-1
+IMEI: 861234567890123
+IMSI: 250011234567890
+Sent: 3
+Received: 12
+Failed: 0
+BatterPercent: -1
+NetworkSignal: 54
+"""
+
+
+def test_parse_monitor_output():
+    assert health.parse_monitor_output(MONITOR_OUTPUT) == {
+        "phone_id": "modem-1",
+        "imei": "861234567890123",
+        "sent": 3,
+        "received": 12,
+        "failed": 0,
+        "battery_percent": -1,
+        "signal_percent": 54,
+    }
+    assert health.parse_monitor_output("garbage\nNetworkSignal: n/a\n") == {}
+
+
+def test_heartbeat_is_throttled_but_counts_every_delivery(tmp_path):
+    now = [1000.0]
+    heartbeat = health.Heartbeat(tmp_path / "state" / "worker.json", interval=10, clock=lambda: now[0])
+    heartbeat.beat()
+    first = json.loads(heartbeat.path.read_text())
+    assert first["heartbeat"] == 1000.0 and first["last_delivery"] is None
+    now[0] = 1005.0
+    heartbeat.beat(delivered=2)
+    assert json.loads(heartbeat.path.read_text()) == first
+    now[0] = 1010.0
+    heartbeat.beat(delivered=1)
+    beat = json.loads(heartbeat.path.read_text())
+    assert beat["heartbeat"] == 1010.0 and beat["delivered"] == 3 and beat["last_delivery"] == 1010.0
+
+
+def test_expected_workers():
+    assert health.expected_workers("direct", 3) == []
+    assert health.expected_workers("queue", 1) == ["worker.json"]
+    assert health.expected_workers("hybrid", 2) == ["worker-0.json", "worker-1.json"]
+
+
+def make_monitor(tmp_path, now, modem, **kwargs):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    monitor = health.HealthMonitor(
+        queue,
+        tmp_path / "state",
+        health.expected_workers("queue", 2),
+        smsd_configs=[health.DEFAULT_SMSD_CONFIG],
+        modem_sampler=lambda config: dict(modem),
+        clock=lambda: now[0],
+        **kwargs,
+    )
+    return queue, monitor
+
+
+def test_report_derives_liveness_and_readiness_from_cached_samples(tmp_path):
+    now = [time.time()]
+    modem = {"ok": True, "imei": "861234567890123", "signal_percent": 54}
+    queue, monitor = make_monitor(tmp_path, now, modem, worker_stale=60, max_queue_age=300)
+    live, ready, body = monitor.report()
+    assert not live and not ready and body["status"] == "down"
+
+    for index in range(2):
+        health.Heartbeat(tmp_path / "state" / f"worker-{index}.json", clock=lambda: now[0]).beat(delivered=index)
+    queue.enqueue("+1", "waiting")
+    monitor.refresh()
+    live, ready, body = monitor.report()
+    assert live and ready and body["status"] == "ok"
+    assert body["modems"]["default"]["imei"] == "861234567890123" and body["queue"]["pending"] == 1
+    assert body["last_delivery"] == now[0] and body["workers"]["worker-1.json"]["delivered"] == 1
+
+    # Reports only read the cache: nothing is sampled again until refresh.
+    with mock.patch("health.read_heartbeats") as read, mock.patch("health.sample_queue") as sample:
+        now[0] += 400
+        live, ready, body = monitor.report()
+        read.assert_not_called()
+        sample.assert_not_called()
+    assert body["queue"]["oldest_pending_age"] >= 400 and not ready
+    now[0] += 100
+    live, ready, body = monitor.report()
+    assert not live and body["workers"]["worker-0.json"]["heartbeat_age"] >= 500
+
+
+def test_modem_is_sampled_on_its_own_schedule(tmp_path):
+    now = [time.time()]
+    sampler = mock.Mock(return_value={"ok": False, "error": "no shared memory"})
+    monitor = health.HealthMonitor(
+        None, tmp_path, [], ["/tmp/gammu-smsdrc"], modem_interval=60, modem_sampler=sampler, clock=lambda: now[0]
+    )
+    monitor.refresh()
+    now[0] += 30
+    monitor.refresh()
+    assert sampler.call_count == 1
+    live, ready, body = monitor.report()
+    assert live and not ready and body["status"] == "degraded" and body["modems"]["default"]["age"] == 30
+    now[0] += 30
+    monitor.refresh()
+    assert sampler.call_count == 2
+
+
+def test_every_modem_instance_is_sampled_and_must_answer(tmp_path):
+    for name in ("gammu-smsdrc-861234567890123", "gammu-smsdrc-869999999999999", "gammurc"):
+        (tmp_path / name).write_text("[gammu]\n")
+    configs = health.find_smsd_configs(str(tmp_path / "gammu-smsdrc*"))
+    assert [health.modem_name(config) for config in configs] == ["861234567890123", "869999999999999"]
+    assert health.modem_name(health.DEFAULT_SMSD_CONFIG) == "default"
+
+    statuses = {configs[0]: {"ok": True, "signal_percent": 54}, configs[1]: {"ok": False, "error": "no network"}}
+    monitor = health.HealthMonitor(None, tmp_path, [], configs, modem_sampler=lambda config: dict(statuses[config]))
+    monitor.refresh()
+    live, ready, body = monitor.report()
+    assert live and not ready
+    assert body["modems"]["861234567890123"]["signal_percent"] == 54
+    assert body["modems"]["869999999999999"]["error"] == "no network"
+
+    # Without any gammu-smsd config there is no modem to deliver with.
+    monitor = health.HealthMonitor(None, tmp_path, [], [], modem_sampler=mock.Mock())
+    monitor.refresh()
+    assert monitor.report()[1] is False
+
+
+def test_sample_modem_without_the_monitor_binary_is_unknown():
+    with mock.patch("subprocess.run", side_effect=FileNotFoundError):
+        assert health.sample_modem()["ok"] is None
+    with mock.patch("subprocess.run", return_value=mock.Mock(returncode=0, stdout=MONITOR_OUTPUT)):
+        assert health.sample_modem()["ok"] is True
+    with mock.patch("subprocess.run", return_value=mock.Mock(returncode=2, stdout="Can not map shared memory\n")):
+        assert health.sample_modem() == {"ok": False, "error": "Can not map shared memory"}
+
+
+def test_endpoints_and_check(tmp_path):
+    monitor = health.HealthMonitor(None, tmp_path, ["worker.json"], modem_interval=0)
+    server = health.start_server(monitor, 0, "127.0.0.1")
+    port = server.server_address[1]
+    env = {health.HEALTH_PORT_ENV: str(port)}.get
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=5)
+        assert error.value.code == 503
+        assert json.loads(error.value.read())["workers"] == {"worker.json": {"alive": False}}
+        assert health.check(env=env) == 1
+
+        health.Heartbeat(tmp_path / "worker.json").beat()
+        monitor.refresh()
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=5) as response:
+            assert response.status == 200 and json.loads(response.read())["ready"] is True
+        assert health.check(env=env) == 0 and health.check(ready=True, env=env) == 0
+    finally:
+        server.shutdown()
+    assert health.check(env={}.get) == 0
+
+
+def test_worker_reports_deliveries_to_the_heartbeat(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+1", "hello")
+    heartbeat = health.Heartbeat(tmp_path / "worker.json", interval=0)
+    health.set_heartbeat(heartbeat)
+    try:
+        with mock.patch("queue_worker.send_once"):
+            assert queue_worker.process_queue_once(queue, "token", "chat", 5, 30.0)
+    finally:
+        health.set_heartbeat(None)
+    assert json.loads(heartbeat.path.read_text())["delivered"] == 1
+
+
+def test_supervisor_starts_the_health_server_when_enabled(tmp_path):
+    children = supervisor.build_children("direct", python="py", app_dir=tmp_path, health=True)
+    assert [child.name for child in children] == ["health server"]
+    assert children[0].argv == ["py", str(tmp_path / "health.py")]
@@ -0,0 +1,168 @@
+import os
+import subprocess
+import time
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+import inbox_ingest
+import sms_queue
+import sqlite_queue
+
+ENTRYPOINT = Path("entrypoint.sh").read_text().splitlines()
+CUT = next(i for i, line in enumerate(ENTRYPOINT) if line.strip() == 'if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then')
+FUNCTIONS = "\n".join(ENTRYPOINT[:CUT])
+
+
+def write_part(inbox, name, text, encoding="utf-16", age=10.0):
+    path = inbox / name
+    path.write_bytes(text.encode(encoding))
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def pending_texts(queue):
+    return [(item.payload["number"], item.payload["text"]) for item in queue.pending()]
+
+
+def test_parse_inbox_name():
+    part = inbox_ingest.parse_inbox_name(Path("IN20240501_123456_00_+49_170_123_01.txt"), 5.0)
+    assert part.sender == "+49_170_123"
+    assert part.part == 1
+    assert part.serial == "00"
+    assert part.mtime == 5.0
+    assert time.localtime(part.timestamp)[:6] == (2024, 5, 1, 12, 34, 56)
+    assert inbox_ingest.parse_inbox_name(Path("IN20240501_123456_00_+49_00.bin")) is None
+    assert inbox_ingest.parse_inbox_name(Path("OUT20240501_123456_00_+49_00.txt")) is None
+    assert inbox_ingest.parse_inbox_name(Path("IN20241399_123456_00_+49_00.txt")) is None
+
+
+def test_read_inbox_text_encodings(tmp_path):
+    assert inbox_ingest.read_inbox_text(write_part(tmp_path, "a", "Grüße ✓", "utf-16")) == "Grüße ✓"
+    assert inbox_ingest.read_inbox_text(write_part(tmp_path, "b", "Grüße", "utf-8")) == "Grüße"
+    assert inbox_ingest.read_inbox_text(write_part(tmp_path, "c", "Grüße", "latin-1")) == "Grüße"
+
+
+def test_multipart_messages_are_joined_in_order(tmp_path):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    write_part(inbox, "IN20240501_120000_00_+100_00.txt", "Hello wo")
+    write_part(inbox, "IN20240501_120001_00_+100_01.txt", "rld, this is")
+    write_part(inbox, "IN20240501_120001_00_+100_02.txt", " one SMS")
+    write_part(inbox, "IN20240501_120005_00_+200_00.txt", "Second\nsender")
+    write_part(inbox, "IN20240501_120009_00_+100_00.txt", "Next message")
+    (inbox / "notes.txt").write_text("ignored")
+
+    assert inbox_ingest.ingest_once(inbox, queue, inbox_ingest.InboxAssembler(2.0), set()) == 3
+    assert pending_texts(queue) == [
+        ("+100", "Hello world, this is one SMS"),
+        ("+200", "Second sender"),
+        ("+100", "Next message"),
+    ]
+    assert sorted(path.name for path in inbox.iterdir()) == ["notes.txt"]
+
+
+def test_recent_parts_wait_for_the_assembly_window(tmp_path):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    assembler = inbox_ingest.InboxAssembler(2.0)
+    seen = set()
+    write_part(inbox, "IN20240501_120000_00_+100_00.txt", "Part one, ", age=0)
+
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen) == 0
+    assert len(assembler) == 1
+    write_part(inbox, "IN20240501_120000_00_+100_01.txt", "part two", age=0)
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen) == 0
+
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen, now=time.time() + 3) == 1
+    assert pending_texts(queue) == [("+100", "Part one, part two")]
+    assert len(assembler) == 0
+    assert seen == set()
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_batches_use_enqueue_many(tmp_path, backend):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    if backend == "file":
+        queue = sms_queue.FileQueue(tmp_path / "queue")
+    else:
+        queue = sqlite_queue.SQLiteQueue(tmp_path / "queue.sqlite3")
+    for index in range(5):
+        write_part(inbox, f"IN20240501_1200{index:02d}_00_+{index}_00.txt", f"m{index}")
+
+    with mock.patch.object(queue, "enqueue_many", wraps=queue.enqueue_many) as enqueue_many:
+        assert inbox_ingest.ingest_once(inbox, queue, inbox_ingest.InboxAssembler(), set(), batch_size=2) == 5
+    assert enqueue_many.call_count == 3
+    assert [text for _, text in pending_texts(queue)] == ["m0", "m1", "m2", "m3", "m4"]
+    queue.close()
+
+
+def test_failed_enqueue_keeps_files_for_the_next_scan(tmp_path):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    assembler = inbox_ingest.InboxAssembler()
+    seen = set()
+    write_part(inbox, "IN20240501_120000_00_+100_00.txt", "Hello")
+
+    with mock.patch.object(queue, "enqueue_many", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            inbox_ingest.ingest_once(inbox, queue, assembler, seen)
+    assert seen == set()
+    assert len(list(inbox.iterdir())) == 1
+
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen) == 1
+    assert pending_texts(queue) == [("+100", "Hello")]
+
+
+def test_entrypoint_inbox_mode_drops_run_on_receive(tmp_path):
+    env = dict(os.environ, DELIVERY_MODE="inbox", GAMMU_SPOOL_PATH=str(tmp_path))
+    script = FUNCTIONS + '\nresolve_delivery_mode\ngenerate_config /dev/null\ncat "$GAMMU_CONFIG"\n'
+    result = subprocess.run(["bash", "-c", script], env=env, capture_output=True, text=True, check=True)
+    assert "RunOnReceive" not in result.stdout
+    assert f"inboxpath    = {tmp_path}/inbox/" in result.stdout
+
+    env["DELIVERY_MODE"] = "queue"
+    result = subprocess.run(["bash", "-c", script], env=env, capture_output=True, text=True, check=True)
+    assert "RunOnReceive = python3 -S /app/on_receive.py --enqueue" in result.stdout
+
+    env["DELIVERY_MODE"] = "hybrid"
+    result = subprocess.run(["bash", "-c", script], env=env, capture_output=True, text=True, check=True)
+    assert "RunOnReceive = python3 /app/on_receive.py --hybrid" in result.stdout
+
+
+def backup(*segments):
+    """An ``InboxFormat = detail`` file with one section per ``(udh, text)`` segment."""
+    lines = []
+    for index, (udh, text) in enumerate(segments):
+        hex_text = text.encode("utf-16-be").hex().upper()
+        lines += [f"[SMSBackup{index:03d}]", 'Number = "+100"', f"UDH = {udh}", f"; {text}", f"Text00 = {hex_text}", ""]
+    return "\n".join(lines)
+
+
+def test_detail_segments_are_stitched_by_udh_reference(tmp_path):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    assembler = inbox_ingest.InboxAssembler(2.0, multipart_timeout=600)
+    seen = set()
+    # gammu gave up on segment 2 and saved 1 and 3; segment 2 shows up later on its own.
+    write_part(
+        inbox, "IN20240501_120000_00_+100_00.txt", backup(("050003A70301", "Hello "), ("050003A70303", "!")), "utf-8"
+    )
+    write_part(inbox, "IN20240501_120001_00_+100_00.txt", backup(("050003420201", "Other")), "utf-8", age=0)
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen) == 0
+    assert len(assembler) == 2
+
+    write_part(inbox, "IN20240501_121000_01_+100_00.txt", backup(("050003A70302", "world")), "utf-8")
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen) == 1
+    assert pending_texts(queue) == [("+100", "Hello world!")]
+
+    assert inbox_ingest.ingest_once(inbox, queue, assembler, seen, now=time.time() + 601) == 1
+    assert pending_texts(queue)[-1] == ("+100", "Other")
+    assert list(inbox.iterdir()) == [] and len(assembler) == 0
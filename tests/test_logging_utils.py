@@ -1,4 +1,9 @@
+import contextlib
+import io
+import json
 import logging
+import threading
+import time
 
 import pytest
 
@@ -38,3 +43,77 @@ def test_get_loglevel_from_env(monkeypatch):
 def test_get_loglevel_default(monkeypatch):
     monkeypatch.delenv("LOGLEVEL", raising=False)
     assert logging_utils.get_loglevel() == logging.INFO
+
+
+@contextlib.contextmanager
+def bare_root():
+    """The root logger without pytest's capture handlers, which would make configure_logging a no-op."""
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    root.handlers = []
+    try:
+        yield root
+    finally:
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+
+
+def test_json_lines_carry_message_fields():
+    stream = io.StringIO()
+    env = {"LOG_FORMAT": "json", "LOGLEVEL": "info"}.get
+    with bare_root():
+        logging_utils.configure_logging(background=False, stream=stream, env=env)
+        fields = logging_utils.message_fields("m1", "+100", time.time() - 2)
+        logging.info("Delivered SMS from %s", "+100", extra=dict(fields, attempt=1))
+    entry = json.loads(stream.getvalue())
+    assert entry["msg"] == "Delivered SMS from +100" and entry["level"] == "INFO"
+    assert entry["message_id"] == "m1" and entry["attempt"] == 1
+    assert entry["number_hash"] == logging_utils.hash_number("+100") != "+100"
+    assert 2000 <= entry["latency_ms"] < 60000
+
+
+def test_sampling_passes_a_burst_per_template():
+    now = [0.0]
+    sampler = logging_utils.SamplingFilter(interval=60, burst=2, clock=lambda: now[0])
+
+    def record(msg, level=logging.WARNING):
+        return logging.LogRecord("worker", level, __file__, 1, msg, ("x",), None)
+
+    assert [sampler.filter(record("Delivery failed: %s")) for _ in range(5)] == [True, True, False, False, False]
+    assert sampler.filter(record("Other warning: %s"))
+    assert sampler.filter(record("Delivery failed: %s", logging.ERROR))
+    now[0] = 61
+    passed = record("Delivery failed: %s")
+    assert sampler.filter(passed) and passed.suppressed == 3
+
+
+def test_background_handler_writes_from_a_thread():
+    stream = io.StringIO()
+    with bare_root() as root:
+        logging_utils.configure_logging(background=True, stream=stream, env={"LOG_SAMPLE_BURST": "1"}.get)
+        assert not isinstance(root.handlers[0], logging.StreamHandler)
+        for attempt in range(3):
+            logging.warning("Delivery failed (%s)", attempt)
+        logging.error("done")
+    deadline = time.time() + 5
+    while "done" not in stream.getvalue() and time.time() < deadline:
+        time.sleep(0.01)
+    assert stream.getvalue().splitlines() == ["WARNING:root:Delivery failed (0)", "ERROR:root:done"]
+
+
+def test_background_handler_counts_drops_from_every_thread():
+    handler, listener = logging_utils._background_handler(logging.NullHandler(), 1)
+    listener.stop()
+    handler.queue.put_nowait("full")
+    record = logging.LogRecord("root", logging.INFO, __file__, 0, "x", None, None)
+
+    def flood():
+        for _ in range(2000):
+            handler.enqueue(record)
+
+    threads = [threading.Thread(target=flood) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert handler.dropped == 16000
@@ -0,0 +1,223 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import timeit
+from pathlib import Path
+from unittest import mock
+
+import pytest
+import requests
+
+import metrics
+import queue_worker
+import sms_queue
+import telegram_client
+from benchmarks.stub_telegram import StubTelegramServer
+
+ENTRYPOINT = Path("entrypoint.sh").read_text().splitlines()
+CUT = next(i for i, line in enumerate(ENTRYPOINT) if line.strip() == 'if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then')
+FUNCTIONS = "\n".join(ENTRYPOINT[:CUT])
+
+
+def scrape(server):
+    response = requests.get(f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    return response.text
+
+
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{name} not in scrape:\n{text}")
+
+
+def test_render_counter_histogram_and_gauge():
+    registry = metrics.Registry()
+    counter = registry.counter("demo_requests", "Requests.", ["code"])
+    counter.inc(code=200)
+    counter.inc(2, code="error")
+    histogram = registry.histogram("demo_seconds", "Latency.", buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(5)
+    registry.gauge("demo_depth", 'Depth "quoted".', lambda: {("pending",): 3}, ["state"])
+    registry.gauge("demo_missing", "Unknown value.", lambda: None)
+
+    text = registry.render()
+    assert 'demo_requests_total{code="200"} 1' in text
+    assert 'demo_requests_total{code="error"} 2' in text
+    assert 'demo_seconds_bucket{le="0.1"} 2' in text
+    assert 'demo_seconds_bucket{le="1"} 2' in text
+    assert 'demo_seconds_bucket{le="+Inf"} 3' in text
+    assert "demo_seconds_count 3" in text
+    assert "demo_seconds_sum 5.15" in text
+    assert 'demo_depth{state="pending"} 3' in text
+    assert "# TYPE demo_missing gauge" in text
+    assert "\ndemo_missing " not in text
+
+
+def test_failing_gauge_does_not_break_scrape():
+    registry = metrics.Registry()
+    registry.gauge("broken", "Raises.", mock.Mock(side_effect=OSError("gone")))
+    registry.counter("ok", "Still rendered.").inc()
+    assert "ok_total 1" in registry.render()
+
+
+def test_updates_are_cheap():
+    counter = metrics.Registry().counter("cheap", "Cheap.", ["code"])
+    histogram = metrics.Registry().histogram("cheap_seconds", "Cheap.")
+    per_call = min(timeit.repeat(lambda: (counter.inc(code=200), histogram.observe(0.2)), number=2000, repeat=3))
+    # Generous bound: a few microseconds per update even on slow CI runners.
+    assert per_call / 2000 < 50e-6
+
+
+def test_worker_metrics_endpoint(tmp_path, monkeypatch):
+    queue = sms_queue.FileQueue(tmp_path)
+    registry = metrics.Registry()
+    queue_worker.register_queue_metrics(queue, registry)
+    for metric in (metrics.TELEGRAM_REQUESTS, metrics.TELEGRAM_REQUEST_SECONDS, metrics.DELIVERY_LATENCY_SECONDS):
+        registry.register(metric)
+
+    old = queue.enqueue("+1", "old")
+    queue.enqueue("+1", "new")
+    path = queue.dirs["pending"] / f"{old}.json"
+    payload = sms_queue.load_payload(path)
+    payload["received_at"] = time.time() - 120
+    sms_queue.rewrite_item(path, payload, queue.dirs["tmp"])
+
+    server = metrics.start_server(0, "127.0.0.1", registry)
+    try:
+        text = scrape(server)
+        assert 'smsgw_queue_depth{state="pending"} 2' in text
+        assert sample(text, "smsgw_queue_oldest_pending_age_seconds") >= 119
+
+        ok_before = metrics.TELEGRAM_REQUESTS.value(code=200)
+        latency_before = metrics.DELIVERY_LATENCY_SECONDS.count()
+        with StubTelegramServer() as telegram:
+            monkeypatch.setenv(telegram_client.API_URL_ENV, telegram.url)
+            telegram_client.reset_session()
+            queue_worker.process_queue_once(queue, "token", "chat", 5, 60.0)
+        telegram_client.reset_session()
+
+        text = scrape(server)
+        assert 'smsgw_queue_depth{state="sent"} 2' in text
+        assert sample(text, "smsgw_queue_oldest_pending_age_seconds") == 0
+        assert metrics.TELEGRAM_REQUESTS.value(code=200) - ok_before == 2
+        assert metrics.DELIVERY_LATENCY_SECONDS.count() - latency_before == 2
+        assert 'smsgw_telegram_requests_total{code="200"}' in text
+        assert "smsgw_delivery_latency_seconds_bucket" in text
+        assert requests.get(f"http://127.0.0.1:{server.server_address[1]}/other", timeout=5).status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_error_and_retry_counters(tmp_path, monkeypatch):
+    queue = sms_queue.FileQueue(tmp_path)
+    queue.enqueue("+1", "Hello")
+    not_found_before = metrics.TELEGRAM_REQUESTS.value(code=404)
+    retries_before = metrics.RETRIES.value()
+    with StubTelegramServer() as telegram:
+        # An unknown path makes the stub answer 404.
+        monkeypatch.setenv(telegram_client.API_URL_ENV, telegram.url + "/missing")
+        telegram_client.reset_session()
+        queue_worker.process_queue_once(queue, "token", "chat", 5, 60.0)
+    telegram_client.reset_session()
+
+    assert metrics.TELEGRAM_REQUESTS.value(code=404) - not_found_before == 1
+    assert metrics.RETRIES.value() - retries_before == 1
+
+    error_before = metrics.TELEGRAM_REQUESTS.value(code="error")
+    monkeypatch.setenv(telegram_client.API_URL_ENV, "http://127.0.0.1:9")
+    telegram_client.reset_session()
+    try:
+        with pytest.raises(requests.ConnectionError):
+            telegram_client.send_message("token", {"chat_id": "1", "text": "x"}, timeout=1)
+    finally:
+        telegram_client.reset_session()
+    assert metrics.TELEGRAM_REQUESTS.value(code="error") - error_before == 1
+
+
+def test_watchdog_resets_from_entrypoint(tmp_path):
+    state_file = tmp_path / "resets"
+    env = dict(os.environ, WATCHDOG_STATE_FILE=str(state_file))
+    script = FUNCTIONS + "\nrecord_watchdog_reset 12d1:1001\nrecord_watchdog_reset 12d1:1001\n"
+    subprocess.run(["bash", "-c", script], env=env, check=True, capture_output=True)
+
+    count, last = metrics.read_watchdog_resets(state_file)
+    assert count == 2
+    assert abs(last - time.time()) < 60
+    assert metrics.read_watchdog_resets(tmp_path / "missing") == (0, None)
+
+    registry = metrics.Registry()
+    metrics.register_watchdog_metrics(registry, env=env.get)
+    text = registry.render()
+    assert "# TYPE smsgw_modem_watchdog_resets counter" in text
+    assert sample(text, "smsgw_modem_watchdog_resets_total") == 2
+    assert sample(text, "smsgw_modem_watchdog_last_reset_timestamp_seconds") == last
+
+
+def test_per_modem_resets_and_deliveries(tmp_path):
+    state_file = tmp_path / "resets"
+    env = dict(os.environ, WATCHDOG_STATE_FILE=str(state_file))
+    script = FUNCTIONS + (
+        "\nrecord_watchdog_reset 12d1:1001\n"
+        "SMSGW_MODEM_ID=111 record_watchdog_reset 12d1:1001\n"
+        "SMSGW_MODEM_ID=222 record_watchdog_reset 12d1:1001\n"
+        "SMSGW_MODEM_ID=222 record_watchdog_reset 12d1:1001\n"
+    )
+    subprocess.run(["bash", "-c", script], env=env, check=True, capture_output=True)
+    assert metrics.read_watchdog_resets(state_file)[0] == 4
+    assert metrics.read_watchdog_resets_by_modem(state_file) == {("111",): 1, ("222",): 2}
+    registry = metrics.Registry()
+    metrics.register_watchdog_metrics(registry, env=env.get)
+    assert sample(registry.render(), 'smsgw_modem_watchdog_resets_by_modem_total{modem="222"}') == 2
+
+    before = metrics.MODEM_DELIVERED.value(modem="222")
+    queue_worker.record_delivery({"modem": "222", "received_at": time.time()})
+    queue_worker.record_delivery({"received_at": time.time()})
+    assert metrics.MODEM_DELIVERED.value(modem="222") - before == 1
+
+
+def test_every_shard_serves_its_own_deliveries(tmp_path):
+    assert queue_worker.metrics_port_for(9108, None) == 9108
+    assert queue_worker.metrics_port_for(9108, (2, 3)) == 9110
+    assert queue_worker.metrics_port_for(0, (2, 3)) == 0
+
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+1", "hi")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    env = dict(
+        os.environ,
+        SMSGW_QUEUE_DIR=str(tmp_path / "queue"),
+        SMSGW_DEDUP_DB=str(tmp_path / "dedup.sqlite3"),
+        TELEGRAM_BOT_TOKEN="token",
+        TELEGRAM_CHAT_ID="chat",
+        QUEUE_POLL_INTERVAL="0.2",
+        QUEUE_SHARDING="false",
+        METRICS_PORT=str(port - 1),
+        METRICS_ADDR="127.0.0.1",
+    )
+    with StubTelegramServer() as telegram:
+        env["TELEGRAM_API_URL"] = telegram.url
+        worker = subprocess.Popen([sys.executable, "queue_worker.py", "--shard", "1/2"], env=env)
+        try:
+            text, deadline = "", time.monotonic() + 30
+            while "smsgw_messages_delivered_total 1" not in text and time.monotonic() < deadline:
+                time.sleep(0.1)
+                try:
+                    text = requests.get(f"http://127.0.0.1:{port}/metrics", timeout=5).text
+                except requests.ConnectionError:
+                    continue
+        finally:
+            worker.terminate()
+            worker.wait(timeout=30)
+    assert sample(text, "smsgw_messages_delivered_total") == 1
+    # The spool-wide gauges come from worker 0 only.
+    assert "smsgw_queue_depth" not in text
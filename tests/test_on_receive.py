@@ -1,4 +1,9 @@
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from pathlib import Path
 from unittest import mock
 
 import on_receive
@@ -20,14 +25,50 @@ class TestOnReceive(unittest.TestCase):
         with self.assertRaises(EnvironmentError):
             on_receive.get_env("MISSING", required=True)
 
-    @mock.patch("on_receive.requests.post")
+    @mock.patch("telegram_client.send_message")
     def test_send_to_telegram(self, mock_post):
-        mock_resp = mock.Mock()
-        mock_resp.raise_for_status.return_value = None
-        mock_post.return_value = mock_resp
         on_receive.send_to_telegram("token", "chat", "123", "hi")
         mock_post.assert_called()
 
+    def test_hybrid_sends_once_then_falls_back_to_the_queue(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(os.environ, {"SMSGW_QUEUE_DIR": tmp}):
+            with mock.patch("telegram_client.send_message") as send:
+                self.assertTrue(on_receive.send_or_enqueue("token", "chat", "+1", "hi", timeout=2))
+            self.assertEqual(send.call_args.kwargs["timeout"], 2)
+            with mock.patch("telegram_client.send_message", side_effect=OSError("down")) as send:
+                self.assertFalse(on_receive.send_or_enqueue("token", "chat", "+1", "hi", timeout=2))
+            send.assert_called_once()
+            pending = list(Path(tmp, "pending").glob("*.json"))
+            self.assertEqual(len(pending), 1)
+
+    def test_long_sms_is_split_instead_of_truncated(self):
+        env = {"SMS_MESSAGES": "2", "SMS_1_NUMBER": "+1", "SMS_1_TEXT": "word " * 1000, "SMS_2_TEXT": "end"}
+        number, text = on_receive.parse_sms(2, getenv=env.get)
+        self.assertTrue(text.endswith(" end"))
+        payloads = on_receive.build_telegram_payloads("chat", number, text)
+        self.assertEqual(len(payloads), 2)
+        self.assertTrue(payloads[0]["text"].startswith("<b>+1</b> (1/2)\n"))
+        self.assertTrue(all(len(payload["text"]) <= on_receive.TELEGRAM_TEXT_LIMIT for payload in payloads))
+        self.assertEqual(len(on_receive.build_telegram_payloads("chat", number, "short")), 1)
+
+    def test_enqueue_hook_runs_without_site_packages(self):
+        probe = (
+            "import sys; sys.argv = ['on_receive.py', '--enqueue']; import on_receive; on_receive.main(); "
+            "print('requests' in sys.modules, 'telegram_client' in sys.modules)"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, SMSGW_QUEUE_DIR=tmp, SMS_MESSAGES="1", SMS_1_NUMBER="+1", SMS_1_TEXT="Hi")
+            result = subprocess.run(
+                [sys.executable, "-S", "-c", probe],
+                env=env,
+                cwd=Path(on_receive.__file__).parent,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            self.assertEqual(result.stdout.split(), ["False", "False"])
+            self.assertEqual(len(list(Path(tmp, "pending").glob("*.json"))), 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,132 @@
+import codecs
+from pathlib import Path
+from unittest import mock
+
+import pytest
+import requests
+
+import outbox
+import sms_queue
+
+
+def make_dispatcher(tmp_path, **kwargs):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    return queue, outbox.OutboxDispatcher(queue, tmp_path / "spool", **kwargs)
+
+
+def enqueue(queue, count):
+    return queue.enqueue_payloads([sms_queue.build_payload(f"+4912345{i:03d}", f"msg {i}") for i in range(count)])
+
+
+@pytest.fixture
+def api(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    server = outbox.start_api(queue, 0, token="secret")
+    yield queue, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_api_enqueues_a_batch_with_one_directory_sync(api):
+    queue, url = api
+    messages = [{"number": f"+4912345{i}", "text": f"hi {i}"} for i in range(50)]
+    with mock.patch.object(sms_queue, "_fsync_dir") as fsync_dir:
+        response = requests.post(
+            f"{url}/send", json={"messages": messages}, headers={"Authorization": "Bearer secret"}, timeout=5
+        )
+    assert response.status_code == 202
+    ids = response.json()["ids"]
+    assert len(ids) == 50 and queue.count("pending") == 50
+    assert fsync_dir.call_count == 1
+
+    status = requests.get(f"{url}/messages/{ids[0]}", headers={"Authorization": "Bearer secret"}, timeout=5)
+    assert status.json() == {"id": ids[0], "state": "pending", "number": "+49123450"}
+
+
+def test_api_rejects_bad_requests(api):
+    queue, url = api
+    auth = {"Authorization": "Bearer secret"}
+    assert requests.post(f"{url}/send", json={"number": "+491", "text": "x"}, timeout=5).status_code == 401
+    bad = [{"number": "12ab", "text": "x"}, {"number": "+4912345", "text": ""}, {"messages": []}]
+    for body in bad:
+        assert requests.post(f"{url}/send", json=body, headers=auth, timeout=5).status_code == 400
+    # One invalid entry rejects the whole batch.
+    batch = {"messages": [{"number": "+4912345", "text": "ok"}, {"number": "x", "text": "no"}]}
+    assert requests.post(f"{url}/send", json=batch, headers=auth, timeout=5).status_code == 400
+    assert queue.count("pending") == 0
+    assert requests.get(f"{url}/messages/nope", headers=auth, timeout=5).status_code == 404
+
+
+def test_api_requires_token_off_loopback(tmp_path):
+    with pytest.raises(ValueError):
+        outbox.start_api(sms_queue.FileQueue(tmp_path), 0, addr="0.0.0.0")
+
+
+def test_outbox_file_name_and_encoding(tmp_path):
+    queue, dispatcher = make_dispatcher(tmp_path)
+    payload = sms_queue.build_payload("+49123456", "Grüße ✓")
+    payload["received_at"] = 0
+    queue.enqueue_payloads([payload])
+    assert dispatcher.dispatch() == 1
+    path = dispatcher.outbox / f"OUTC19700101_000000_00_+49123456_{payload['id']}.txt"
+    data = path.read_bytes()
+    assert data.startswith(codecs.BOM_UTF16_LE)
+    assert data[2:].decode("utf-16-le") == "Grüße ✓"
+    assert not list(dispatcher.outbox.glob(".*.tmp"))
+
+
+def test_dispatch_respects_rate_and_inflight_limits(tmp_path):
+    now = [0.0]
+    queue, dispatcher = make_dispatcher(tmp_path, rate=2.0, burst=3.0, max_inflight=5, clock=lambda: now[0])
+    enqueue(queue, 10)
+    assert dispatcher.dispatch() == 3
+    assert dispatcher.dispatch() == 0
+    assert dispatcher.next_dispatch_in() == pytest.approx(0.5)
+    now[0] = 0.5
+    assert dispatcher.dispatch() == 1
+    now[0] = 100.0
+    # The bucket is full again but only one in-flight slot is left.
+    assert dispatcher.dispatch() == 1
+    assert len(list(dispatcher.outbox.iterdir())) == 5
+    assert queue.count("processing") == 5 and queue.count("pending") == 5
+
+
+def test_reconcile_sent_error_and_lost_messages(tmp_path):
+    queue, dispatcher = make_dispatcher(tmp_path, rate=0, max_attempts=2, retry_delay=0.0)
+    enqueue(queue, 4)
+    assert dispatcher.dispatch() == 4
+    files = sorted(dispatcher.outbox.iterdir())
+    files[0].rename(dispatcher.sent / files[0].name)
+    files[1].rename(dispatcher.error / files[1].name)
+    files[2].unlink()
+    assert dispatcher.reconcile() == 3
+    assert queue.count("sent") == 1
+    assert queue.count("pending") == 2 and queue.count("processing") == 1
+    assert not (dispatcher.error / files[1].name).exists()
+
+    retried = next(item for item in queue.pending() if item.payload.get("attempts"))
+    assert retried.payload["last_error"]
+    assert dispatcher.dispatch() == 2
+    (dispatcher.outbox / files[1].name).rename(dispatcher.error / files[1].name)
+    dispatcher.reconcile()
+    assert queue.count("failed") == 1
+
+
+def test_multi_modem_outbox_must_name_a_modem_spool():
+    root = {"GAMMU_SPOOL_PATH": "/spool"}
+    assert outbox.resolve_spool_dir(root.get) == Path("/spool")
+    multi = dict(root, MULTI_MODEM="true")
+    # Every gammu-smsd reads its own modems/<id>/outbox, so the root outbox would never be sent.
+    for spool in (None, "/spool", "/elsewhere/861234567890123"):
+        env = dict(multi, OUTBOX_SPOOL_PATH=spool) if spool else multi
+        with pytest.raises(ValueError, match="OUTBOX_SPOOL_PATH"):
+            outbox.resolve_spool_dir(env.get)
+    env = dict(multi, OUTBOX_SPOOL_PATH="/spool/modems/861234567890123")
+    assert outbox.resolve_spool_dir(env.get) == Path("/spool/modems/861234567890123")
+
+
+def test_outbox_refuses_to_start_without_a_modem_spool(monkeypatch):
+    monkeypatch.setenv("MULTI_MODEM", "true")
+    monkeypatch.delenv("OUTBOX_SPOOL_PATH", raising=False)
+    with mock.patch("outbox.start_api") as start_api, pytest.raises(SystemExit):
+        outbox.run_outbox()
+    start_api.assert_not_called()
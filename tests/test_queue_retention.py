@@ -0,0 +1,234 @@
+import calendar
+import gzip
+import json
+import time
+from unittest import mock
+
+import pytest
+
+import queue_retention
+import queue_worker
+import routing
+import sms_queue
+import sqlite_queue
+
+DAY = 86400
+
+
+def make_file_queue(tmp_path):
+    return sms_queue.FileQueue(tmp_path / "spool")
+
+
+def make_sqlite_queue(tmp_path):
+    return sqlite_queue.SQLiteQueue(tmp_path / "queue.sqlite3")
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def queue(request, tmp_path):
+    factory = make_file_queue if request.param == "file" else make_sqlite_queue
+    queue = factory(tmp_path)
+    yield queue
+    queue.close()
+
+
+def finish(queue, number, text, state="sent", received_at=None):
+    queue.enqueue(number, text)
+    item = [pending for pending in queue.pending() if pending.payload["text"] == text][0]
+    claimed = queue.claim(item)
+    if received_at is not None:
+        # retry() persists the payload, so the backdated timestamp sticks.
+        claimed.payload["received_at"] = received_at
+        queue.retry(claimed)
+        claimed = queue.claim(item)
+    if state == "sent":
+        queue.ack(claimed)
+    else:
+        claimed.payload["last_error"] = "x"
+        queue.fail(claimed)
+
+
+def read_segment(path):
+    with gzip.open(path, "rt", encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_count_limit_archives_oldest(queue, tmp_path):
+    for index in range(5):
+        finish(queue, "+123", f"m{index}")
+    archive_dir = tmp_path / "archive"
+    policy = queue_retention.RetentionPolicy(max_age_days=0, max_items=2, batch_size=10)
+
+    assert queue_retention.compact_once(queue, archive_dir, policy) == 3
+    assert queue.count("sent") == 2
+    assert [item.payload["text"] for item in queue.oldest("sent", 10)] == ["m3", "m4"]
+
+    (segment,) = archive_dir.glob("sent-*.jsonl.gz")
+    records = read_segment(segment)
+    assert [record["text"] for record in records] == ["m0", "m1", "m2"]
+    assert all(record["state"] == "sent" for record in records)
+    assert queue_retention.compact_once(queue, archive_dir, policy) == 0
+
+
+def test_age_limit_and_daily_segments(queue, tmp_path):
+    now = time.time()
+    finish(queue, "+1", "old", state="failed", received_at=now - 10 * DAY)
+    finish(queue, "+1", "fresh", state="failed")
+    archive_dir = tmp_path / "archive"
+    policy = queue_retention.RetentionPolicy(max_age_days=7, max_items=0)
+
+    assert queue_retention.compact_once(queue, archive_dir, policy, now=now) == 1
+    assert [item.payload["text"] for item in queue.oldest("failed", 10)] == ["fresh"]
+    day = time.strftime("%Y-%m-%d", time.gmtime(now - 10 * DAY))
+    (record,) = read_segment(archive_dir / f"failed-{day}.jsonl.gz")
+    assert record["text"] == "old"
+    assert record["last_error"] == "x"
+
+
+def test_batch_size_bounds_each_pass(queue, tmp_path):
+    for index in range(5):
+        finish(queue, "+123", f"m{index}")
+    archive_dir = tmp_path / "archive"
+    policy = queue_retention.RetentionPolicy(max_age_days=0, max_items=1, batch_size=2)
+
+    assert queue_retention.compact_once(queue, archive_dir, policy) == 2
+    assert queue_retention.compact_once(queue, archive_dir, policy) == 2
+    assert queue_retention.compact_once(queue, archive_dir, policy) == 0
+    # Appends to the same segment are separate gzip members read back as one stream.
+    (segment,) = archive_dir.glob("sent-*.jsonl.gz")
+    assert [record["text"] for record in read_segment(segment)] == ["m0", "m1", "m2", "m3"]
+
+
+def test_pending_items_are_never_archived(tmp_path):
+    queue = make_file_queue(tmp_path)
+    for index in range(3):
+        queue.enqueue("+123", f"m{index}")
+    policy = queue_retention.RetentionPolicy(max_age_days=0.0001, max_items=1)
+
+    assert queue_retention.compact_once(queue, tmp_path / "archive", policy, now=time.time() + DAY) == 0
+    assert queue.count("pending") == 3
+
+
+def test_message_timestamp_falls_back_to_id():
+    item = sms_queue.QueueItem("1700000000000000-abc", None)
+    assert queue_retention.message_timestamp(item) == 1700000000.0
+    item = sms_queue.QueueItem("1700000000000-abc", None)
+    assert queue_retention.message_timestamp(item) == 1700000000.0
+    assert queue_retention.message_timestamp(sms_queue.QueueItem("bogus", None)) is None
+
+
+def test_prune_segments(tmp_path):
+    archive_dir = tmp_path / "archive"
+    archive_dir.mkdir()
+    for name in ("sent-2020-01-01.jsonl.gz", "failed-2020-01-02.jsonl.gz", "sent-2099-01-01.jsonl.gz", "notes.txt"):
+        (archive_dir / name).write_bytes(b"")
+    now = calendar.timegm((2020, 1, 10, 0, 0, 0))
+
+    assert queue_retention.prune_segments(archive_dir, 0, now) == 0
+    assert queue_retention.prune_segments(archive_dir, 8, now) == 1
+    assert sorted(path.name for path in archive_dir.iterdir()) == [
+        "failed-2020-01-02.jsonl.gz",
+        "notes.txt",
+        "sent-2099-01-01.jsonl.gz",
+    ]
+
+
+def test_query_filters_and_replay(tmp_path):
+    queue = make_file_queue(tmp_path)
+    finish(queue, "+49100", "Your code is 1234")
+    finish(queue, "+49100", "Hello")
+    finish(queue, "+33100", "Another CODE", state="failed")
+    archive_dir = tmp_path / "archive"
+    assert queue_retention.compact_once(queue, archive_dir, queue_retention.RetentionPolicy(0, 0)) == 0
+
+    for state in queue_retention.ARCHIVE_STATES:
+        items = queue.oldest(state, 10)
+        queue_retention.archive_items(archive_dir, state, items)
+        queue.purge(items)
+
+    records = [
+        record
+        for record in queue_retention.iter_archive(archive_dir)
+        if queue_retention.record_matches(record, text="code")
+    ]
+    assert sorted(record["number"] for record in records) == ["+33100", "+49100"]
+    sent_only = list(queue_retention.iter_archive(archive_dir, states=["sent"]))
+    assert [record["text"] for record in sent_only] == ["Your code is 1234", "Hello"]
+    assert list(queue_retention.iter_archive(archive_dir, since="2999-01-01")) == []
+
+    assert queue_retention.replay(queue, [r for r in records if queue_retention.record_matches(r, number="+49")]) == 1
+    (item,) = queue.pending()
+    assert item.payload["text"] == "Your code is 1234"
+    assert "state" not in item.payload
+    queue.close()
+
+
+def test_replay_keeps_the_routing_of_routed_copies(tmp_path):
+    queue = make_file_queue(tmp_path)
+    router = routing.Router(
+        [{"keywords": ["OTP"], "destinations": ["telegram:otp@alerts", "webhook:http://hook.test/sms"]}],
+        "main",
+        bots={"alerts": "alert-token"},
+    )
+    queue.enqueue_payloads(router.fan_out(sms_queue.build_payload("+44123", "OTP 1234")))
+    for item in list(queue.pending()):
+        queue.ack(queue.claim(item))
+    items = queue.oldest("sent", 10)
+    queue_retention.archive_items(tmp_path / "archive", "sent", items)
+    queue.purge(items)
+
+    assert queue_retention.replay(queue, queue_retention.iter_archive(tmp_path / "archive")) == 2
+    replayed = sorted((item.payload for item in queue.pending()), key=lambda payload: "webhook" in payload)
+    assert (replayed[0]["chat_id"], replayed[0]["bot"]) == ("otp", "alerts")
+    assert replayed[1]["webhook"] == "http://hook.test/sms" and "chat_id" not in replayed[1]
+    with mock.patch("queue_worker.telegram_client.send_message") as send, mock.patch(
+        "routing.telegram_client.get_session"
+    ) as session:
+        assert queue_worker.process_queue_once(queue, "token", "main", 3, 10.0, router=router)
+    # Each copy goes to its own destination once; neither is routed again.
+    send.assert_called_once()
+    assert send.call_args.args[0] == "alert-token" and send.call_args.args[1]["chat_id"] == "otp"
+    session.return_value.post.assert_called_once()
+    assert session.return_value.post.call_args.args[0] == "http://hook.test/sms"
+    assert queue.counts() == {"pending": 0, "processing": 0, "sent": 2, "failed": 0}
+    queue.close()
+
+
+def test_cli_compact_query_and_replay(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("SMSGW_QUEUE_DIR", str(tmp_path / "spool"))
+    monkeypatch.setenv("QUEUE_RETENTION_MAX_ITEMS", "1")
+    monkeypatch.setenv("QUEUE_RETENTION_BATCH", "1")
+    queue = sms_queue.open_queue()
+    for index in range(3):
+        finish(queue, "+123", f"m{index}")
+    queue.close()
+
+    queue_retention.main(["compact", "--all"])
+    queue = sms_queue.open_queue()
+    assert queue.count("sent") == 1
+    queue.close()
+
+    queue_retention.main(["query", "--text", "M1"])
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["text"] for line in lines] == ["m1"]
+
+    queue_retention.main(["replay", "--limit", "1", "--dry-run"])
+    queue_retention.main(["replay", "--limit", "1"])
+    queue = sms_queue.open_queue()
+    assert [item.payload["text"] for item in queue.pending()] == ["m0"]
+    queue.close()
+
+
+def test_run_retention_logs_errors(tmp_path):
+    queue = make_file_queue(tmp_path)
+    policy = queue_retention.RetentionPolicy()
+    with mock.patch.object(queue_retention, "compact_once", side_effect=OSError("disk full")):
+        assert queue_worker.run_retention(queue, tmp_path / "archive", policy) == 0
+
+
+def test_policy_from_env(monkeypatch):
+    monkeypatch.setenv("QUEUE_RETENTION_DAYS", "0")
+    monkeypatch.setenv("QUEUE_RETENTION_MAX_ITEMS", "0")
+    monkeypatch.setenv("QUEUE_RETENTION_BATCH", "0")
+    policy = queue_retention.RetentionPolicy.from_env()
+    assert not policy.enabled
+    assert policy.batch_size == 1
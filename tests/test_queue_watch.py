@@ -0,0 +1,59 @@
+import sys
+import threading
+import time
+
+import pytest
+
+import queue_watch
+import sms_queue
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify requires Linux")
+
+
+@linux_only
+def test_inotify_wakes_on_enqueue(tmp_path):
+    base_dir = tmp_path / "queue"
+    dirs = sms_queue.ensure_queue_dirs(base_dir)
+    watcher = queue_watch.InotifyWatcher(dirs["pending"])
+    try:
+        timer = threading.Timer(0.1, sms_queue.enqueue_message, args=("123", "hi", base_dir))
+        timer.start()
+        started = time.monotonic()
+        names = watcher.wait(5)
+        timer.join()
+        assert time.monotonic() - started < 2
+        assert [path.name for path in dirs["pending"].glob("*.json")] == names
+    finally:
+        watcher.close()
+
+
+@linux_only
+def test_inotify_timeout_and_wake(tmp_path):
+    watcher = queue_watch.InotifyWatcher(tmp_path)
+    try:
+        assert watcher.wait(0.05) == []
+        watcher.wake()
+        started = time.monotonic()
+        assert watcher.wait(5) == []
+        assert time.monotonic() - started < 1
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher_wake():
+    watcher = queue_watch.PollingWatcher()
+    watcher.wake()
+    started = time.monotonic()
+    assert watcher.wait(5) == []
+    assert time.monotonic() - started < 1
+
+
+def test_open_watcher_modes(tmp_path):
+    assert isinstance(queue_watch.open_watcher(tmp_path, "poll"), queue_watch.PollingWatcher)
+    fallback = queue_watch.open_watcher(tmp_path / "missing", "inotify")
+    assert isinstance(fallback, queue_watch.PollingWatcher)
+
+
+@pytest.mark.parametrize("value, expected", [(None, "auto"), ("INOTIFY", "inotify"), (" poll ", "poll"), ("x", "auto")])
+def test_normalize_watch_mode(value, expected):
+    assert queue_watch.normalize_watch_mode(value) == expected
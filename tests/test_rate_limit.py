@@ -0,0 +1,139 @@
+import threading
+
+import pytest
+import requests
+
+import queue_worker
+import rate_limit
+import telegram_client
+from benchmarks.stub_telegram import StubTelegramServer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_limiter(clock, **kwargs):
+    return rate_limit.RateLimiter(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_chat_bucket_allows_burst_then_paces():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=0, chat_rate=1.0, chat_burst=3)
+    waits = [limiter.acquire("chat") for _ in range(6)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3:] == pytest.approx([1.0, 1.0, 1.0])
+    # Other chats have their own bucket.
+    assert limiter.acquire("other") == 0.0
+
+
+def test_global_bucket_spans_chats():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=10.0, global_burst=2, chat_rate=0)
+    waits = [limiter.acquire(f"chat{index}") for index in range(4)]
+    assert waits == pytest.approx([0.0, 0.0, 0.1, 0.1])
+
+
+def test_sustained_rate_matches_configuration():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=5.0, global_burst=1, chat_rate=0)
+    start = clock.now
+    for index in range(51):
+        limiter.acquire(f"chat{index % 7}")
+    assert clock.now - start == pytest.approx(10.0)
+
+
+def test_reservations_space_out_concurrent_callers():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=0, chat_rate=2.0, chat_burst=1)
+    # Without sleeping in between, each reservation queues behind the last.
+    assert [limiter.reserve("chat") for _ in range(4)] == pytest.approx([0.0, 0.5, 1.0, 1.5])
+
+
+def test_penalize_blocks_chat_until_retry_after():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=0, chat_rate=1.0, chat_burst=3)
+    limiter.penalize("chat", 7.0)
+    assert limiter.acquire("chat") == pytest.approx(8.0)
+    assert limiter.acquire("other") == 0.0
+    # The bucket restarts empty after the pause instead of bursting again.
+    assert limiter.acquire("chat") == pytest.approx(1.0)
+
+
+def test_disabled_limiter_never_sleeps():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=0, chat_rate=0)
+    limiter.penalize("chat", 30)
+    assert [limiter.acquire("chat") for _ in range(100)] == [0.0] * 100
+    assert clock.sleeps == []
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_RATE_GLOBAL", "12")
+    monkeypatch.setenv("TELEGRAM_RATE_CHAT", "0.5")
+    monkeypatch.setenv("TELEGRAM_RATE_CHAT_BURST", "2")
+    limiter = rate_limit.RateLimiter.from_env()
+    assert (limiter.global_rate, limiter.chat_rate, limiter.chat_burst) == (12.0, 0.5, 2.0)
+
+
+def test_sharded_workers_split_only_the_global_rate(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_RATE_GLOBAL", "30")
+    monkeypatch.setenv("TELEGRAM_RATE_CHAT", "1")
+    sharded = queue_worker.worker_limiter(3, sharding=True)
+    assert (sharded.global_rate, sharded.chat_rate) == (10.0, 1.0)
+    shared = queue_worker.worker_limiter(3, sharding=False)
+    assert (shared.global_rate, round(shared.chat_rate, 6)) == (10.0, round(1 / 3, 6))
+
+
+def test_send_message_consults_limiter_and_learns_retry_after(monkeypatch):
+    limiter = rate_limit.RateLimiter(global_rate=0, chat_rate=1000.0, chat_burst=10)
+    rate_limit.set_limiter(limiter)
+    calls = []
+    monkeypatch.setattr(limiter, "acquire", lambda chat_id: calls.append(chat_id) or 0.0)
+    penalties = []
+    monkeypatch.setattr(limiter, "penalize", lambda chat_id, delay: penalties.append((chat_id, delay)))
+
+    with StubTelegramServer() as server:
+        monkeypatch.setenv(telegram_client.API_URL_ENV, server.url)
+        telegram_client.reset_session()
+        telegram_client.send_message("token", {"chat_id": "42", "text": "hi"})
+    telegram_client.reset_session()
+    assert calls == ["42"]
+
+    response = requests.Response()
+    response.status_code = 429
+    response._content = b'{"ok": false, "parameters": {"retry_after": 9}}'
+    session = type("Session", (), {"post": lambda self, *args, **kwargs: response})()
+    monkeypatch.setattr(telegram_client, "get_session", lambda: session)
+    with pytest.raises(telegram_client.TelegramAPIError):
+        telegram_client.send_message("token", {"chat_id": "42", "text": "hi"})
+    assert penalties == [("42", 9.0)]
+
+
+def test_concurrent_reservations_are_unique():
+    clock = FakeClock()
+    limiter = make_limiter(clock, global_rate=0, chat_rate=10.0, chat_burst=1)
+    waits = []
+    lock = threading.Lock()
+
+    def reserve_many():
+        for _ in range(50):
+            wait = limiter.reserve("chat")
+            with lock:
+                waits.append(wait)
+
+    threads = [threading.Thread(target=reserve_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(waits) == pytest.approx([index / 10.0 for index in range(400)])
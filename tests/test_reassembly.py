@@ -0,0 +1,77 @@
+import random
+import re
+
+import pytest
+
+import reassembly
+
+
+def legacy_clean(text, limit):
+    text = text.lstrip()
+    text = re.sub(r"\n(?!\n)", " ", text)
+    text = re.sub(r" {2,}", " ", text)
+    return (text or "(empty)")[:limit]
+
+
+def test_text_builder_matches_whole_string_normalization():
+    rng = random.Random(7)
+    for _ in range(2000):
+        parts = ["".join(rng.choice("ab \n\t") for _ in range(rng.randint(0, 8))) for _ in range(rng.randint(1, 5))]
+        limit = rng.randint(1, 30)
+        assert reassembly.normalize_parts(parts, limit) == legacy_clean("".join(parts), limit), parts
+
+
+def test_normalize_stops_reading_at_the_limit():
+    consumed = []
+
+    def parts():
+        for index in range(1000):
+            consumed.append(index)
+            yield "x" * 100
+
+    assert reassembly.normalize_parts(parts(), limit=250) == "x" * 250
+    assert len(consumed) == 3
+
+
+def test_split_text_prefers_line_and_word_breaks():
+    assert reassembly.split_text("short", 10) == ["short"]
+    assert reassembly.split_text("aaaa bbbb\ncccc dddd", 12) == ["aaaa bbbb", "cccc dddd"]
+    assert reassembly.split_text("aaaaa bbbbb ccccc", 12) == ["aaaaa bbbbb", "ccccc"]
+    assert reassembly.split_text("x" * 25, 10) == ["x" * 10, "x" * 10, "x" * 5]
+    text = "word " * 3000
+    assert all(len(piece) <= 4000 for piece in reassembly.split_text(text, 4000))
+
+
+@pytest.mark.parametrize(
+    "udh, expected",
+    [
+        ("050003A70302", (0xA7, 3, 2)),
+        ("0608041234 0201".replace(" ", ""), (0x1234, 2, 1)),
+        # A port-addressing element before the concatenation element.
+        ("0B05040B8423F00003150201", (0x15, 2, 1)),
+        ("050003A70304", None),
+        ("050003A700", None),
+        ("", None),
+        ("zz", None),
+    ],
+)
+def test_parse_concat_udh(udh, expected):
+    assert reassembly.parse_concat_udh(udh) == expected
+
+
+def test_concat_index_completes_out_of_order_and_expires_stragglers():
+    now = [0.0]
+    index = reassembly.ConcatIndex(timeout=600, max_open=2, clock=lambda: now[0])
+    assert index.add("+1", 7, 3, [3], "c") is None
+    assert index.add("+1", 7, 3, [1], "a") is None
+    message = index.add("+1", 7, 3, [2], "b")
+    assert message.complete and message.items == ["c", "a", "b"] and len(index) == 0
+
+    index.add("+1", 8, 2, [1], "x")
+    now[0] = 10
+    index.add("+2", 8, 2, [1], "y")
+    index.add("+3", 8, 2, [1], "z")
+    assert [message.items for message in index.expired()] == [["x"]]
+    now[0] = 700
+    assert sorted(message.items[0] for message in index.expired()) == ["y", "z"]
+    assert len(index) == 0
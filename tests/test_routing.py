@@ -0,0 +1,126 @@
+import json
+from unittest import mock
+
+import pytest
+import requests
+
+import queue_worker
+import routing
+import sms_queue
+import sqlite_queue
+
+ROUTES = [
+    {"numbers": ["+4917"], "destinations": ["telegram:mobile"]},
+    {"keywords": ["code", "OTP"], "destinations": ["telegram:otp@alerts", "webhook:http://hook.test/sms"]},
+    {"numbers": ["+49 170"], "keywords": ["codeword"], "destinations": ["telegram:special", "telegram:mobile"]},
+]
+
+
+def make_router(**kwargs):
+    return routing.Router(ROUTES, "main", bots={"alerts": "alert-token"}, **kwargs)
+
+
+def test_prefix_trie_returns_every_matching_prefix():
+    trie = routing.PrefixTrie()
+    trie.add("+49", 1)
+    trie.add("+4917", 2)
+    trie.add("+44", 3)
+    trie.add("", 4)
+    assert trie.match("+4917012") == {1, 2, 4}
+    assert trie.match("+4930") == {1, 4}
+    assert trie.match("") == {4}
+
+
+def test_keyword_index_finds_overlapping_keywords():
+    index = routing.KeywordIndex({"code": {1}, "codeword": {2}, "word": {3}, "x.y": {4}})
+    assert index.match("Your CODEWORD") == {1, 2, 3}
+    assert index.match("no match: xzy") == set()
+    assert index.match("x.y") == {4}
+
+
+def test_route_unions_matching_rules_in_order():
+    router = make_router()
+    assert router.route("+491701234", "hello") == ["telegram:mobile"]
+    assert router.route("+44123", "Your otp is 1234") == ["telegram:otp@alerts", "webhook:http://hook.test/sms"]
+    assert router.route("+491701234", "the codeword") == [
+        "telegram:mobile",
+        "telegram:otp@alerts",
+        "webhook:http://hook.test/sms",
+        "telegram:special",
+    ]
+    assert router.route("+44123", "hello") == ["telegram:main"]
+    assert make_router(default=["webhook:http://all.test"]).route("+1", "hi") == ["webhook:http://all.test"]
+
+
+def test_invalid_rules_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        routing.Router([{"destinations": ["telegram:x@nobody"]}], "main")
+    with pytest.raises(ValueError):
+        routing.Router([{"destinations": ["sms:+1"]}], "main")
+    with pytest.raises(ValueError):
+        routing.Router([{"numbers": ["+1"]}], "main")
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps({"routes": ROUTES, "bots": {"alerts": "t"}}))
+    assert routing.load_router("main", {routing.ROUTES_ENV: str(path)}.get).route("+4917", "") == ["telegram:mobile"]
+    assert routing.load_router("main", {}.get) is None
+
+
+def test_fan_out_children_have_stable_ids():
+    router = make_router()
+    payload = sms_queue.build_payload("+44123", "OTP 1")
+    children = router.fan_out(payload)
+    assert [child["id"] for child in children] == [f"{payload['id']}-0", f"{payload['id']}-1"]
+    assert children[0]["chat_id"] == "otp" and children[0]["bot"] == "alerts"
+    assert children[1]["webhook"] == "http://hook.test/sms"
+    assert all(child["parent"] == payload["id"] for child in children)
+    assert router.fan_out(sms_queue.build_payload("+44123", "hi")) is None
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite"])
+def test_enqueue_payloads_skips_known_ids(tmp_path, backend):
+    if backend == "file":
+        queue = sms_queue.FileQueue(tmp_path / "queue")
+    else:
+        queue = sqlite_queue.SQLiteQueue(tmp_path / "queue.sqlite3")
+    payload = sms_queue.build_payload("+1", "first")
+    queue.enqueue_payloads([payload])
+    (item,) = queue.pending()
+    queue.ack(queue.claim(item))
+    queue.enqueue_payloads([dict(payload, text="again"), sms_queue.build_payload("+2", "second")])
+    assert [item.payload["text"] for item in queue.pending()] == ["second"]
+    assert queue.counts()["sent"] == 1
+    queue.close()
+
+
+def test_destinations_are_delivered_and_retried_independently(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+44123", "OTP 1234")
+    router = make_router()
+
+    with mock.patch("queue_worker.telegram_client.send_message") as send, mock.patch(
+        "routing.telegram_client.get_session"
+    ) as session:
+        session.return_value.post.return_value.raise_for_status.side_effect = requests.HTTPError("503")
+        assert queue_worker.process_queue_once(queue, "token", "main", 3, 10.0, router=router)
+        assert queue.counts() == {"pending": 2, "processing": 0, "sent": 1, "failed": 0}
+        assert queue_worker.process_queue_once(queue, "token", "main", 3, 10.0, router=router)
+
+    send.assert_called_once()
+    assert send.call_args.args[0] == "alert-token"
+    assert send.call_args.args[1]["chat_id"] == "otp"
+    assert session.return_value.post.call_args.args[0] == "http://hook.test/sms"
+    assert session.return_value.post.call_args.kwargs["json"]["text"] == "OTP 1234"
+    (pending,) = queue.pending()
+    assert pending.payload["webhook"] == "http://hook.test/sms"
+    assert pending.payload["attempts"] == 1
+    assert queue.counts()["sent"] == 2
+
+
+def test_default_route_delivers_without_fan_out(tmp_path):
+    queue = sms_queue.FileQueue(tmp_path / "queue")
+    queue.enqueue("+44123", "hello")
+    with mock.patch("queue_worker.telegram_client.send_message") as send:
+        assert queue_worker.process_queue_once(queue, "token", "main", 3, 10.0, router=make_router())
+    send.assert_called_once()
+    assert send.call_args.args[1]["chat_id"] == "main"
+    assert queue.counts()["sent"] == 1
@@ -0,0 +1,192 @@
+import json
+import time
+from unittest import mock
+
+import requests
+
+import queue_worker
+import sms_queue
+import sqlite_queue
+
+
+def make_queue(tmp_path):
+    return sqlite_queue.SQLiteQueue(tmp_path / "queue.sqlite3")
+
+
+def test_enqueue_claim_ack(tmp_path):
+    queue = make_queue(tmp_path)
+    message_id = queue.enqueue("+123", "Hello", chat_id="chat")
+    (item,) = queue.pending()
+    assert item.id == message_id
+    assert item.payload["text"] == "Hello"
+    assert item.payload["chat_id"] == "chat"
+
+    claimed = queue.claim(item)
+    assert claimed is not None
+    assert queue.claim(item) is None
+    assert list(queue.pending()) == []
+    queue.ack(claimed)
+    assert queue.counts() == {"pending": 0, "processing": 0, "sent": 1, "failed": 0}
+    assert queue.wake_path.exists()
+    queue.close()
+
+
+def test_pending_order_and_batch_limit(tmp_path):
+    queue = sqlite_queue.SQLiteQueue(tmp_path / "queue.sqlite3", batch_size=2)
+    for index in range(3):
+        queue.enqueue("+123", f"m{index}")
+    assert [item.payload["text"] for item in queue.pending()] == ["m0", "m1"]
+    queue.close()
+
+
+def test_deferred_rows_at_the_head_do_not_starve_due_ones(tmp_path):
+    queue = sqlite_queue.SQLiteQueue(tmp_path / "queue.sqlite3", batch_size=5)
+    queue.enqueue("+1", "a0", chat_id="chat-a")
+    head = queue.claim(next(queue.pending()))
+    head.payload["next_attempt_at"] = time.time() + 3600
+    queue.retry(head)
+    for index in range(1, 7):
+        queue.enqueue("+1", f"a{index}", chat_id="chat-a")
+    queue.enqueue("+2", "b0", chat_id="chat-b")
+
+    with mock.patch("queue_worker.send_once") as mock_send:
+        assert queue_worker.process_queue_once(queue, "token", "default", 3, 1.0)
+    assert [call.args[1:] for call in mock_send.call_args_list] == [("chat-b", "+2", "b0")]
+    assert queue.counts() == {"pending": 7, "processing": 0, "sent": 1, "failed": 0}
+    queue.close()
+
+
+def test_stale_retry_does_not_revive_a_settled_row(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue("+1", "hello")
+    claimed = queue.claim(next(queue.pending()))
+    queue.ack(claimed)
+    queue.retry(claimed)
+    assert queue.counts() == {"pending": 0, "processing": 0, "sent": 1, "failed": 0}
+    queue.close()
+
+
+def test_retry_recover_and_requeue(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue("+123", "Hello")
+    claimed = queue.claim(next(queue.pending()))
+    claimed.payload.update({"attempts": 1, "next_attempt_at": 123.0, "last_error": "boom"})
+    queue.retry(claimed)
+    (item,) = queue.pending()
+    assert item.payload["attempts"] == 1
+    assert queue._connection().execute("SELECT next_attempt_at FROM messages").fetchone() == (123.0,)
+
+    queue.claim(item)
+    assert queue.recover() == 1
+    claimed = queue.claim(next(queue.pending()))
+    queue.fail(claimed)
+    assert queue.counts()["failed"] == 1
+    assert queue.requeue_failed() == 1
+    (item,) = queue.pending()
+    assert "attempts" not in item.payload
+    queue.close()
+
+
+def test_worker_delivers_from_sqlite(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue("+123", "first")
+    queue.enqueue("+123", "second")
+
+    with mock.patch("queue_worker.send_once") as mock_send:
+        assert queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0)
+    assert [call.args[3] for call in mock_send.call_args_list] == ["first", "second"]
+    assert queue.counts()["sent"] == 2
+
+    queue.enqueue("+123", "third")
+    with mock.patch("queue_worker.send_once", side_effect=requests.RequestException("down")):
+        assert queue_worker.process_queue_once(queue, "token", "chat", 3, 10.0)
+        assert not queue_worker.process_queue_once(queue, "token", "chat", 3, 10.0)
+    (item,) = queue.pending()
+    assert item.payload["attempts"] == 1
+    queue.close()
+
+
+def test_worker_pool_with_sqlite(tmp_path):
+    queue = make_queue(tmp_path)
+    for index in range(6):
+        queue.enqueue("+123", f"m{index}", chat_id=f"chat-{index % 3}")
+    pool = queue_worker.DeliveryPool(3)
+    try:
+        with mock.patch("queue_worker.send_once"):
+            assert queue_worker.process_queue_once(queue, "token", "chat", 3, 1.0, pool)
+            pool.drain()
+    finally:
+        pool.shutdown()
+    assert queue.counts()["sent"] == 6
+    queue.close()
+
+
+def test_import_spool(tmp_path):
+    spool = tmp_path / "spool"
+    pending = sms_queue.enqueue_message("+1", "pending", spool)
+    in_flight = sms_queue.move_item(sms_queue.enqueue_message("+2", "processing", spool), spool / "processing")
+    sent = sms_queue.move_item(sms_queue.enqueue_message("+3", "sent", spool), spool / "sent")
+    failed = sms_queue.enqueue_message("+4", "failed", spool)
+    payload = json.loads(failed.read_text())
+    payload.update({"attempts": 5, "last_error": "boom"})
+    failed.write_text(json.dumps(payload))
+    failed = sms_queue.move_item(failed, spool / "failed")
+    (spool / "pending" / "broken.json").write_text("{")
+
+    queue = make_queue(tmp_path)
+    imported = sqlite_queue.import_spool(spool, queue)
+    assert imported == {"pending": 2, "processing": 0, "sent": 1, "failed": 1}
+    assert [item.payload["text"] for item in queue.pending()] == ["pending", "processing"]
+    assert sqlite_queue.import_spool(spool, queue) == {"pending": 0, "processing": 0, "sent": 0, "failed": 0}
+    row = queue._connection().execute("SELECT payload FROM messages WHERE state = 'failed'").fetchone()
+    assert json.loads(row[0])["last_error"] == "boom"
+
+    sqlite_queue.import_spool(spool, queue, delete=True)
+    for path in (pending, in_flight, sent, failed):
+        assert not path.exists()
+    queue.close()
+
+
+def test_import_spool_cli(tmp_path):
+    spool = tmp_path / "spool"
+    sms_queue.enqueue_message("+1", "hi", spool)
+    sqlite_queue.main(["import-spool", str(spool), "--db", str(tmp_path / "db.sqlite3")])
+    queue = sqlite_queue.SQLiteQueue(tmp_path / "db.sqlite3")
+    assert queue.counts()["pending"] == 1
+    queue.close()
+
+
+def test_open_queue_selects_backend(tmp_path):
+    env = {"SMSGW_QUEUE_DIR": str(tmp_path), "SMSGW_QUEUE_BACKEND": "sqlite"}
+    queue = sms_queue.open_queue(env.get)
+    assert isinstance(queue, sqlite_queue.SQLiteQueue)
+    assert queue.path == tmp_path / "queue.sqlite3"
+    queue.close()
+
+    env["SMSGW_QUEUE_BACKEND"] = "bogus"
+    assert isinstance(sms_queue.open_queue(env.get), sms_queue.FileQueue)
+
+
+def test_leases_and_shards(tmp_path):
+    first = make_queue(tmp_path)
+    second = make_queue(tmp_path)
+    for index in range(20):
+        first.enqueue("+1", f"m{index}", chat_id=f"chat-{index % 5}")
+    shards = [
+        [item.payload["chat_id"] for item in sqlite_queue.SQLiteQueue(first.path, shard=(i, 2)).pending()]
+        for i in range(2)
+    ]
+    assert len(shards[0] + shards[1]) == 20 and not set(shards[0]) & set(shards[1])
+
+    held, abandoned = [first.claim(item) for item in list(first.pending())[:2]]
+    with first.transaction() as conn:
+        conn.execute("UPDATE messages SET updated_at = 0 WHERE state = 'processing'")
+    assert first.renew() == 2
+    first._drop(abandoned.id)
+    with first.transaction() as conn:
+        conn.execute("UPDATE messages SET updated_at = 0 WHERE id = ?", (abandoned.id,))
+    assert second.recover(lease=60) == 1
+    assert first.recover(lease=0.001) == 0
+    assert first.count("processing") == 1
+    first.close()
+    second.close()
@@ -0,0 +1,162 @@
+import io
+import sys
+import threading
+import time
+from pathlib import Path
+
+import supervisor
+
+
+class FakeHelpers:
+    def __init__(self, port="/dev/fake-modem"):
+        self.port = port
+        self.calls = []
+
+    def detect(self):
+        self.calls.append("detect")
+        return self.port
+
+    def probe(self, port):
+        self.calls.append("probe")
+        return True
+
+    def reset(self, port):
+        self.calls.append("reset")
+        return True
+
+
+def fake_smsd(*lines, linger=30.0):
+    script = "import sys, time\n"
+    for line in lines:
+        script += f"print({line!r}, flush=True)\ntime.sleep(0.01)\n"
+    script += f"time.sleep({linger})\n"
+    return [sys.executable, "-c", script]
+
+
+def run_until(sup, condition, timeout=10.0):
+    thread = threading.Thread(target=sup.run)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    sup.request_stop()
+    thread.join(timeout)
+    assert not thread.is_alive()
+    assert condition()
+
+
+def test_hang_restarts_smsd_then_resets_usb_within_seconds():
+    helpers = FakeHelpers()
+    output = io.StringIO()
+    sup = supervisor.Supervisor(
+        fake_smsd("GSM started", "Error: TIMEOUT", "No response in specified timeout", "TIMEOUT"),
+        helpers,
+        output=output,
+    )
+    started = time.monotonic()
+    run_until(sup, lambda: sup.resets == 1 and sup.smsd_starts == 3)
+
+    assert time.monotonic() - started < 5
+    # The first hang only restarts gammu-smsd; the second one resets USB and
+    # polls the modem instead of sleeping through the settle time.
+    assert helpers.calls[:4] == ["detect", "detect", "reset", "probe"]
+    assert output.getvalue().count("GSM started") >= 2
+
+
+def test_interleaved_timeouts_do_not_count():
+    helpers = FakeHelpers()
+    sup = supervisor.Supervisor(
+        fake_smsd("TIMEOUT", "ok", "TIMEOUT", "ok", "TIMEOUT", linger=0), helpers, detect_retry=0.01
+    )
+    run_until(sup, lambda: sup.smsd_starts >= 2)
+    assert sup.resets == 0
+    assert "reset" not in helpers.calls
+
+
+def test_detection_resets_usb_after_reset_after_seconds():
+    class NoModem(FakeHelpers):
+        def detect(self):
+            self.calls.append("detect")
+            return None
+
+    helpers = NoModem()
+    sup = supervisor.Supervisor(fake_smsd(), helpers, detect_retry=0.01, reset_after=0.05)
+    run_until(sup, lambda: sup.resets >= 1)
+    assert sup.smsd_starts == 0
+
+
+def test_crashed_child_is_restarted_with_backoff():
+    now = [0.0]
+    child = supervisor.ManagedChild(
+        "worker", [sys.executable, "-c", "raise SystemExit(3)"], min_delay=1.0, max_delay=4.0, clock=lambda: now[0]
+    )
+    child.start()
+    first_pid = child.pid
+    child._process.wait()
+    child.poll()
+    assert child.restarts == 0
+    now[0] = 0.5
+    child.poll()
+    assert child.pid == first_pid
+    now[0] = 1.0
+    child.poll()
+    assert child.restarts == 1 and child.pid != first_pid
+
+    child._process.wait()
+    child.poll()
+    now[0] = 2.5
+    child.poll()
+    assert child.restarts == 1
+    now[0] = 3.0
+    child.poll()
+    assert child.restarts == 2
+    child.stop(1.0)
+
+
+def test_stop_terminates_children_gracefully():
+    child = supervisor.ManagedChild("worker", [sys.executable, "-c", "import time; time.sleep(30)"])
+    sup = supervisor.Supervisor(fake_smsd("started"), FakeHelpers(), [child])
+    run_until(sup, lambda: sup.smsd_starts == 1 and child.pid is not None)
+    assert child._process.poll() is not None
+
+
+def test_reset_backoff_matches_entrypoint():
+    now = [0.0]
+    backoff = supervisor.ResetBackoff(min_interval=60, step=30, maximum=60, window=300, clock=lambda: now[0])
+    assert backoff.delay() == 0
+    backoff.record()
+    now[0] = 10
+    assert backoff.delay() == 80
+    now[0] = 100
+    backoff.record()
+    now[0] = 110
+    assert backoff.delay() == 110
+    now[0] = 1000
+    assert backoff.delay() == 0
+
+
+def test_build_children_by_mode(tmp_path):
+    assert supervisor.build_children("direct") == []
+    names = [child.name for child in supervisor.build_children("inbox", "python3", tmp_path)]
+    assert names == ["queue worker", "inbox ingester"]
+    sharded = supervisor.build_children("queue", "python3", tmp_path, outbox=True, workers=2)
+    assert [child.name for child in sharded] == ["outbox", "queue worker 0", "queue worker 1"]
+    assert sharded[2].argv[-2:] == ["--shard", "1/2"]
+    assert [child.name for child in supervisor.build_children("hybrid", "python3", tmp_path)] == ["queue worker"]
+    assert supervisor.resolve_delivery_mode(" Queue ") == "queue"
+    assert supervisor.resolve_delivery_mode("bogus") == "direct"
+
+
+def test_shell_helpers_use_entrypoint_functions(tmp_path):
+    gammu = tmp_path / "gammu"
+    gammu.write_text("#!/usr/bin/env bash\necho 'IMEI : 1'\n")
+    gammu.chmod(0o755)
+    port = tmp_path / "ttyUSB9"
+    port.touch()
+    env = {"PATH": f"{tmp_path}:/usr/bin:/bin", "GAMMU_SPOOL_PATH": str(tmp_path)}
+    helpers = supervisor.ShellHelpers(Path("entrypoint.sh").resolve(), env)
+    assert helpers.probe(str(port))
+    env["MODEM_PORT"] = str(port)
+    assert helpers.detect() == str(port)
+    gammu.write_text("#!/usr/bin/env bash\nexit 1\n")
+    assert not helpers.probe(str(port))
@@ -0,0 +1,45 @@
+import pytest
+import requests
+
+import telegram_client
+from benchmarks.stub_telegram import StubTelegramServer
+
+
+@pytest.fixture(autouse=True)
+def fresh_session():
+    telegram_client.reset_session()
+    yield
+    telegram_client.reset_session()
+
+
+def test_api_url_default(monkeypatch):
+    monkeypatch.delenv("TELEGRAM_API_URL", raising=False)
+    assert telegram_client.api_url("abc") == "https://api.telegram.org/botabc/sendMessage"
+
+
+def test_api_url_override(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_API_URL", "http://127.0.0.1:8081/")
+    assert telegram_client.api_url("abc", "getMe") == "http://127.0.0.1:8081/botabc/getMe"
+
+
+def test_timeouts_from_env(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_CONNECT_TIMEOUT", "1.5")
+    monkeypatch.setenv("TELEGRAM_READ_TIMEOUT", "7")
+    assert telegram_client.get_timeouts() == (1.5, 7.0)
+
+
+def test_send_message_reuses_connection(monkeypatch):
+    with StubTelegramServer() as server:
+        monkeypatch.setenv("TELEGRAM_API_URL", server.url)
+        for index in range(5):
+            telegram_client.send_message("token", {"chat_id": "chat", "text": f"hi {index}"})
+        assert server.connections == 1
+        assert [item["payload"]["text"] for item in server.requests] == [f"hi {index}" for index in range(5)]
+        assert server.requests[0]["path"] == "/bottoken/sendMessage"
+
+
+def test_send_message_raises_on_http_error(monkeypatch):
+    with StubTelegramServer() as server:
+        monkeypatch.setenv("TELEGRAM_API_URL", server.url + "/missing")
+        with pytest.raises(requests.HTTPError):
+            telegram_client.send_message("token", {"chat_id": "chat", "text": "hi"})